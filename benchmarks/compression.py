@@ -0,0 +1,68 @@
+"""
+Benchmark zarr compression profiles on a sample of a real volume.
+
+Usage:
+
+    python benchmarks/compression.py PATH [--labels] [--samples 4]
+
+PATH is a zarr array (or OME-Zarr group), or a directory of image slices.
+Reports the compression ratio and the write and read throughput of each
+profile, and the profile that would be picked for a conversion.
+
+"""
+
+import argparse
+import pathlib
+
+from ml4paleo.volume_providers import ImageStackVolumeProvider, ZarrVolumeProvider
+from ml4paleo.volume_providers.compression import (
+    DEFAULT_MIN_WRITE_MB_PER_S,
+    IMAGE_COMPRESSION_PROFILES,
+    LABEL_COMPRESSION_PROFILES,
+    benchmark_compression,
+    pick_compression_profile,
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("path", type=pathlib.Path)
+    parser.add_argument(
+        "--labels", action="store_true", help="Benchmark the label profiles."
+    )
+    parser.add_argument("--samples", type=int, default=4)
+    parser.add_argument("--chunk", type=int, nargs=3, default=(256, 256, 32))
+    parser.add_argument(
+        "--min-mb-per-s", type=float, default=DEFAULT_MIN_WRITE_MB_PER_S
+    )
+    parser.add_argument(
+        "--workdir", type=pathlib.Path, default=None,
+        help="Where to write the temporary arrays (e.g. the destination disk).",
+    )
+    args = parser.parse_args()
+
+    if (args.path / ".zarray").exists() or (args.path / ".zgroup").exists():
+        volume = ZarrVolumeProvider(args.path)
+    else:
+        volume = ImageStackVolumeProvider(args.path, cache_size=0)
+    profiles = LABEL_COMPRESSION_PROFILES if args.labels else IMAGE_COMPRESSION_PROFILES
+
+    print(f"Sampling {args.samples} x {tuple(args.chunk)} of {volume.shape} {volume.dtype}")
+    results = benchmark_compression(
+        volume,
+        profiles=profiles,
+        chunk_size=tuple(args.chunk),
+        samples=args.samples,
+        workdir=args.workdir,
+    )
+    print(f"{'profile':<12} {'ratio':>8} {'write (MB/s)':>13} {'read (MB/s)':>12}")
+    for result in results:
+        print(
+            f"{result['profile']:<12} {result['ratio']:>8.2f} "
+            f"{result['write_mb_per_s']:>13.1f} {result['read_mb_per_s']:>12.1f}"
+        )
+    print(f"Picked: {pick_compression_profile(results, args.min_mb_per_s)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+Micro-benchmark for `normalize_key`, which runs on every provider read.
+
+Usage:
+
+    python benchmarks/normalize_key.py [--number 100000]
+
+Reports the per-call overhead for a few representative keys, both when the
+normalized result is already cached (the common case: a conversion reads the
+same slab shapes over and over) and when every call sees a new key.
+
+"""
+
+import argparse
+import timeit
+
+import numpy as np
+
+from ml4paleo.volume_providers.volume_provider import (
+    _normalize_signature,
+    normalize_key,
+)
+
+SHAPE_ZYX = (2048, 4096, 4096)
+
+KEYS = {
+    "full slab": np.s_[:, :, 128:192],
+    "cutout": np.s_[1000:1512, 2000:2512, 40:51],
+    "negative + step": np.s_[-512::2, -512::2, ::4],
+    "numpy ints": np.s_[np.int64(10) : np.int64(522), np.int32(3), ...],
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--number", type=int, default=100_000)
+    args = parser.parse_args()
+
+    print(f"{'key':<18} {'cached (us)':>12} {'uncached (us)':>14}")
+    for name, key in KEYS.items():
+        cached = timeit.timeit(
+            lambda: normalize_key(key, SHAPE_ZYX), number=args.number
+        )
+
+        def _uncached():
+            _normalize_signature.cache_clear()
+            normalize_key(key, SHAPE_ZYX)
+
+        uncached = timeit.timeit(_uncached, number=args.number)
+        print(
+            f"{name:<18} {cached / args.number * 1e6:>12.2f} "
+            f"{uncached / args.number * 1e6:>14.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,8 @@ from intern.utils.parallel import block_compute
 import zarr
 import numpy as np
 from ml4paleo.volume_providers import VolumeProvider
-from .segmenter import Segmenter3D
+from ml4paleo.volume_providers.compression import get_compressor
+from .segmenter import Segmenter3D, smallest_label_dtype
 from .rf import RandomForest3DSegmenter
 
 import tqdm
@@ -22,11 +23,16 @@ def segment_chunk_and_write(
     """
     Segment a chunk of a job.
     """
-    # Get the volume for the chunk:
-    volume = volume_provider[xs[0] : xs[1], ys[0] : ys[1], zs[0] : zs[1]]
+    # Get the volume for the chunk, plus the neighboring slices that 3D
+    # features need (so chunks don't have seams in Z):
+    z_halo = getattr(segmenter, "z_halo", 0)
+    z_start = max(0, zs[0] - z_halo)
+    z_stop = min(volume_provider.shape[2], zs[1] + z_halo)
+    volume = volume_provider[xs[0] : xs[1], ys[0] : ys[1], z_start:z_stop]
     # Segment the volume:
     # seg_volume = np.zeros(volume.shape, dtype=np.uint64)
     seg_volume = segmenter.segment(volume)
+    seg_volume = seg_volume[:, :, zs[0] - z_start : zs[1] - z_start]
     # Write the seg to the seg path zarr:
     seg_zarr = zarr.open(seg_path, mode="a")
     seg_zarr[xs[0] : xs[1], ys[0] : ys[1], zs[0] : zs[1]] = seg_volume
@@ -41,17 +47,28 @@ def segment_volume_to_zarr(
     parallel: Union[bool, int] = True,
     progress: bool = True,
     progress_callback: Optional[Callable[[int, Any, int], Any]] = None,
+    compression="labels",
+    label_dtype=None,
 ):
     seg_path.mkdir(parents=True, exist_ok=True)
 
+    # Labels are stored in the segmenter's (smallest sufficient) label dtype,
+    # or a wider one if requested, so they are never truncated.
+    segmenter_dtype = getattr(segmenter, "label_dtype", np.dtype(np.uint64))
+    if label_dtype is not None:
+        label_dtype = np.promote_types(label_dtype, segmenter_dtype)
+    else:
+        label_dtype = segmenter_dtype
+
     # Create the Zarr file for the segmentation.
     zarr.open(
         str(seg_path),
         mode="w",
         zarr_format=2,
-        dtype="uint64",
+        dtype=label_dtype,
         shape=vol_provider.shape,
         chunks=chunk_size,
+        compressor=get_compressor(compression),
         write_empty_chunks=False,
     )
 
@@ -89,4 +106,9 @@ def segment_volume_to_zarr(
     )
 
 
-__all__ = ["Segmenter3D", "RandomForest3DSegmenter", "segment_chunk_and_write"]
+__all__ = [
+    "Segmenter3D",
+    "RandomForest3DSegmenter",
+    "segment_chunk_and_write",
+    "smallest_label_dtype",
+]
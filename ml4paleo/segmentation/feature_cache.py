@@ -0,0 +1,198 @@
+import hashlib
+import os
+import pathlib
+import tempfile
+import threading
+from typing import Callable, Optional, Union
+
+import numpy as np
+
+from ml4paleo.volume_providers.cache import SliceCache
+
+
+def describe_features_fn(features_fn: Callable) -> str:
+    """
+    Return a stable description of a features function and its parameters.
+
+    `functools.partial` objects are described by their function and their
+    (sorted) bound arguments, so equal partials get equal descriptions.
+    """
+    func = getattr(features_fn, "func", features_fn)
+    name = f"{getattr(func, '__module__', '')}.{getattr(func, '__qualname__', repr(func))}"
+    args = getattr(features_fn, "args", ())
+    keywords = sorted(getattr(features_fn, "keywords", {}).items())
+    return f"{name}{args!r}{keywords!r}"
+
+
+class FeatureCache:
+    """
+    A content-addressed cache of the features of 2D slices.
+
+    Entries are keyed by a hash of the slice's contents plus a description of
+    how its features were computed (see `key`), so a slice that is featurized
+    again with the same parameters (e.g. when previewing predictions on the
+    same annotation slice over and over) is only computed once.
+
+    Features are kept in an in-memory LRU cache (see `SliceCache`) in front
+    of an optional on-disk cache. The on-disk cache is shared by every process
+    that uses the same directory: files are written atomically, and the least
+    recently used files are deleted once the directory exceeds its size limit.
+    """
+
+    def __init__(
+        self,
+        directory: Optional[Union[str, pathlib.Path]] = None,
+        max_disk_bytes: int = 4 * 1024**3,
+        max_memory_bytes: int = 512 * 1024**2,
+    ):
+        """
+        Create a new FeatureCache.
+
+        Arguments:
+            directory (pathlib.Path): The directory of the on-disk cache. If
+                None, features are only cached in memory.
+            max_disk_bytes (int): The maximum total size of the on-disk cache.
+                Defaults to 4 GB.
+            max_memory_bytes (int): The maximum total size of the in-memory
+                cache. Defaults to 512 MB.
+
+        """
+        self.directory = pathlib.Path(directory) if directory is not None else None
+        self.max_disk_bytes = int(max_disk_bytes)
+        self._memory = SliceCache(max_memory_bytes)
+        self._disk_lock = threading.Lock()
+        self._disk_bytes: Optional[int] = None
+        if self.directory is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        del state["_disk_lock"]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._disk_lock = threading.Lock()
+
+    @staticmethod
+    def key(imgslice: np.ndarray, parameters: str) -> str:
+        """
+        Return the cache key of a slice's features.
+
+        Arguments:
+            imgslice (np.ndarray): The slice.
+            parameters (str): A description of how the features are computed
+                (e.g. from `describe_features_fn`).
+
+        Returns:
+            str: The key.
+
+        """
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(f"{imgslice.shape}{imgslice.dtype.str}{parameters}".encode())
+        digest.update(np.ascontiguousarray(imgslice).data)
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> pathlib.Path:
+        return self.directory / key[:2] / f"{key}.npy"
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """
+        Return the cached features for a key, or None if they aren't cached.
+        """
+        features = self._memory.get(key)
+        if features is not None or self.directory is None:
+            return features
+        path = self._path(key)
+        try:
+            features = np.load(path)
+            # Mark the file as recently used, for eviction:
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        self._memory.put(key, features)
+        return features
+
+    def put(self, key: str, features: np.ndarray) -> None:
+        """
+        Cache the features for a key, in memory and on disk.
+        """
+        self._memory.put(key, features)
+        if self.directory is None:
+            return
+        path = self._path(key)
+        if path.exists():
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file and rename it, so that other processes
+        # never read a partial file:
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, features)
+            os.replace(tmp_path, path)
+        except BaseException:
+            pathlib.Path(tmp_path).unlink(missing_ok=True)
+            raise
+        with self._disk_lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = self._scan_disk_bytes()
+            else:
+                self._disk_bytes += path.stat().st_size
+            if self._disk_bytes > self.max_disk_bytes:
+                self._evict()
+
+    def get_or_compute(self, key: str, compute_fn: Callable[[], np.ndarray]) -> np.ndarray:
+        """
+        Return the cached features for a key, computing and caching them if
+        they aren't cached yet.
+        """
+        features = self.get(key)
+        if features is None:
+            features = compute_fn()
+            self.put(key, features)
+        return features
+
+    def _entries(self):
+        return list(self.directory.glob("*/*.npy"))
+
+    def _scan_disk_bytes(self) -> int:
+        total = 0
+        for path in self._entries():
+            try:
+                total += path.stat().st_size
+            except OSError:
+                pass
+        return total
+
+    def _evict(self) -> None:
+        """
+        Delete the least recently used files until the on-disk cache is
+        within its size limit (and a little under, so we don't evict on
+        every write).
+        """
+        entries = []
+        for path in self._entries():
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        target = int(self.max_disk_bytes * 0.9)
+        for _, size, path in entries:
+            if total <= target:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+        self._disk_bytes = total
+
+    def stats(self) -> dict:
+        """
+        Return the in-memory cache counters (see `SliceCache.stats`).
+        """
+        return self._memory.stats()
+
+
+__all__ = ["FeatureCache", "describe_features_fn"]
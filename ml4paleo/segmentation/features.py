@@ -0,0 +1,242 @@
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+import scipy.ndimage as ndi
+import skimage.feature
+from skimage.util import img_as_float32
+
+_SOBEL_EDGE = np.array([1.0, 0.0, -1.0], dtype=np.float32)
+_SOBEL_SMOOTH = np.array([1.0, 2.0, 1.0], dtype=np.float32) / 4
+
+# Named sets of `multiscale_stack_features` parameters, from cheapest to most
+# thorough. "default" is the features that models have always been trained
+# with (24 channels); "minimal" has 8 channels and "full" has 52.
+FEATURE_BANKS = {
+    "minimal": dict(
+        intensity=True, edges=True, texture=False, sigma_min=1, sigma_max=8
+    ),
+    "default": dict(
+        intensity=True, edges=True, texture=True, sigma_min=1, sigma_max=32
+    ),
+    "full": dict(
+        intensity=True,
+        edges=True,
+        texture=True,
+        sigma_min=0.5,
+        sigma_max=32,
+        num_sigma=13,
+    ),
+}
+
+
+def feature_sigmas(
+    sigma_min: float, sigma_max: float, num_sigma: Optional[int] = None
+) -> np.ndarray:
+    """
+    Return the Gaussian scales of `multiscale_basic_features`.
+    """
+    if num_sigma is None:
+        num_sigma = int(np.log2(sigma_max) - np.log2(sigma_min) + 1)
+    return np.logspace(
+        np.log2(sigma_min), np.log2(sigma_max), num=num_sigma, base=2, endpoint=True
+    )
+
+
+def feature_bank(name: str = "default", z_sigma: float = 0) -> functools.partial:
+    """
+    Return the features function of a feature bank.
+
+    Arguments:
+        name (str): The name of a bank in `FEATURE_BANKS`.
+        z_sigma (float): If positive, also compute true 3D features, with
+            this scale in Z (see `multiscale_stack_features`). These need
+            neighboring slices, so they can only be computed for stacks.
+
+    Returns:
+        functools.partial: The features function.
+
+    Raises:
+        ValueError: If the bank name is unknown.
+
+    """
+    if name not in FEATURE_BANKS:
+        raise ValueError(
+            f"Unknown feature bank {name}; must be one of {list(FEATURE_BANKS)}."
+        )
+    kwargs = dict(FEATURE_BANKS[name])
+    if z_sigma > 0:
+        kwargs["z_sigma"] = z_sigma
+    return functools.partial(multiscale_stack_features, **kwargs)
+
+
+def z_halo(features_fn) -> int:
+    """
+    Return the number of neighboring slices (on each side) that the
+    features of a slice depend on, for a features function.
+    """
+    if getattr(features_fn, "func", None) is not multiscale_stack_features:
+        return 0
+    z_sigma = features_fn.keywords.get("z_sigma", 0)
+    # Gaussians are truncated at 4 sigma, and the Z gradient looks one
+    # slice further:
+    return int(np.ceil(4 * z_sigma)) + 1 if z_sigma > 0 else 0
+
+
+def _sobel_xy(image: np.ndarray, xy_axes: Tuple[int, int]) -> np.ndarray:
+    """
+    The Sobel edge magnitude of each XY slice of an image, like
+    `skimage.filters.sobel` on each slice.
+    """
+    magnitude = np.zeros(image.shape, dtype=image.dtype)
+    x_axis, y_axis = xy_axes
+    for edge_axis, smooth_axis in ((x_axis, y_axis), (y_axis, x_axis)):
+        edges = ndi.convolve1d(image, _SOBEL_EDGE, axis=edge_axis, mode="reflect")
+        edges = ndi.convolve1d(edges, _SOBEL_SMOOTH, axis=smooth_axis, mode="reflect")
+        magnitude += edges * edges
+    np.sqrt(magnitude, out=magnitude)
+    magnitude /= np.sqrt(2, dtype=image.dtype)
+    return magnitude
+
+
+def _hessian_eigenvalues_xy(smoothed: np.ndarray, xy_axes: Tuple[int, int]):
+    """
+    The eigenvalues of the (finite-difference) Hessian of each XY slice, like
+    the texture features of `multiscale_basic_features`.
+    """
+    x_axis, y_axis = xy_axes
+    gradients = np.gradient(smoothed, axis=xy_axes)
+    hessian = [
+        np.gradient(gradients[0], axis=x_axis),
+        np.gradient(gradients[0], axis=y_axis),
+        np.gradient(gradients[1], axis=y_axis),
+    ]
+    return skimage.feature.hessian_matrix_eigvals(hessian)
+
+
+def multiscale_stack_features(
+    image: np.ndarray,
+    intensity: bool = True,
+    edges: bool = True,
+    texture: bool = True,
+    sigma_min: float = 0.5,
+    sigma_max: float = 16,
+    num_sigma: Optional[int] = None,
+    z_sigma: float = 0,
+    channels: Optional[Sequence[int]] = None,
+    workers: Optional[int] = None,
+) -> np.ndarray:
+    """
+    Compute `multiscale_basic_features` of every XY slice of a stack at once.
+
+    The features are the same as those of
+    `skimage.feature.multiscale_basic_features` on each 2D slice (up to
+    float32 rounding), but each filter is run once over the whole stack, with
+    its kernel only spanning X and Y, rather than once per slice.
+
+    If `z_sigma` is positive, each scale also gets two true 3D features: the
+    intensity smoothed in Z (by `z_sigma`) as well as in X and Y, and the
+    magnitude of its gradient in Z.
+
+    The channels of each scale are, in order: intensity, edges, the two
+    texture channels, and the two 3D channels (of those that are enabled).
+
+    Arguments:
+        image (np.ndarray): A 2D slice, or a stack of slices with Z last.
+        intensity (bool): Whether to include the smoothed intensities.
+        edges (bool): Whether to include the Sobel edge magnitudes.
+        texture (bool): Whether to include the Hessian eigenvalues.
+        sigma_min (float): The smallest Gaussian scale.
+        sigma_max (float): The largest Gaussian scale.
+        num_sigma (int): The number of scales. Defaults to one per octave.
+        z_sigma (float): The Z scale of the 3D features, or 0 for none.
+        channels (Sequence[int]): If given, only compute these channels (in
+            this order), e.g. the ones a pruned classifier uses.
+        workers (int): The number of threads to compute scales in parallel
+            with. Defaults to the number of cores.
+
+    Returns:
+        np.ndarray<f32>: The features, of shape `image.shape + (n_features,)`.
+
+    Raises:
+        ValueError: If no features are enabled, or if 3D features are asked
+            for a 2D slice.
+
+    """
+    if not any([intensity, edges, texture]):
+        raise ValueError(
+            "At least one of `intensity`, `edges` or `texture` must be True."
+        )
+    if z_sigma > 0 and image.ndim != 3:
+        raise ValueError("3D features (z_sigma > 0) need a stack of slices.")
+    image = img_as_float32(image)
+    if image.ndim == 3:
+        # Filter Z-first stacks, so every slice is contiguous in memory:
+        image = np.moveaxis(image, 2, 0)
+    image = np.ascontiguousarray(image)
+    xy_axes = (0, 1) if image.ndim == 2 else (1, 2)
+    # Smooth in X and Y only, so slices stay independent:
+    xy_only = [1.0 if axis in xy_axes else 0.0 for axis in range(image.ndim)]
+
+    sigmas = feature_sigmas(sigma_min, sigma_max, num_sigma)
+    kinds = (
+        ["intensity"] * intensity
+        + ["edges"] * edges
+        + ["texture0", "texture1"] * texture
+        + ["z_intensity", "z_gradient"] * (z_sigma > 0)
+    )
+    n_channels = len(kinds) * len(sigmas)
+    channels = list(range(n_channels)) if channels is None else list(channels)
+    if any(not 0 <= channel < n_channels for channel in channels):
+        raise ValueError(f"Channels must be in [0, {n_channels}); got {channels}.")
+    # The output position of each (scale, kind) that was asked for:
+    wanted = {}
+    for position, channel in enumerate(channels):
+        scale, kind = divmod(channel, len(kinds))
+        wanted.setdefault(scale, {}).setdefault(kinds[kind], []).append(position)
+    # Each feature is written straight into its channel of the output, so
+    # only one scale's intermediates are alive per thread:
+    features = np.empty(image.shape + (len(channels),), dtype=np.float32)
+
+    def _scale_features(index: int) -> None:
+        sigma = sigmas[index]
+        outputs = wanted[index]
+        smoothed = ndi.gaussian_filter(
+            image, [sigma * axis for axis in xy_only], mode="nearest", truncate=4.0
+        )
+        scale_features = {"intensity": smoothed}
+        if "edges" in outputs:
+            scale_features["edges"] = _sobel_xy(smoothed, xy_axes)
+        if "texture0" in outputs or "texture1" in outputs:
+            eigvals = _hessian_eigenvalues_xy(smoothed, xy_axes)
+            scale_features["texture0"], scale_features["texture1"] = eigvals
+        if "z_intensity" in outputs or "z_gradient" in outputs:
+            smoothed_3d = ndi.gaussian_filter1d(
+                smoothed, z_sigma, axis=0, mode="nearest", truncate=4.0
+            )
+            scale_features["z_intensity"] = smoothed_3d
+            if smoothed_3d.shape[0] > 1:
+                scale_features["z_gradient"] = np.abs(np.gradient(smoothed_3d, axis=0))
+            else:
+                scale_features["z_gradient"] = np.zeros_like(smoothed_3d)
+        for kind, positions in outputs.items():
+            for position in positions:
+                features[..., position] = scale_features[kind]
+
+    # The filters release the GIL, so scales can be computed in threads:
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(_scale_features, sorted(wanted)))
+    if features.ndim == 4:
+        # Back to XYZ order (as a view; moving Z back to the front is free):
+        features = np.moveaxis(features, 0, 2)
+    return features
+
+
+__all__ = [
+    "FEATURE_BANKS",
+    "feature_bank",
+    "multiscale_stack_features",
+    "feature_sigmas",
+    "z_halo",
+]
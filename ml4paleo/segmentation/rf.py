@@ -1,43 +1,84 @@
-import functools
-from typing import Callable, Optional
+from typing import Callable, List, Optional, Tuple
 import numpy as np
-import skimage
-import skimage.feature
 import joblib
 from sklearn.ensemble import RandomForestClassifier
 
-from .segmenter import Segmenter3D
+from .feature_cache import FeatureCache, describe_features_fn
+from .features import feature_bank, multiscale_stack_features, z_halo
+from .sampling import class_balanced_sample, stratified_sample
+from .segmenter import Segmenter3D, smallest_label_dtype
 
 
-_default_features_func = functools.partial(
-    skimage.feature.multiscale_basic_features,
-    intensity=True,
-    edges=True,
-    texture=True,
-    sigma_min=1,
-    sigma_max=32,
-)
+# The same features as skimage.feature.multiscale_basic_features, but they
+# can be computed for a whole stack of slices at once (see `_features`).
+_default_features_func = feature_bank("default")
 
-# one in every X negative voxels will be used for training; positives are kept
-# in full so sparse brush annotations still reach the classifier
+# When segmenting, slices are featurized and predicted in batches of about
+# this many bytes of features.
+_DEFAULT_BATCH_FEATURE_BYTES = 256 * 1024**2
+
+# one in every X negative voxels will be used for training (but at least as
+# many as positives); positives are kept in full (up to the per-class limit
+# below) so sparse brush annotations still reach the classifier
 _DEFAULT_TRAINING_SPARSITY = 500
 
+# At most this many voxels of each class of a slice are used for training
+# (spread out over the slice), which bounds the size of the training set.
+_DEFAULT_MAX_CLASS_SAMPLES = 50_000
+
+# Training samples are featurized in XY tiles of this size (plus the features'
+# halo), one at a time, so that featurizing a slice for training takes memory
+# for one tile's features (about 160 MB for the default features) rather than
+# the whole slice's. Smaller tiles featurize proportionally more halo.
+_DEFAULT_SAMPLE_TILE_SIZE = 1024
+
+# The number of voxels of each annotated slice that are set aside (with their
+# features, which are computed for training anyway) to evaluate the trained
+# classifier on, split evenly between the classes of the slice.
+_DEFAULT_EVALUATION_SAMPLES = 8192
+
 
 class RandomForest3DSegmenter(Segmenter3D):
     def __init__(
         self,
         rf_kwargs: Optional[dict] = None,
         features_fn: Callable = _default_features_func,
+        intensity_window: Optional[Tuple[float, float]] = None,
+        min_label_dtype=np.uint8,
+        batch_slices: Optional[int] = None,
+        feature_cache: Optional[FeatureCache] = None,
     ):
         """
         Initialize the segmentation algorithm.
 
         Arguments:
             rf_kwargs (dict): The keyword arguments to pass to the random forest.
+            features_fn (Callable): The features function, e.g. a feature bank
+                (see `feature_bank`). Defaults to the "default" bank.
+            intensity_window (Tuple[float, float]): A (low, high) intensity
+                window of the volume (e.g. from its precomputed intensity
+                statistics). If given, images are rescaled so that the window
+                maps onto [0, 1] before features are computed, so features
+                are comparable across volumes of different intensity ranges.
+                It is saved with the model.
+            min_label_dtype (np.dtype): The smallest dtype for segmentation
+                masks. Masks use the smallest unsigned dtype that holds all of
+                the classifier's classes, promoted to at least this one.
+                Defaults to np.uint8.
+            batch_slices (int): The number of slices to featurize and predict
+                at once when segmenting. Defaults to as many as fit in about
+                256 MB of features.
+            feature_cache (FeatureCache): A cache for the features of single
+                slices (as used for training and previews). Defaults to None
+                (no caching).
 
         """
         self.rf_kwargs = rf_kwargs or {}
         self.features_fn = features_fn or (lambda x: x)
+        self.intensity_window = intensity_window
+        self.min_label_dtype = np.dtype(min_label_dtype)
+        self.batch_slices = batch_slices
+        self.feature_cache = feature_cache
 
         estimators = self.rf_kwargs.pop("n_estimators", 50)
         max_depth = self.rf_kwargs.pop("max_depth", 12)
@@ -46,6 +87,20 @@ class RandomForest3DSegmenter(Segmenter3D):
         self._training_subsample = self.rf_kwargs.pop(
             "training_subsample", _DEFAULT_TRAINING_SPARSITY
         )
+        self._max_class_samples = self.rf_kwargs.pop(
+            "max_class_samples", _DEFAULT_MAX_CLASS_SAMPLES
+        )
+        self._sample_tile_size = self.rf_kwargs.pop(
+            "sample_tile_size", _DEFAULT_SAMPLE_TILE_SIZE
+        )
+        self._evaluation_samples = self.rf_kwargs.pop(
+            "evaluation_samples", _DEFAULT_EVALUATION_SAMPLES
+        )
+        # The evaluation samples of the last call to `fit`:
+        self.evaluation_samples: Optional[dict] = None
+        # The feature channels that the classifier was trained on, if it was
+        # pruned to a subset of them (see `prune_features`):
+        self.feature_channels: Optional[List[int]] = None
 
         self._clf = RandomForestClassifier(
             n_estimators=estimators,
@@ -62,17 +117,129 @@ class RandomForest3DSegmenter(Segmenter3D):
             volume (np.ndarray<any>): The volume to segment.
 
         Returns:
-            np.ndarray<u64>: The segmentation mask.
+            np.ndarray: The segmentation mask, of dtype `label_dtype`.
 
         """
-        # Extract features:
-        mask = np.zeros(volume.shape, dtype=np.uint64)
-
-        for z in range(volume.shape[2]):
-            mask[:, :, z] = self._segment_slice(volume[:, :, z])
+        mask = np.zeros(volume.shape, dtype=self.label_dtype)
+
+        # Featurize and predict a batch of slices at a time. The first batch
+        # is one slice, which tells us how large each slice's features are.
+        # 3D features also need `z_halo` neighboring slices on each side.
+        z, batch = 0, self.batch_slices or 1
+        while z < volume.shape[2]:
+            stop = min(volume.shape[2], z + batch)
+            low = max(0, z - self.z_halo)
+            high = min(volume.shape[2], stop + self.z_halo)
+            features = self._features(volume[:, :, low:high], self.feature_channels)
+            if low != z or high != stop:
+                features = features[:, :, z - low : stop - low]
+            mask[:, :, z:stop] = self._predict(features)
+            if self.batch_slices is None:
+                slice_bytes = max(1, features.nbytes // (stop - z))
+                batch = max(1, _DEFAULT_BATCH_FEATURE_BYTES // slice_bytes)
+            z = stop
 
         return mask
 
+    @property
+    def z_halo(self) -> int:
+        """
+        The number of neighboring slices (on each side) that the features of
+        a slice depend on; nonzero for 3D features.
+        """
+        return z_halo(self.features_fn)
+
+    @property
+    def label_dtype(self) -> np.dtype:
+        """
+        The smallest unsigned dtype that holds every class of the classifier
+        (and is at least `min_label_dtype`). Before the classifier is fit,
+        this is uint64.
+        """
+        classes = getattr(self._clf, "classes_", None)
+        if classes is None:
+            return np.dtype(np.uint64)
+        if classes.dtype.kind not in "biu" or classes.min() < 0:
+            raise ValueError(
+                f"Cannot store classes {classes} as labels; they must be "
+                "non-negative integers."
+            )
+        return smallest_label_dtype(int(classes.max()), self.min_label_dtype)
+
+    def _normalize(self, imgslice: np.ndarray) -> np.ndarray:
+        """
+        Rescale a slice by the intensity window, if there is one.
+        """
+        if self.intensity_window is None:
+            return imgslice
+        low, high = self.intensity_window
+        return (imgslice.astype(np.float32) - low) / max(high - low, 1e-12)
+
+    def _features(
+        self, image: np.ndarray, channels: Optional[List[int]] = None
+    ) -> np.ndarray:
+        """
+        Compute the (float32) features of a slice, or of a stack of slices.
+
+        Stack-aware feature functions (like the default one) are run on the
+        whole stack at once; others are run on each slice in turn. Features
+        of single slices are cached in the `feature_cache`, if there is one.
+
+        Arguments:
+            image (np.ndarray): A 2D slice, or a stack of slices with Z last.
+            channels (List[int]): If given, only these feature channels are
+                returned (and, for stack-aware feature functions, computed).
+
+        Returns:
+            np.ndarray<f32>: The features, of shape `image.shape + (n,)`.
+
+        """
+        if self.feature_cache is not None and image.ndim == 2:
+            key = FeatureCache.key(
+                image,
+                f"{describe_features_fn(self.features_fn)}"
+                f"window={self.intensity_window!r}"
+                + (f"channels={channels!r}" if channels is not None else ""),
+            )
+            return self.feature_cache.get_or_compute(
+                key, lambda: self._compute_features(image, channels)
+            )
+        return self._compute_features(image, channels)
+
+    def _compute_features(
+        self, image: np.ndarray, channels: Optional[List[int]] = None
+    ) -> np.ndarray:
+        image = self._normalize(image)
+        stack_aware = getattr(self.features_fn, "func", self.features_fn) is (
+            multiscale_stack_features
+        )
+        if stack_aware:
+            features = self.features_fn(image, channels=channels)
+        elif image.ndim == 2:
+            features = self.features_fn(image)
+        else:
+            features = np.stack(
+                [self.features_fn(image[:, :, z]) for z in range(image.shape[2])],
+                axis=2,
+            )
+        if channels is not None and not stack_aware:
+            features = features[..., channels]
+        return features.astype(np.float32, copy=False)
+
+    def _predict(self, features: np.ndarray) -> np.ndarray:
+        """
+        Predict the labels of featurized pixels, in a single classifier call.
+        """
+        if features.ndim == 4:
+            # Stack features are laid out Z-first in memory (see
+            # `multiscale_stack_features`), so flatten them in that order to
+            # avoid a copy, and move Z back to the end afterwards.
+            z_first = np.moveaxis(features, 2, 0)
+            labels = self._clf.predict(z_first.reshape(-1, features.shape[-1]))
+            return np.moveaxis(labels.reshape(z_first.shape[:-1]), 0, 2)
+        labels = self._clf.predict(features.reshape(-1, features.shape[-1]))
+        return labels.reshape(features.shape[:-1])
+
     def _segment_slice(self, imgslice: np.ndarray) -> np.ndarray:
         """
         Segment the given slice.
@@ -84,13 +251,7 @@ class RandomForest3DSegmenter(Segmenter3D):
             np.ndarray<u64>: The segmentation mask.
 
         """
-        # Extract features:
-        features = self.features_fn(imgslice)
-
-        # Segment the slice:
-        mask = self._clf.predict(features.reshape(-1, features.shape[-1]))
-        mask = mask.reshape(features.shape[:2])
-        return mask
+        return self._predict(self._features(imgslice, self.feature_channels))
 
     def fit(self, volume: np.ndarray, mask: np.ndarray) -> None:
         """
@@ -101,66 +262,279 @@ class RandomForest3DSegmenter(Segmenter3D):
             mask (np.ndarray<u64>): The segmentation mask.
 
         """
-        # Extract features:
-        # features = self.features_fn(volume)
+        samples = self.training_samples(volume, mask)
+        self.fit_samples(samples["features"], samples["labels"])
+        self.evaluation_samples = {
+            key: value
+            for key, value in samples.items()
+            if key.startswith("evaluation_")
+        }
+
+    def training_parameters(self) -> str:
+        """
+        Return a description of how training samples are picked and
+        featurized, e.g. to key stored samples by (see `TrainingSampleStore`).
+        """
+        return (
+            f"{describe_features_fn(self.features_fn)}"
+            f"window={self.intensity_window!r}"
+            f"subsample={self._training_subsample!r}"
+            f"max_class_samples={self._max_class_samples!r}"
+            f"evaluation={self._evaluation_samples!r}"
+        )
 
-        # Train the classifier:
-        # self._clf.fit(features.reshape(-1, features.shape[-1]), mask.reshape(-1))
+    def training_samples(self, volume: np.ndarray, mask: np.ndarray) -> dict:
+        """
+        Pick and featurize the training samples of an annotated volume.
 
-        # Extract features:
-        features = []
-        labels = []
+        Arguments:
+            volume (np.ndarray<any>): The annotated volume.
+            mask (np.ndarray<u64>): Its segmentation mask.
+
+        Returns:
+            dict: The "features" and "labels" of the voxels sampled for
+                training, and the "evaluation_features", "evaluation_labels"
+                and "evaluation_weights" of the voxels sampled for evaluation
+                (see `_fit_slice`).
 
-        for z in range(volume.shape[2]):
-            f, l = self._fit_slice(volume[:, :, z], mask[:, :, z])
-            features.append(f)
-            labels.append(l)
+        """
+        slices = []
+        for i in range(volume.shape[2]):
+            if self.z_halo:
+                # 3D features need the neighboring slices too:
+                low = max(0, i - self.z_halo)
+                high = min(volume.shape[2], i + self.z_halo + 1)
+                slices.append(
+                    self._fit_slice(volume[:, :, low:high], mask[:, :, i], i - low)
+                )
+            else:
+                slices.append(self._fit_slice(volume[:, :, i], mask[:, :, i]))
+        return {
+            key: np.concatenate([samples[key] for samples in slices], axis=0)
+            for key in slices[0]
+        }
+
+    def fit_samples(self, features: np.ndarray, labels: np.ndarray) -> None:
+        """
+        Train a new classifier on featurized training samples.
 
-        features = np.concatenate(features, axis=0)
-        labels = np.concatenate(labels, axis=0)
+        Arguments:
+            features (np.ndarray): The features of the samples, one per row.
+            labels (np.ndarray): The labels of the samples.
 
-        # Train the classifier:
+        """
+        self.feature_channels = None
+        self._clf.set_params(warm_start=False)
         self._clf.fit(features, labels)
 
-    def _fit_slice(self, imgslice: np.ndarray, mask: np.ndarray) -> tuple:
+    def grow(self, features: np.ndarray, labels: np.ndarray, n_estimators: int) -> None:
+        """
+        Add trees to the trained classifier, keeping the existing ones.
+
+        The new trees are fit (with warm-start) on the given samples, which
+        should include the samples that the existing trees were fit on, so
+        that the forest isn't biased towards the newest annotations. If the
+        classifier was pruned, the new trees use the same feature channels.
+
+        Arguments:
+            features (np.ndarray): The features of the samples, one per row.
+            labels (np.ndarray): The labels of the samples.
+            n_estimators (int): The number of trees to add.
+
+        Raises:
+            ValueError: If the classifier hasn't been trained yet, or if the
+                samples have different classes than it was trained on (in
+                which case it has to be retrained from scratch).
+
         """
-        Train the segmentation algorithm on the given slice.
+        classes = getattr(self._clf, "classes_", None)
+        if classes is None:
+            raise ValueError("Cannot grow a classifier that hasn't been trained.")
+        if not np.array_equal(np.unique(labels), classes):
+            raise ValueError(
+                f"Cannot grow a classifier trained on classes {classes} with "
+                f"samples of classes {np.unique(labels)}."
+            )
+        self._clf.set_params(
+            warm_start=True, n_estimators=self._clf.n_estimators + n_estimators
+        )
+        self._clf.fit(self._select_channels(features), labels)
+        self._clf.set_params(warm_start=False)
+
+    def prune_features(
+        self, features: np.ndarray, labels: np.ndarray, importance: float = 0.99
+    ) -> List[int]:
+        """
+        Retrain the classifier on only its most important feature channels.
+
+        The channels are ranked by the (impurity-based) importances of the
+        trained classifier, and the fewest channels that together make up
+        `importance` of the total are kept (channels that no tree splits on
+        have no importance, so they are always dropped). The classifier is
+        then retrained on those channels, and only they are computed when
+        segmenting.
 
         Arguments:
-            slice (np.ndarray<any>): The slice to segment.
-            mask (np.ndarray<u64>): The segmentation mask.
+            features (np.ndarray): The features of the training samples, with
+                every channel (as returned by `training_samples`).
+            labels (np.ndarray): The labels of the samples.
+            importance (float): The fraction of the total importance to keep.
 
         Returns:
-            tuple: The features and labels.
+            List[int]: The kept channels.
+
+        Raises:
+            ValueError: If the classifier hasn't been trained yet, or was
+                already pruned.
 
         """
-        # Extract features:
-        features = self.features_fn(imgslice)
+        if getattr(self._clf, "classes_", None) is None:
+            raise ValueError("Cannot prune a classifier that hasn't been trained.")
+        if self.feature_channels is not None:
+            raise ValueError("The classifier was already pruned.")
+        importances = self._clf.feature_importances_
+        order = np.argsort(importances)[::-1]
+        cumulative = np.cumsum(importances[order])
+        count = int(np.searchsorted(cumulative, importance * cumulative[-1])) + 1
+        channels = sorted(
+            int(channel) for channel in order[:count] if importances[channel] > 0
+        )
+        if len(channels) < features.shape[1]:
+            self._clf.fit(features[:, channels], labels)
+            self.feature_channels = channels
+        return channels
 
-        flat_features = features.reshape(-1, features.shape[-1])
-        flat_mask = mask.reshape(-1)
+    def _select_channels(self, features: np.ndarray) -> np.ndarray:
+        """
+        Select the channels of full feature rows that the classifier uses.
+        """
+        if self.feature_channels is None:
+            return features
+        return features[:, self.feature_channels]
+
+    def predict_samples(self, features: np.ndarray) -> np.ndarray:
+        """
+        Predict the labels of featurized samples (e.g. evaluation samples).
+
+        Arguments:
+            features (np.ndarray): The features of the samples, one per row.
+
+        Returns:
+            np.ndarray: The predicted labels.
 
-        positive_mask = flat_mask != 0
-        negative_mask = ~positive_mask
+        """
+        return self._clf.predict(self._select_channels(features))
 
-        positive_features = flat_features[positive_mask]
-        positive_labels = flat_mask[positive_mask]
+    def _feature_halo(self) -> Optional[int]:
+        """
+        The distance (in pixels) from which a pixel's features are affected
+        by the image, or None if it isn't known for the features function.
+        """
+        if getattr(self.features_fn, "func", None) is not multiscale_stack_features:
+            return None
+        sigma_max = self.features_fn.keywords.get("sigma_max", 16)
+        # Gaussians are truncated at 4 sigma, and the edge and texture
+        # filters look two more pixels out:
+        return int(np.ceil(4 * sigma_max)) + 2
+
+    def _sample_features(
+        self, image: np.ndarray, indices: np.ndarray, z: Optional[int] = None
+    ) -> np.ndarray:
+        """
+        Compute the features of some pixels of a slice.
 
-        negative_features = flat_features[negative_mask]
-        negative_labels = flat_mask[negative_mask]
-        if self._training_subsample > 1:
-            negative_features = negative_features[:: self._training_subsample]
-            negative_labels = negative_labels[:: self._training_subsample]
+        The slice is featurized in tiles of `sample_tile_size` (padded by the
+        features' halo, so the features are the same as those of the whole
+        slice), one at a time, and only tiles that contain pixels are
+        featurized. Peak memory is bounded by the features of one tile, not
+        of the whole slice. If the halo of the features function isn't known,
+        the whole slice is featurized at once.
 
-        if positive_features.size == 0:
-            return negative_features, negative_labels
-        if negative_features.size == 0:
-            return positive_features, positive_labels
+        Arguments:
+            image (np.ndarray): The slice, or a stack of slices around it.
+            indices (np.ndarray): The flat (XY) indices of the pixels.
+            z (int): The index of the slice in the stack, if `image` is one.
 
-        features = np.concatenate([positive_features, negative_features], axis=0)
-        mask = np.concatenate([positive_labels, negative_labels], axis=0)
+        Returns:
+            np.ndarray<f32>: The features (of every channel), one row per
+                pixel.
 
-        return features, mask
+        """
+        shape = image.shape[:2]
+        halo = self._feature_halo()
+        tile = self._sample_tile_size
+        if halo is None:
+            halo, tile = 0, max(shape)
+        if len(indices) == 0:
+            # Featurize a tiny crop, just to get the number of channels:
+            image, indices = image[:3, :3], np.zeros(1, dtype=np.int64)
+            return self._sample_features(image, indices, z)[:0]
+
+        coords = np.unravel_index(indices, shape)
+        tiles_y = -(-shape[1] // tile)
+        tile_ids = (coords[0] // tile) * tiles_y + coords[1] // tile
+        order = np.argsort(tile_ids, kind="stable")
+        tile_ids, starts = np.unique(tile_ids[order], return_index=True)
+        stops = np.append(starts[1:], len(order))
+
+        features = None
+        for tile_id, start, stop in zip(tile_ids, starts, stops):
+            rows = order[start:stop]
+            tile_x, tile_y = divmod(int(tile_id), tiles_y)
+            crop = tuple(
+                slice(max(0, index * tile - halo), min(size, (index + 1) * tile + halo))
+                for index, size in zip((tile_x, tile_y), shape)
+            )
+            # Training samples are stored (see `TrainingSampleStore`), so their
+            # features bypass the feature cache, which is for repeated previews:
+            tile_features = self._compute_features(image[crop])
+            if z is not None:
+                tile_features = tile_features[:, :, z]
+            values = tile_features[
+                coords[0][rows] - crop[0].start, coords[1][rows] - crop[1].start
+            ]
+            if features is None:
+                features = np.empty((len(indices), values.shape[-1]), dtype=np.float32)
+            features[rows] = values
+            del tile_features
+        return features
+
+    def _fit_slice(
+        self, imgslice: np.ndarray, mask: np.ndarray, z: Optional[int] = None
+    ) -> dict:
+        """
+        Pick and featurize the training and evaluation samples of a slice.
+
+        The voxels are picked first (see `class_balanced_sample` and
+        `stratified_sample`), and only their neighborhood is featurized.
+
+        Arguments:
+            slice (np.ndarray<any>): The slice to segment, or a stack of
+                slices around it (for 3D features).
+            mask (np.ndarray<u64>): The segmentation mask of the slice.
+            z (int): The index of the slice in the stack, if it is one.
+
+        Returns:
+            dict: The samples (see `training_samples`).
+
+        """
+        training_indices = class_balanced_sample(
+            mask, self._max_class_samples, self._training_subsample
+        )
+        evaluation_indices, evaluation_weights = stratified_sample(
+            mask, self._evaluation_samples
+        )
+        features = self._sample_features(
+            imgslice, np.concatenate([training_indices, evaluation_indices]), z
+        )
+        flat_mask = mask.reshape(-1)
+        return {
+            "features": features[: len(training_indices)],
+            "labels": flat_mask[training_indices],
+            "evaluation_features": features[len(training_indices) :],
+            "evaluation_labels": flat_mask[evaluation_indices],
+            "evaluation_weights": evaluation_weights,
+        }
 
     def save(self, path: str) -> None:
         """
@@ -170,7 +544,15 @@ class RandomForest3DSegmenter(Segmenter3D):
             path (str): The path to save the segmentation algorithm to.
 
         """
-        joblib.dump(self._clf, path)
+        joblib.dump(
+            {
+                "classifier": self._clf,
+                "intensity_window": self.intensity_window,
+                "feature_channels": self.feature_channels,
+                "features_fn": self.features_fn,
+            },
+            path,
+        )
 
     def load(self, path: str) -> None:
         """
@@ -180,4 +562,15 @@ class RandomForest3DSegmenter(Segmenter3D):
             path (str): The path to load the segmentation algorithm from.
 
         """
-        self._clf = joblib.load(path)
+        saved = joblib.load(path)
+        if isinstance(saved, dict):
+            self._clf = saved["classifier"]
+            self.intensity_window = saved.get("intensity_window")
+            self.feature_channels = saved.get("feature_channels")
+            # Models saved before feature banks used the default features:
+            self.features_fn = saved.get("features_fn", _default_features_func)
+        else:
+            # Models saved before intensity windows were a bare classifier.
+            self._clf = saved
+            self.intensity_window = None
+            self.feature_channels = None
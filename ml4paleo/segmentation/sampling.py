@@ -0,0 +1,155 @@
+from typing import Optional, Tuple
+
+import numpy as np
+
+
+def spread_choice(
+    indices: np.ndarray,
+    shape: Tuple[int, ...],
+    count: int,
+    rng: np.random.Generator,
+) -> np.ndarray:
+    """
+    Choose `count` of the flat `indices` into an array, spread out in space.
+
+    The bounding box of the indices is divided into about `count` equal
+    cells, and voxels are picked from the cells in turn (at random within
+    each cell), so that every part of the region is sampled, rather than
+    the chosen voxels clumping together like a plain random choice can.
+
+    Arguments:
+        indices (np.ndarray): Flat indices into an array of `shape`.
+        shape (Tuple[int, ...]): The shape of the array.
+        count (int): The number of indices to choose.
+        rng (np.random.Generator): The random number generator.
+
+    Returns:
+        np.ndarray: The chosen indices, sorted.
+
+    """
+    if count >= len(indices):
+        return np.sort(indices)
+    coords = np.unravel_index(indices, shape)
+    low = [int(c.min()) for c in coords]
+    extent = [int(c.max()) - start + 1 for c, start in zip(coords, low)]
+    cell_size = max(1, int((np.prod(extent) / count) ** (1 / len(shape))))
+    cells = np.zeros(len(indices), dtype=np.int64)
+    for c, start, size in zip(coords, low, extent):
+        cells *= size // cell_size + 1
+        cells += (c - start) // cell_size
+    del coords
+
+    # Visit the voxels cell by cell, in a random order within each cell:
+    position_type = np.int32 if len(indices) < 2**31 else np.int64
+    order = rng.permutation(len(indices)).astype(position_type)
+    order = order[np.argsort(cells[order], kind="stable")]
+    cells = cells[order]
+    starts = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])
+    del cells
+    # The rank of each voxel within its cell; taking voxels by rank takes one
+    # from every cell before a second from any:
+    rank = np.arange(len(order), dtype=position_type)
+    rank -= np.repeat(starts, np.diff(np.r_[starts, len(order)])).astype(position_type)
+    last = int(np.searchsorted(np.cumsum(np.bincount(rank)), count))
+    chosen = order[rank < last]
+    if len(chosen) < count:
+        chosen = np.concatenate(
+            [
+                chosen,
+                rng.choice(order[rank == last], count - len(chosen), replace=False),
+            ]
+        )
+    return np.sort(indices[chosen])
+
+
+def class_balanced_sample(
+    mask: np.ndarray,
+    max_per_class: int,
+    background_subsample: int = 1,
+    rng: Optional[np.random.Generator] = None,
+) -> np.ndarray:
+    """
+    Pick the voxels of an annotation mask to train on.
+
+    Every labeled (nonzero) class keeps up to `max_per_class` voxels, so
+    that sparse brush annotations reach the classifier in full. Background
+    (zero) voxels are subsampled to one in `background_subsample`, but at
+    least as many as all of the labeled voxels (so that the classes stay
+    balanced), and at most `max_per_class`. Voxels are spread out in space
+    within each class (see `spread_choice`).
+
+    Arguments:
+        mask (np.ndarray): The annotation mask.
+        max_per_class (int): The most voxels to pick of any class.
+        background_subsample (int): Pick one in this many background voxels.
+        rng (np.random.Generator): The random number generator. Defaults to
+            a fixed seed, so the same mask always gives the same sample.
+
+    Returns:
+        np.ndarray: The flat indices of the picked voxels, sorted.
+
+    """
+    rng = rng or np.random.default_rng(0)
+    flat_mask = mask.reshape(-1)
+    picked = []
+    labeled_count = 0
+    background = None
+    for label in np.unique(flat_mask):
+        indices = np.flatnonzero(flat_mask == label)
+        if label == 0:
+            background = indices
+            continue
+        chosen = spread_choice(indices, mask.shape, max_per_class, rng)
+        labeled_count += len(chosen)
+        picked.append(chosen)
+    if background is not None:
+        count = -(-len(background) // max(1, background_subsample))
+        count = min(max(count, labeled_count), max_per_class)
+        picked.append(spread_choice(background, mask.shape, count, rng))
+    return np.sort(np.concatenate(picked)) if picked else np.zeros(0, np.int64)
+
+
+def stratified_sample(
+    mask: np.ndarray,
+    count: int,
+    rng: Optional[np.random.Generator] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Pick a weighted sample of the voxels of a mask, e.g. to evaluate on.
+
+    The voxels of each class are sampled evenly, and weighted by how many
+    voxels of that class each one stands for, so that weighted statistics of
+    the sample estimate those of the whole mask. (Within a class, voxels are
+    picked uniformly at random, not spread out like `spread_choice` does,
+    which would favor sparse regions and bias the estimates.)
+
+    Arguments:
+        mask (np.ndarray): The annotation mask.
+        count (int): The total number of voxels to pick, split evenly between
+            the classes.
+        rng (np.random.Generator): The random number generator. Defaults to
+            a fixed seed.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The flat indices of the picked voxels,
+            and their (float32) weights.
+
+    """
+    rng = rng or np.random.default_rng(0)
+    flat_mask = mask.reshape(-1)
+    classes = np.unique(flat_mask)
+    per_class = max(1, count // max(1, len(classes)))
+    indices, weights = [], []
+    for label in classes:
+        class_indices = np.flatnonzero(flat_mask == label)
+        chosen = class_indices
+        if len(class_indices) > per_class:
+            chosen = np.sort(rng.choice(class_indices, per_class, replace=False))
+        indices.append(chosen)
+        weights.append(np.full(len(chosen), len(class_indices) / len(chosen)))
+    if not indices:
+        return np.zeros(0, np.int64), np.zeros(0, np.float32)
+    return np.concatenate(indices), np.concatenate(weights).astype(np.float32)
+
+
+__all__ = ["spread_choice", "class_balanced_sample", "stratified_sample"]
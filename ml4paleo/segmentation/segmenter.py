@@ -1,6 +1,36 @@
 import abc
 import numpy as np
 
+# The label dtypes that segmentations are stored in, smallest first.
+LABEL_DTYPES = (np.uint8, np.uint16, np.uint32, np.uint64)
+
+
+def smallest_label_dtype(max_label: int, minimum_dtype=np.uint8) -> np.dtype:
+    """
+    Return the smallest unsigned dtype that can hold labels up to a value.
+
+    Arguments:
+        max_label (int): The largest label value.
+        minimum_dtype (np.dtype): The smallest dtype to return, e.g. to
+            promote the labels to a wider dtype than they need. Defaults to
+            np.uint8.
+
+    Returns:
+        np.dtype: The dtype.
+
+    Raises:
+        ValueError: If the label value is negative or too large for uint64.
+
+    """
+    if max_label < 0:
+        raise ValueError(f"Labels must be non-negative, but got {max_label}.")
+    for dtype in LABEL_DTYPES:
+        if np.dtype(dtype).itemsize < np.dtype(minimum_dtype).itemsize:
+            continue
+        if max_label <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise ValueError(f"Label {max_label} does not fit in a uint64.")
+
 
 class Segmenter3D(abc.ABC):
     """
@@ -10,6 +40,16 @@ class Segmenter3D(abc.ABC):
 
     """
 
+    @property
+    def label_dtype(self) -> np.dtype:
+        """
+        The dtype of the masks that `segment` returns.
+
+        Subclasses that know their set of labels should return the smallest
+        dtype that holds them (see `smallest_label_dtype`).
+        """
+        return np.dtype(np.uint64)
+
     @abc.abstractmethod
     def segment(self, volume: np.ndarray) -> np.ndarray:
         """
@@ -19,7 +59,7 @@ class Segmenter3D(abc.ABC):
             volume (np.ndarray<any>): The volume to segment.
 
         Returns:
-            np.ndarray<u64>: The segmentation mask.
+            np.ndarray: The segmentation mask, of dtype `label_dtype`.
 
         """
         ...
@@ -0,0 +1,123 @@
+import hashlib
+import os
+import pathlib
+import tempfile
+from typing import Dict, Iterable, Optional, Union
+
+import numpy as np
+
+
+class TrainingSampleStore:
+    """
+    A directory of the sampled training features and labels of annotations.
+
+    Each annotated slice's training samples (named arrays, like the features
+    and labels of the voxels that were picked for training and evaluation)
+    are stored under a key derived from
+    the slice, its mask, and the sampling and feature parameters (see `key`).
+    Retraining after adding an annotation then only needs to featurize and
+    sample the new one, and an edited annotation simply gets a new key.
+    """
+
+    def __init__(self, directory: Union[str, pathlib.Path]):
+        """
+        Open (or create) a TrainingSampleStore.
+
+        Arguments:
+            directory (pathlib.Path): The directory of the store, e.g. one per
+                job.
+
+        """
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(imgslice: np.ndarray, mask: np.ndarray, parameters: str) -> str:
+        """
+        Return the key of a slice's training samples.
+
+        Arguments:
+            imgslice (np.ndarray): The annotated slice.
+            mask (np.ndarray): Its annotation mask.
+            parameters (str): A description of how the samples were picked
+                and featurized.
+
+        Returns:
+            str: The key.
+
+        """
+        digest = hashlib.blake2b(digest_size=20)
+        for array in (imgslice, mask):
+            digest.update(f"{array.shape}{array.dtype.str}".encode())
+            digest.update(np.ascontiguousarray(array).data)
+        digest.update(parameters.encode())
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> pathlib.Path:
+        return self.directory / f"{key}.npz"
+
+    def __contains__(self, key: str) -> bool:
+        return self._path(key).exists()
+
+    def get(self, key: str) -> Optional[Dict[str, np.ndarray]]:
+        """
+        Return the samples stored under a key, or None.
+        """
+        try:
+            with np.load(self._path(key)) as saved:
+                return {name: saved[name] for name in saved.files}
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key: str, samples: Dict[str, np.ndarray]) -> None:
+        """
+        Store the samples (named arrays) of a slice under a key.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, **samples)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            pathlib.Path(tmp_path).unlink(missing_ok=True)
+            raise
+
+    def load(self, keys: Iterable[str]) -> Dict[str, np.ndarray]:
+        """
+        Return the concatenated samples of several keys.
+
+        Raises:
+            KeyError: If a key is not in the store, or if its samples don't
+                have the same arrays as the others.
+
+        """
+        stored = []
+        for key in keys:
+            samples = self.get(key)
+            if samples is None:
+                raise KeyError(f"No training samples stored for {key}.")
+            stored.append(samples)
+        return {
+            name: np.concatenate([samples[name] for samples in stored], axis=0)
+            for name in stored[0]
+        }
+
+    def prune(self, keep: Iterable[str]) -> int:
+        """
+        Delete the stored samples of every key that is not in `keep` (e.g. of
+        annotations that were deleted or edited).
+
+        Returns:
+            int: The number of deleted entries.
+
+        """
+        keep = set(keep)
+        deleted = 0
+        for path in self.directory.glob("*.npz"):
+            if path.stem not in keep:
+                path.unlink(missing_ok=True)
+                deleted += 1
+        return deleted
+
+
+__all__ = ["TrainingSampleStore"]
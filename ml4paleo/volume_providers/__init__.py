@@ -11,10 +11,12 @@ from .volume_provider import VolumeProvider
 from .numpyvp import NumpyVolumeProvider
 from .imagevp import ImageStackVolumeProvider
 from .zarrvp import ZarrVolumeProvider
+from .zipvp import ZipImageStackVolumeProvider
 
 __all__ = [
     "VolumeProvider",
     "NumpyVolumeProvider",
     "ImageStackVolumeProvider",
     "ZarrVolumeProvider",
+    "ZipImageStackVolumeProvider",
 ]
@@ -0,0 +1,149 @@
+import threading
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+import numpy as np
+
+
+class SliceCache:
+    """
+    A thread-safe LRU cache of numpy arrays, bounded by total size in bytes.
+
+    Volume providers use this to avoid re-decoding the same 2D slices from
+    disk when overlapping subvolumes are requested (e.g. annotation sampling,
+    conversion, and export all reading the same stack). Entries are evicted
+    in least-recently-used order until the total number of cached bytes fits
+    within `max_bytes`.
+
+    Cached arrays are marked read-only, so callers that want to modify a
+    cached slice must copy it first.
+    """
+
+    def __init__(self, max_bytes: int):
+        """
+        Create a new SliceCache.
+
+        Arguments:
+            max_bytes (int): The maximum total size of the cached arrays, in
+                bytes. If 0, nothing will be cached.
+
+        Raises:
+            ValueError: If max_bytes is negative.
+
+        """
+        if max_bytes < 0:
+            raise ValueError(f"max_bytes must be non-negative, but got {max_bytes}.")
+        self.max_bytes = int(max_bytes)
+        self._entries: "OrderedDict[Hashable, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __getstate__(self) -> dict:
+        # Locks can't be pickled, and there's no point shipping cached slices
+        # to another process, so a pickled cache arrives empty.
+        state = self.__dict__.copy()
+        del state["_lock"]
+        state["_entries"] = OrderedDict()
+        state["_current_bytes"] = 0
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[np.ndarray]:
+        """
+        Return the cached array for `key`, or None if it is not cached.
+
+        Arguments:
+            key (Hashable): The cache key.
+
+        Returns:
+            np.ndarray: The cached (read-only) array.
+            None: If the key is not in the cache.
+
+        """
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: np.ndarray) -> None:
+        """
+        Insert an array into the cache, evicting old entries if necessary.
+
+        Arrays larger than the entire cache budget are not stored. The cache
+        keeps a read-only view of the array (the caller's array itself stays
+        writeable), so it shares the array's memory: don't modify the array
+        after putting it in the cache.
+
+        Arguments:
+            key (Hashable): The cache key.
+            value (np.ndarray): The array to store.
+
+        """
+        nbytes = int(value.nbytes)
+        if nbytes > self.max_bytes:
+            return
+        value = value.view()
+        value.flags.writeable = False
+        with self._lock:
+            existing = self._entries.pop(key, None)
+            if existing is not None:
+                self._current_bytes -= existing.nbytes
+            self._entries[key] = value
+            self._current_bytes += nbytes
+            while self._current_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._current_bytes -= evicted.nbytes
+                self.evictions += 1
+
+    def clear(self) -> None:
+        """
+        Remove all entries from the cache. Counters are not reset.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._current_bytes = 0
+
+    @property
+    def current_bytes(self) -> int:
+        """
+        The total size of the currently cached arrays, in bytes.
+        """
+        return self._current_bytes
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def stats(self) -> dict:
+        """
+        Return a snapshot of the cache counters.
+
+        Returns:
+            dict: The hit, miss, and eviction counts, plus the current number
+                of entries and bytes, and the byte budget.
+
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "current_bytes": self._current_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+__all__ = ["SliceCache"]
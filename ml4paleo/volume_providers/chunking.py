@@ -0,0 +1,245 @@
+import math
+from typing import Callable, Optional, Sequence, Tuple
+
+import numpy as np
+import psutil
+
+# Storage chunks are kept between these sizes (in bytes), starting from the
+# preferred chunk shape: large enough that a volume isn't split into a huge
+# number of tiny files, small enough that reading one chunk is cheap.
+MIN_STORAGE_CHUNK_BYTES = 8 * 1024**2
+MAX_STORAGE_CHUNK_BYTES = 32 * 1024**2
+# Storage chunks are grown (up to the maximum size) to stay under this many
+# chunks per volume.
+MAX_STORAGE_CHUNK_COUNT = 100_000
+
+# Rough peak memory per voxel of a block being converted: the block as read,
+# the cast/transformed copy, and the pooled pyramid levels.
+CONVERSION_BYTES_PER_VOXEL_FACTOR = 3
+
+# Random forest segmentation computes features for batches of slices: the
+# default multiscale features are 24 float32 channels per pixel, plus about
+# as much again in filter temporaries. Batches hold at most about
+# SEGMENTATION_FEATURE_BATCH_BYTES of features (and at least one slice).
+SEGMENTATION_FEATURE_BYTES_PER_PIXEL = 24 * 4 * 2
+SEGMENTATION_FEATURE_BATCH_BYTES = 256 * 1024**2 * 2
+# Per voxel of a segmentation chunk: the normalized float copy of the input,
+# and the label output (uint8 or uint16 for a handful of classes).
+SEGMENTATION_BYTES_PER_VOXEL = 8 + 2
+
+# Per voxel of a meshing chunk: the labels, the per-object masks, and the
+# marching cubes workspace.
+MESHING_BYTES_PER_VOXEL = 8 + 1 + 16
+
+DEFAULT_STORAGE_CHUNK_SIZE = (512, 512, 64)
+DEFAULT_SEGMENTATION_CHUNK_SIZE = (256, 256, 256)
+DEFAULT_MESHING_CHUNK_SIZE = (512, 512, 512)
+
+
+def default_memory_budget(fraction: float = 0.5) -> int:
+    """
+    Return a fraction of the currently available memory, in bytes.
+    """
+    return int(psutil.virtual_memory().available * fraction)
+
+
+def _fit_chunk(
+    shape: Sequence[int],
+    preferred: Sequence[int],
+    cost_fn: Callable[[Sequence[int]], float],
+    min_cost: float,
+    max_cost: float,
+    min_axis: int = 1,
+) -> Tuple[int, ...]:
+    """
+    Fit a chunk shape to a volume, starting from a preferred shape.
+
+    The preferred shape is first clipped to the volume. While the chunk costs
+    more than `max_cost`, its largest axis is halved; then, while it costs
+    less than `min_cost`, its smallest axis that is not yet as large as the
+    volume is doubled (as long as that keeps it under `max_cost`). Thin axes
+    are therefore compensated for by the other axes, and huge axes are cut
+    down first.
+    """
+    chunk = [max(1, min(int(p), int(d))) for p, d in zip(preferred, shape)]
+
+    while cost_fn(chunk) > max_cost:
+        shrinkable = [i for i in range(len(chunk)) if chunk[i] > min_axis]
+        if not shrinkable:
+            break
+        axis = max(shrinkable, key=lambda i: chunk[i])
+        chunk[axis] = max(min_axis, math.ceil(chunk[axis] / 2))
+
+    while cost_fn(chunk) < min_cost:
+        growable = [i for i in range(len(chunk)) if chunk[i] < shape[i]]
+        if not growable:
+            break
+        axis = min(growable, key=lambda i: chunk[i])
+        grown = list(chunk)
+        grown[axis] = min(int(shape[axis]), chunk[axis] * 2)
+        if cost_fn(grown) > max_cost:
+            break
+        chunk = grown
+
+    return tuple(chunk)
+
+
+def _chunk_count(shape: Sequence[int], chunk: Sequence[int]) -> int:
+    return int(np.prod([math.ceil(d / c) for d, c in zip(shape, chunk)]))
+
+
+def plan_chunk_shapes(
+    shape: Sequence[int],
+    dtype: np.dtype,
+    conversion_workers: int = 1,
+    segmentation_workers: int = 1,
+    memory_budget: Optional[int] = None,
+    multiscale_levels: int = 0,
+    storage_chunk_size: Sequence[int] = DEFAULT_STORAGE_CHUNK_SIZE,
+    segmentation_chunk_size: Sequence[int] = DEFAULT_SEGMENTATION_CHUNK_SIZE,
+    meshing_chunk_size: Sequence[int] = DEFAULT_MESHING_CHUNK_SIZE,
+) -> dict:
+    """
+    Pick storage and compute chunk shapes for a volume.
+
+    The given chunk sizes are the preferred shapes, which are adapted to the
+    volume and to the machine:
+
+    * Storage (zarr) chunks are kept between `MIN_STORAGE_CHUNK_BYTES` and
+      `MAX_STORAGE_CHUNK_BYTES`, so e.g. a thin slab gets wider chunks rather
+      than thousands of tiny ones. Conversion blocks are capped so that all
+      conversion workers together fit in the memory budget, so that very wide
+      (huge-XY) slices are converted in tiles rather than in full slabs.
+    * Segmentation chunks are the largest (up to the preferred size, or wider
+      for thin volumes) that all segmentation workers can hold in memory
+      at once, including the per-slice features.
+    * Meshing chunks run one at a time, and get the whole budget.
+
+    Arguments:
+        shape (Sequence[int]): The (X, Y, Z) shape of the volume.
+        dtype (np.dtype): The dtype of the volume.
+        conversion_workers (int): The number of parallel conversion workers.
+        segmentation_workers (int): The number of parallel segmentation
+            workers.
+        memory_budget (int): The total memory available to the workers, in
+            bytes. Defaults to half of the currently available memory.
+        multiscale_levels (int): The number of pyramid levels that will be
+            written; storage chunks are kept at least 2 ** levels wide.
+        storage_chunk_size (Sequence[int]): The preferred storage chunk shape.
+        segmentation_chunk_size (Sequence[int]): The preferred segmentation
+            chunk shape.
+        meshing_chunk_size (Sequence[int]): The preferred meshing chunk shape.
+
+    Returns:
+        dict: A JSON-serializable plan, with the "storage_chunk_size",
+            "segmentation_chunk_size" and "meshing_chunk_size", the
+            "conversion_slice_count" and "conversion_max_block_bytes" to
+            convert with, the inputs that the plan was made from, and a list
+            of "notes" that explain any adaptations.
+
+    """
+    shape = tuple(int(dim) for dim in shape)
+    itemsize = np.dtype(dtype).itemsize
+    if memory_budget is None:
+        memory_budget = default_memory_budget()
+    conversion_workers = max(1, int(conversion_workers))
+    segmentation_workers = max(1, int(segmentation_workers))
+    volume_bytes = int(np.prod(shape)) * itemsize
+    notes = []
+
+    # Storage chunks
+    max_chunk_bytes = min(
+        MAX_STORAGE_CHUNK_BYTES,
+        memory_budget // (conversion_workers * CONVERSION_BYTES_PER_VOXEL_FACTOR),
+    )
+    min_chunk_bytes = min(
+        max_chunk_bytes,
+        max(MIN_STORAGE_CHUNK_BYTES, volume_bytes // MAX_STORAGE_CHUNK_COUNT),
+    )
+    storage = _fit_chunk(
+        shape,
+        storage_chunk_size,
+        lambda chunk: np.prod(chunk) * itemsize,
+        min_chunk_bytes,
+        max_chunk_bytes,
+        min_axis=2**multiscale_levels,
+    )
+    if storage != tuple(min(p, d) for p, d in zip(storage_chunk_size, shape)):
+        notes.append(
+            f"Storage chunks resized from {tuple(storage_chunk_size)} to {storage} "
+            f"to stay within {min_chunk_bytes} to {max_chunk_bytes} bytes per chunk."
+        )
+
+    # Conversion blocks: each worker holds one block at a time.
+    max_block_bytes = max(
+        int(np.prod(storage)) * itemsize,
+        memory_budget // (conversion_workers * CONVERSION_BYTES_PER_VOXEL_FACTOR),
+    )
+    slab_bytes = shape[0] * shape[1] * storage[2] * itemsize
+    if slab_bytes > max_block_bytes:
+        notes.append(
+            f"Full-XY slabs ({slab_bytes} bytes) exceed the per-worker budget of "
+            f"{max_block_bytes} bytes, so conversion blocks are tiled in XY."
+        )
+
+    # Segmentation chunks: each worker holds one chunk and one batch of
+    # slices' features at a time.
+    def _segmentation_cost(chunk):
+        slice_feature_bytes = chunk[0] * chunk[1] * SEGMENTATION_FEATURE_BYTES_PER_PIXEL
+        feature_bytes = max(
+            slice_feature_bytes,
+            min(slice_feature_bytes * chunk[2], SEGMENTATION_FEATURE_BATCH_BYTES),
+        )
+        return np.prod(chunk) * (itemsize + SEGMENTATION_BYTES_PER_VOXEL) + feature_bytes
+
+    segmentation_target = _segmentation_cost(segmentation_chunk_size)
+    segmentation = _fit_chunk(
+        shape,
+        segmentation_chunk_size,
+        _segmentation_cost,
+        min(segmentation_target, memory_budget // segmentation_workers) / 2,
+        memory_budget // segmentation_workers,
+    )
+    if segmentation != tuple(min(p, d) for p, d in zip(segmentation_chunk_size, shape)):
+        notes.append(
+            f"Segmentation chunks resized from {tuple(segmentation_chunk_size)} to "
+            f"{segmentation} for {segmentation_workers} workers."
+        )
+
+    # Meshing chunks: one at a time.
+    def _meshing_cost(chunk):
+        return np.prod(chunk) * MESHING_BYTES_PER_VOXEL
+
+    meshing_target = _meshing_cost(meshing_chunk_size)
+    meshing = _fit_chunk(
+        shape,
+        meshing_chunk_size,
+        _meshing_cost,
+        min(meshing_target, memory_budget) / 2,
+        memory_budget,
+    )
+    if meshing != tuple(min(p, d) for p, d in zip(meshing_chunk_size, shape)):
+        notes.append(
+            f"Meshing chunks resized from {tuple(meshing_chunk_size)} to {meshing}."
+        )
+
+    return {
+        "shape": list(shape),
+        "dtype": np.dtype(dtype).str,
+        "conversion_workers": conversion_workers,
+        "segmentation_workers": segmentation_workers,
+        "memory_budget_bytes": int(memory_budget),
+        "storage_chunk_size": list(storage),
+        "storage_chunk_bytes": int(np.prod(storage)) * itemsize,
+        "storage_chunk_count": _chunk_count(shape, storage),
+        "conversion_slice_count": int(storage[2]),
+        "conversion_max_block_bytes": int(max_block_bytes),
+        "segmentation_chunk_size": list(segmentation),
+        "segmentation_chunk_count": _chunk_count(shape, segmentation),
+        "meshing_chunk_size": list(meshing),
+        "meshing_chunk_count": _chunk_count(shape, meshing),
+        "notes": notes,
+    }
+
+
+__all__ = ["plan_chunk_shapes", "default_memory_budget"]
@@ -0,0 +1,198 @@
+import pathlib
+import shutil
+import tempfile
+import time
+from typing import Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+import zarr
+from numcodecs import Blosc
+from numcodecs.abc import Codec
+
+from . import VolumeProvider
+
+# Named Blosc settings for zarr chunks. "default" is what zarr exports used
+# before profiles existed. Bit-shuffling suits label volumes especially well:
+# a few small label values in wide integers leave most bit planes constant.
+COMPRESSION_PROFILES = {
+    "default": dict(cname="lz4", clevel=5, shuffle=Blosc.SHUFFLE),
+    "fast": dict(cname="lz4", clevel=1, shuffle=Blosc.SHUFFLE),
+    "balanced": dict(cname="zstd", clevel=3, shuffle=Blosc.BITSHUFFLE),
+    "compact": dict(cname="zstd", clevel=7, shuffle=Blosc.BITSHUFFLE),
+    "labels": dict(cname="zstd", clevel=5, shuffle=Blosc.BITSHUFFLE),
+    "labels-fast": dict(cname="lz4", clevel=5, shuffle=Blosc.BITSHUFFLE),
+}
+# The profiles that are benchmarked for image (raw scan) and label volumes:
+IMAGE_COMPRESSION_PROFILES = ("default", "fast", "balanced", "compact")
+LABEL_COMPRESSION_PROFILES = ("labels", "labels-fast", "default")
+
+# A profile is only picked if it writes at least this fast (in MB/s of
+# uncompressed data), so that compression doesn't become the bottleneck of
+# a conversion.
+DEFAULT_MIN_WRITE_MB_PER_S = 100.0
+
+
+def get_compressor(compression: Union[str, Codec, None] = None) -> Codec:
+    """
+    Return a zarr compressor for a compression profile name or codec.
+
+    Arguments:
+        compression (Union[str, Codec]): The name of a profile in
+            `COMPRESSION_PROFILES`, or a numcodecs codec (which is returned
+            as-is). Defaults to the "default" profile.
+
+    Returns:
+        Codec: The compressor.
+
+    Raises:
+        ValueError: If the profile name is unknown.
+
+    """
+    if compression is None:
+        compression = "default"
+    if not isinstance(compression, str):
+        return compression
+    if compression not in COMPRESSION_PROFILES:
+        raise ValueError(
+            f"Unknown compression profile {compression}; "
+            f"must be one of {list(COMPRESSION_PROFILES)}."
+        )
+    return Blosc(**COMPRESSION_PROFILES[compression])
+
+
+def _sample_volume(
+    volume_provider: VolumeProvider,
+    sample_shape: Tuple[int, int, int],
+    samples: int,
+    seed: int,
+) -> List[np.ndarray]:
+    """
+    Read subvolumes from evenly spread (jittered) positions along Z.
+    """
+    rng = np.random.default_rng(seed)
+    shape = volume_provider.shape
+    size = [min(s, d) for s, d in zip(sample_shape, shape)]
+    cutouts = []
+    for i in range(samples):
+        z_span = shape[2] - size[2]
+        z = int((i + rng.random()) / samples * z_span) if z_span > 0 else 0
+        x = int(rng.integers(0, shape[0] - size[0] + 1))
+        y = int(rng.integers(0, shape[1] - size[1] + 1))
+        cutouts.append(
+            np.asarray(
+                volume_provider[x : x + size[0], y : y + size[1], z : z + size[2]]
+            )
+        )
+    return cutouts
+
+
+def benchmark_compression(
+    volume_provider: VolumeProvider,
+    profiles: Optional[Iterable[str]] = None,
+    chunk_size: Tuple[int, int, int] = (256, 256, 32),
+    samples: int = 4,
+    workdir: Optional[Union[str, pathlib.Path]] = None,
+    seed: int = 0,
+) -> List[dict]:
+    """
+    Measure how well each compression profile does on a sample of a volume.
+
+    A few chunk-sized subvolumes are read from the volume, and each profile
+    writes them to (and reads them back from) a temporary zarr array, so the
+    timings include the filesystem as well as the codec.
+
+    Arguments:
+        volume_provider (VolumeProvider): The volume to sample.
+        profiles (Iterable[str]): The names of the profiles to benchmark.
+            Defaults to `IMAGE_COMPRESSION_PROFILES`.
+        chunk_size (Tuple[int, int, int]): The chunk (and sample) shape.
+        samples (int): The number of subvolumes to sample, spread out in Z.
+        workdir (pathlib.Path): Where to write the temporary arrays, e.g. on
+            the disk that the real export will go to. Defaults to the system
+            temporary directory.
+        seed (int): The seed for the sample positions.
+
+    Returns:
+        List[dict]: One result per profile, with the "profile" name, the
+            "ratio" of uncompressed to compressed bytes, and the
+            "write_mb_per_s" and "read_mb_per_s" (of uncompressed data).
+
+    """
+    profiles = list(profiles or IMAGE_COMPRESSION_PROFILES)
+    cutouts = _sample_volume(volume_provider, chunk_size, samples, seed)
+    raw_bytes = sum(cutout.nbytes for cutout in cutouts)
+    results = []
+    tmpdir = tempfile.mkdtemp(prefix="compression-benchmark-", dir=workdir)
+    try:
+        for profile in profiles:
+            compressor = get_compressor(profile)
+            stored_bytes, write_time, read_time = 0, 0.0, 0.0
+            for i, cutout in enumerate(cutouts):
+                path = pathlib.Path(tmpdir) / f"{profile}-{i}.zarr"
+                array = zarr.open_array(
+                    str(path),
+                    mode="w",
+                    shape=cutout.shape,
+                    chunks=cutout.shape,
+                    dtype=cutout.dtype,
+                    compressor=compressor,
+                )
+                start = time.perf_counter()
+                array[...] = cutout
+                write_time += time.perf_counter() - start
+                start = time.perf_counter()
+                array[...]
+                read_time += time.perf_counter() - start
+                stored_bytes += array.nbytes_stored
+                shutil.rmtree(path)
+            results.append(
+                {
+                    "profile": profile,
+                    "ratio": raw_bytes / max(1, stored_bytes),
+                    "write_mb_per_s": raw_bytes / 1e6 / max(write_time, 1e-9),
+                    "read_mb_per_s": raw_bytes / 1e6 / max(read_time, 1e-9),
+                }
+            )
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return results
+
+
+def pick_compression_profile(
+    results: List[dict],
+    min_write_mb_per_s: float = DEFAULT_MIN_WRITE_MB_PER_S,
+) -> str:
+    """
+    Pick the best profile from the results of `benchmark_compression`.
+
+    The profile with the best compression ratio among those that write (and
+    read) at least `min_write_mb_per_s` is picked. If none are that fast, the
+    fastest-writing profile is picked.
+
+    Arguments:
+        results (List[dict]): The benchmark results.
+        min_write_mb_per_s (float): The slowest acceptable throughput.
+
+    Returns:
+        str: The name of the picked profile.
+
+    """
+    fast_enough = [
+        result
+        for result in results
+        if result["write_mb_per_s"] >= min_write_mb_per_s
+        and result["read_mb_per_s"] >= min_write_mb_per_s
+    ]
+    if not fast_enough:
+        return max(results, key=lambda result: result["write_mb_per_s"])["profile"]
+    return max(
+        fast_enough, key=lambda result: (result["ratio"], result["write_mb_per_s"])
+    )["profile"]
+
+
+__all__ = [
+    "COMPRESSION_PROFILES",
+    "get_compressor",
+    "benchmark_compression",
+    "pick_compression_profile",
+]
@@ -1,8 +1,11 @@
 import logging
 import pathlib
-from typing import Optional, Union
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Sequence, Union
 
 import numpy as np
+import psutil
 
 try:
     import pydicom
@@ -12,11 +15,128 @@ except ImportError as e:
         "pydicom was not found. Install pydicom or sync the dicom dependency group."
     ) from e
 
+try:
+    from pydicom.pixels import iter_pixels
+except ImportError:
+    # pydicom < 3 can only decode a multi-frame file's pixel data all at once.
+    iter_pixels = None
+
+from .cache import SliceCache
 from .volume_provider import VolumeProvider, normalize_key
+from .zipvp import ZipArchive
 
 log = logging.getLogger(__name__)
 
 
+def _read_header_or_none(path: pathlib.Path, open_fn=None):
+    """
+    Read a DICOM header without pixel data, or return None if unreadable.
+    """
+    try:
+        source = open_fn(path) if open_fn is not None else str(path)
+        return pydicom.dcmread(source, stop_before_pixels=True)
+    except InvalidDicomError:
+        return None
+    except Exception:
+        log.debug("Skipping unreadable file while scanning DICOM input: %s", path)
+        return None
+
+
+def scan_dicom_headers(
+    paths: Sequence[pathlib.Path], workers: int = 1, open_fn=None
+) -> dict[pathlib.Path, "pydicom.Dataset"]:
+    """
+    Read the headers (without pixel data) of many files concurrently.
+
+    Header reads are dominated by file-open and read latency, so on network
+    storage a thread pool speeds up large series considerably. The result can
+    be passed to `DicomVolumeProvider(headers=...)` so that each header is
+    parsed only once, even if it was also used to detect the upload type.
+
+    Arguments:
+        paths (Sequence[pathlib.Path]): The files to scan.
+        workers (int): The number of threads to read headers with.
+        open_fn (Callable): A function that returns an open binary file for
+            a path, for files that are not on the filesystem (e.g. archive
+            members). Optional.
+
+    Returns:
+        dict[pathlib.Path, pydicom.Dataset]: The header of every file that is
+            a readable DICOM. Other files are left out.
+
+    """
+    paths = [pathlib.Path(path) for path in paths]
+    if workers > 1 and len(paths) > 1:
+        with ThreadPoolExecutor(max_workers=min(workers, len(paths))) as pool:
+            datasets = list(
+                pool.map(lambda path: _read_header_or_none(path, open_fn), paths)
+            )
+    else:
+        datasets = [_read_header_or_none(path, open_fn) for path in paths]
+    return {
+        path: dataset for path, dataset in zip(paths, datasets) if dataset is not None
+    }
+
+
+def _header_record(path: pathlib.Path, dataset) -> dict:
+    """
+    Summarize the header fields of one DICOM slice that the provider needs.
+
+    The records are plain JSON-compatible dicts, so a series' header index can
+    be stored or shipped elsewhere without re-reading the files.
+    """
+    image_position = getattr(dataset, "ImagePositionPatient", None)
+    try:
+        position = float(image_position[2]) if image_position is not None else None
+    except (IndexError, TypeError, ValueError):
+        position = None
+    try:
+        instance_number = int(getattr(dataset, "InstanceNumber", None))
+    except (TypeError, ValueError):
+        instance_number = None
+    file_meta = getattr(dataset, "file_meta", None)
+    transfer_syntax = getattr(file_meta, "TransferSyntaxUID", None)
+    return {
+        "path": str(path),
+        "series_uid": getattr(dataset, "SeriesInstanceUID", None),
+        "position": position,
+        "instance_number": instance_number,
+        "rows": int(getattr(dataset, "Rows", 0)),
+        "columns": int(getattr(dataset, "Columns", 0)),
+        "number_of_frames": int(getattr(dataset, "NumberOfFrames", 1) or 1),
+        "samples_per_pixel": int(getattr(dataset, "SamplesPerPixel", 1)),
+        "bits_allocated": int(getattr(dataset, "BitsAllocated", 0)),
+        "pixel_representation": int(getattr(dataset, "PixelRepresentation", 0)),
+        "transfer_syntax": str(transfer_syntax) if transfer_syntax else None,
+    }
+
+
+def _dtype_from_header(record: dict) -> np.dtype:
+    """
+    Return the dtype that pydicom will decode a slice's pixel data to.
+
+    Arguments:
+        record (dict): A header record from `_header_record`.
+
+    Returns:
+        np.dtype: The pixel dtype.
+
+    Raises:
+        ValueError: If the header has an unsupported BitsAllocated value.
+
+    """
+    bits_allocated = record["bits_allocated"]
+    if bits_allocated == 1:
+        # Bit-packed binary images are unpacked to one byte per pixel.
+        return np.dtype(np.uint8)
+    if bits_allocated not in (8, 16, 32, 64):
+        raise ValueError(
+            f"Unsupported DICOM BitsAllocated value {bits_allocated} in {record['path']}."
+        )
+    kind = "i" if record["pixel_representation"] == 1 else "u"
+    return np.dtype(f"{kind}{bits_allocated // 8}")
+
+
 class DicomVolumeProvider(VolumeProvider):
     """
     A VolumeProvider backed by one multi-frame DICOM or a series of DICOM files.
@@ -26,13 +146,68 @@ class DicomVolumeProvider(VolumeProvider):
         self,
         path_to_dcms: Union[pathlib.Path, str, list[pathlib.Path]],
         dcm_glob: str = "*",
+        cache_size: Union[int, str] = "guess",
+        headers: Optional[dict] = None,
+        header_workers: int = 1,
+        spill_frames: bool = False,
+        header_index: Optional[list[dict]] = None,
     ):
+        """
+        Create a new DicomVolumeProvider.
+
+        Arguments:
+            path_to_dcms (pathlib.Path | str | list[pathlib.Path]): A single
+                (possibly multi-frame) DICOM file, a directory of DICOM files,
+                or a list of DICOM file paths.
+            dcm_glob (str): A glob pattern to match DICOM files against, if
+                path_to_dcms is a directory. Defaults to "*".
+            cache_size (int): The size of the decoded-slice cache to use, in
+                bytes. If 0, no cache will be used. If "guess", 25% of the
+                available memory is used. Defaults to "guess".
+            headers (dict): Headers that were already read with
+                `scan_dicom_headers`, keyed by path. Files with a header here
+                are not read again while building the series. Optional.
+            header_workers (int): The number of threads to read the remaining
+                headers with. Defaults to 1.
+            spill_frames (bool): For multi-frame files, whether to keep every
+                decoded frame in a temporary memory-mapped file on disk, so
+                that frames are only decoded once without holding the whole
+                volume in memory. Defaults to False.
+            header_index (list[dict]): The `header_index` of an existing
+                provider of the same files. If given, the series is rebuilt
+                from it without reading any file headers, and `path_to_dcms`
+                is ignored. Optional.
+
+        Raises:
+            ValueError: If no usable DICOM data could be found.
+
+        """
         self._path: Optional[pathlib.Path] = None
         self._glob = dcm_glob
         self._files: list[pathlib.Path] = []
+        self._header_index: list[dict] = []
         self._volume_xyz: Optional[np.ndarray] = None
+        self._known_headers = {
+            pathlib.Path(path): dataset for path, dataset in (headers or {}).items()
+        }
+        self._header_workers = header_workers
+        self._frame_source: Optional[pathlib.Path] = None
+        self._spill_frames = spill_frames
+        self._spill: Optional[np.ndarray] = None
+        self._spilled: Optional[np.ndarray] = None
+
+        if cache_size == "guess":
+            cache_size = int(psutil.virtual_memory().available / 4)
+        elif isinstance(cache_size, str):
+            raise ValueError(
+                f"Invalid cache size: {cache_size}. Must be an integer or 'guess'."
+            )
+        self._cache_size = cache_size
+        self._cache = SliceCache(cache_size) if cache_size > 0 else None
 
-        if isinstance(path_to_dcms, list):
+        if header_index:
+            self._load_header_index(header_index)
+        elif isinstance(path_to_dcms, list):
             self._load_file_list(path_to_dcms)
         else:
             self._path = pathlib.Path(path_to_dcms)
@@ -42,10 +217,30 @@ class DicomVolumeProvider(VolumeProvider):
                 self._load_directory(self._path)
             else:
                 raise ValueError(f"Path does not exist: {self._path}")
-
-    @staticmethod
-    def _read_header(path: pathlib.Path):
-        return pydicom.dcmread(str(path), stop_before_pixels=True)
+        # The raw headers are summarized in the header index, so don't hold on
+        # to the full datasets for the lifetime of the provider.
+        self._known_headers = {}
+
+    def _scan_headers(self, paths: list[pathlib.Path]) -> dict:
+        """
+        Return the headers of the given files, reusing any pre-scanned ones.
+        """
+        unknown = [path for path in paths if path not in self._known_headers]
+        scanned = scan_dicom_headers(
+            unknown, workers=self._header_workers, open_fn=self._open_source
+        )
+        return {
+            path: self._known_headers.get(path, scanned.get(path)) for path in paths
+        }
+
+    def _open_source(self, path: pathlib.Path):
+        """
+        Return what pydicom should read to read the file at `path`.
+
+        This is the path itself; subclasses that read files from somewhere
+        other than the filesystem return an open binary file instead.
+        """
+        return str(path)
 
     @staticmethod
     def _sort_key(path: pathlib.Path, dataset) -> tuple:
@@ -65,8 +260,33 @@ class DicomVolumeProvider(VolumeProvider):
 
         return (2, path.name)
 
-    def _load_single_file(self, dicom_path: pathlib.Path) -> None:
-        dataset = pydicom.dcmread(str(dicom_path))
+    def _load_single_file(self, dicom_path: pathlib.Path, header=None) -> None:
+        if header is None:
+            header = self._known_headers.get(dicom_path)
+        if header is None:
+            header = pydicom.dcmread(self._open_source(dicom_path), stop_before_pixels=True)
+        record = _header_record(dicom_path, header)
+        if iter_pixels is None or record["samples_per_pixel"] != 1:
+            self._load_single_file_eagerly(dicom_path)
+            return
+
+        # Decode frames lazily, only when their Z range is requested, so that
+        # memory use is proportional to the read size rather than the volume.
+        self._ds = header
+        self._dtype = _dtype_from_header(record)
+        self._shape_xyz = (
+            record["columns"],
+            record["rows"],
+            record["number_of_frames"],
+        )
+        self._files = [dicom_path]
+        self._header_index = [record]
+        self._frame_source = dicom_path
+        if self._spill_frames:
+            self._create_spill()
+
+    def _load_single_file_eagerly(self, dicom_path: pathlib.Path) -> None:
+        dataset = pydicom.dcmread(self._open_source(dicom_path))
         pixel_array = dataset.pixel_array
 
         if pixel_array.ndim == 2:
@@ -85,6 +305,34 @@ class DicomVolumeProvider(VolumeProvider):
         self._files = [dicom_path]
         self._volume_xyz = volume_xyz
 
+    def _create_spill(self) -> None:
+        """
+        Create the (initially empty) on-disk store for decoded frames.
+        """
+        cols, rows, frames = self._shape_xyz
+        # The temporary file is deleted as soon as it is closed (or the
+        # provider is garbage collected), and is sparse until written.
+        self._spill_file = tempfile.TemporaryFile(prefix="ml4paleo_dicom_frames_")
+        self._spill = np.memmap(
+            self._spill_file, dtype=self._dtype, mode="w+", shape=(frames, rows, cols)
+        )
+        self._spilled = np.zeros(frames, dtype=bool)
+
+    def __getstate__(self) -> dict:
+        # Spilled frames live in a process-local temporary file; a pickled
+        # provider starts a fresh (empty) spill when it is unpickled.
+        state = self.__dict__.copy()
+        for key in ("_spill_file", "_spill", "_spilled"):
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._spill = None
+        self._spilled = None
+        if self._frame_source is not None and self._spill_frames:
+            self._create_spill()
+
     def _load_file_list(self, dicom_files: list[pathlib.Path]) -> None:
         if len(dicom_files) == 0:
             raise ValueError("No DICOM files were provided.")
@@ -97,18 +345,12 @@ class DicomVolumeProvider(VolumeProvider):
         self._load_headers_for_paths(self._files, source_label="provided file list")
 
     def _load_directory(self, dicom_dir: pathlib.Path) -> None:
-        headers = []
-        for path in sorted(dicom_dir.glob(self._glob)):
-            if not path.is_file():
-                continue
-            try:
-                dataset = self._read_header(path)
-            except InvalidDicomError:
-                continue
-            except Exception:
-                log.debug("Skipping unreadable file while scanning DICOM input: %s", path)
-                continue
-            headers.append((path, dataset))
+        paths = [path for path in sorted(dicom_dir.glob(self._glob)) if path.is_file()]
+        headers = [
+            (path, dataset)
+            for path, dataset in self._scan_headers(paths).items()
+            if dataset is not None
+        ]
 
         if len(headers) == 0:
             raise ValueError(f"No DICOM files found in {dicom_dir}.")
@@ -116,7 +358,7 @@ class DicomVolumeProvider(VolumeProvider):
         # If the directory contains a single multi-frame DICOM, treat it like a
         # single-file upload instead of a one-slice series.
         if len(headers) == 1 and int(getattr(headers[0][1], "NumberOfFrames", 1)) > 1:
-            self._load_single_file(headers[0][0])
+            self._load_single_file(headers[0][0], headers[0][1])
             return
 
         self._load_headers(headers, source_label=str(dicom_dir))
@@ -125,15 +367,13 @@ class DicomVolumeProvider(VolumeProvider):
         self, dicom_paths: list[pathlib.Path], source_label: str
     ) -> None:
         headers = []
-        for path in dicom_paths:
-            try:
-                dataset = self._read_header(path)
-            except InvalidDicomError as exc:
-                raise ValueError(f"File {path.name} is not a valid DICOM file.") from exc
+        for path, dataset in self._scan_headers(dicom_paths).items():
+            if dataset is None:
+                raise ValueError(f"File {path.name} is not a valid DICOM file.")
             headers.append((path, dataset))
 
         if len(headers) == 1 and int(getattr(headers[0][1], "NumberOfFrames", 1)) > 1:
-            self._load_single_file(headers[0][0])
+            self._load_single_file(headers[0][0], headers[0][1])
             return
 
         self._load_headers(headers, source_label=source_label)
@@ -167,27 +407,95 @@ class DicomVolumeProvider(VolumeProvider):
 
         headers = sorted(headers, key=lambda item: self._sort_key(item[0], item[1]))
         self._files = [path for path, _ in headers]
+        self._header_index = [_header_record(path, header) for path, header in headers]
 
-        dataset = pydicom.dcmread(str(self._files[0]))
-        rows = int(dataset.Rows)
-        cols = int(dataset.Columns)
+        # Everything we need to know about the series is in the headers; we
+        # don't need to decode any pixel data until a slice is requested.
+        first = self._header_index[0]
+        rows = first["rows"]
+        cols = first["columns"]
+        dtype = _dtype_from_header(first)
 
-        for _, header in headers[1:]:
-            if int(getattr(header, "Rows", rows)) != rows or int(
-                getattr(header, "Columns", cols)
-            ) != cols:
+        for record in self._header_index[1:]:
+            if record["rows"] != rows or record["columns"] != cols:
                 raise ValueError(
                     f"DICOM series in {source_label} has inconsistent slice dimensions."
                 )
-            if int(getattr(header, "NumberOfFrames", 1)) > 1:
+            if record["number_of_frames"] > 1:
                 raise ValueError(
                     f"DICOM source {source_label} contains multi-frame files mixed into a series upload."
                 )
+            if _dtype_from_header(record) != dtype:
+                raise ValueError(
+                    f"DICOM series in {source_label} has inconsistent pixel data types."
+                )
 
-        self._ds = dataset
-        self._dtype = np.dtype(dataset.pixel_array.dtype)
+        self._ds = headers[0][1]
+        self._dtype = dtype
         self._shape_xyz = (cols, rows, len(self._files))
 
+    def _load_header_index(self, header_index: list[dict]) -> None:
+        """
+        Rebuild the volume from the header records of an existing provider.
+        """
+        first = header_index[0]
+        self._files = [pathlib.Path(record["path"]) for record in header_index]
+        self._header_index = list(header_index)
+        self._ds = None
+        self._dtype = _dtype_from_header(first)
+        if len(header_index) == 1 and first["number_of_frames"] > 1:
+            self._shape_xyz = (first["columns"], first["rows"], first["number_of_frames"])
+            self._frame_source = self._files[0]
+            if self._spill_frames:
+                self._create_spill()
+        else:
+            self._shape_xyz = (first["columns"], first["rows"], len(self._files))
+
+    @property
+    def supports_region_reads(self) -> bool:
+        # DICOM slices (and frames) are always decoded in full, unless the
+        # whole volume was decoded eagerly.
+        return self._volume_xyz is not None
+
+    def descriptor(self) -> dict:
+        # Volumes decoded eagerly have no header index, so they are rebuilt
+        # (and decoded again) from the file itself. Like image stacks (see
+        # `ImageStackVolumeProvider.descriptor`), rebuilt providers have no
+        # slice cache, since every worker process would get its own.
+        return {
+            "provider": type(self),
+            "kwargs": {
+                "path_to_dcms": list(self._files),
+                "cache_size": 0,
+                "spill_frames": self._spill_frames,
+                "header_index": self._header_index if self._volume_xyz is None else None,
+            },
+        }
+
+    @property
+    def header_index(self) -> list[dict]:
+        """
+        The per-slice header records of the series, in Z order.
+
+        Each record holds the path, position, instance number, dimensions,
+        pixel format, and transfer syntax of one slice. Volumes read from one
+        multi-frame file have a single record for that file (or none, if the
+        file had to be decoded eagerly).
+        """
+        return self._header_index
+
+    def cache_stats(self) -> dict:
+        """
+        Return the hit/miss/eviction counters of the decoded-slice cache.
+
+        Returns:
+            dict: The cache statistics. Empty if caching is disabled.
+
+        """
+        if self._cache is None:
+            return {}
+        return self._cache.stats()
+
     def __getitem__(self, key):
         zs, ys, xs = normalize_key(key, self.shape[::-1])
         return self._get_subvolume(xs, ys, zs)
@@ -195,15 +503,76 @@ class DicomVolumeProvider(VolumeProvider):
     def _read_slice_xyz(self, z_index: int) -> np.ndarray:
         if self._volume_xyz is not None:
             return self._volume_xyz[:, :, z_index]
-        return pydicom.dcmread(str(self._files[z_index])).pixel_array.T
+        if self._frame_source is not None:
+            return self._read_frames_xyz([z_index])[0]
+        if self._cache is not None:
+            cached = self._cache.get(z_index)
+            if cached is not None:
+                return cached
+        res = pydicom.dcmread(self._open_source(self._files[z_index])).pixel_array.T
+        if self._cache is not None:
+            res.flags.writeable = False
+            self._cache.put(z_index, res)
+        return res
+
+    def _read_frames_xyz(self, z_indices: list[int]) -> list[np.ndarray]:
+        """
+        Return frames of a multi-frame file, decoding only the missing ones.
+
+        Frames are looked up in the slice cache and then in the on-disk spill
+        (if enabled). The remaining frames are decoded in one pass over the
+        file.
+
+        Arguments:
+            z_indices (list[int]): The frame indices to read.
+
+        Returns:
+            list[np.ndarray]: The frames, in XY order.
+
+        """
+        frames = {}
+        missing = []
+        for z in z_indices:
+            frame = self._cache.get(z) if self._cache is not None else None
+            if frame is None and self._spilled is not None and self._spilled[z]:
+                frame = self._spill[z].T
+            if frame is None:
+                missing.append(z)
+            else:
+                frames[z] = frame
+
+        if len(missing) > 0:
+            for z, frame in zip(
+                missing,
+                iter_pixels(self._open_source(self._frame_source), indices=missing),
+            ):
+                if self._spill is not None:
+                    self._spill[z] = frame
+                    self._spilled[z] = True
+                frame = frame.T
+                if self._cache is not None:
+                    frame.flags.writeable = False
+                    self._cache.put(z, frame)
+                frames[z] = frame
+
+        return [frames[z] for z in z_indices]
 
     def _get_subvolume(self, xs, ys, zs):
         if self._volume_xyz is not None:
-            return self._volume_xyz[xs[0] : xs[1], ys[0] : ys[1], zs[0] : zs[1]]
+            return self._volume_xyz[
+                xs[0] : xs[1] : xs[2], ys[0] : ys[1] : ys[2], zs[0] : zs[1] : zs[2]
+            ]
 
-        slices = []
-        for z in range(zs[0], zs[1]):
-            slices.append(self._read_slice_xyz(z)[xs[0] : xs[1], ys[0] : ys[1]])
+        z_indices = list(range(*zs))
+        if len(z_indices) == 0:
+            return np.zeros((len(range(*xs)), len(range(*ys)), 0), dtype=self.dtype)
+        if self._frame_source is not None:
+            frames = self._read_frames_xyz(z_indices)
+        else:
+            frames = [self._read_slice_xyz(z) for z in z_indices]
+        slices = [
+            frame[xs[0] : xs[1] : xs[2], ys[0] : ys[1] : ys[2]] for frame in frames
+        ]
         return np.stack(slices, axis=-1)
 
     @property
@@ -213,3 +582,58 @@ class DicomVolumeProvider(VolumeProvider):
     @property
     def dtype(self):
         return self._dtype
+
+
+class ZipDicomVolumeProvider(DicomVolumeProvider):
+    """
+    A DicomVolumeProvider that reads a DICOM series (or one multi-frame file)
+    directly from the members of a ZIP archive, without extracting them.
+    """
+
+    def __init__(
+        self,
+        archive_path: Union[pathlib.Path, str],
+        members: Optional[list[str]] = None,
+        dcm_glob: str = "*",
+        cache_size: Union[int, str] = "guess",
+        headers: Optional[dict] = None,
+        header_workers: int = 1,
+        spill_frames: bool = False,
+        header_index: Optional[list[dict]] = None,
+    ):
+        """
+        Create a new ZipDicomVolumeProvider.
+
+        Arguments:
+            archive_path (pathlib.Path): The path to the ZIP archive.
+            members (list[str]): The names of the DICOM members. If None,
+                every member that matches `dcm_glob` is used.
+            dcm_glob (str): A glob pattern to match member names against, if
+                members is None. Defaults to "*".
+
+        The other arguments are the same as for DicomVolumeProvider. Headers
+        are keyed by member name.
+
+        """
+        self.archive = ZipArchive(archive_path)
+        if members is None:
+            members = self.archive.names(dcm_glob)
+        super().__init__(
+            [pathlib.PurePosixPath(member) for member in members],
+            cache_size=cache_size,
+            headers=headers,
+            header_workers=header_workers,
+            spill_frames=spill_frames,
+            header_index=header_index,
+        )
+
+    def _open_source(self, path):
+        return self.archive.open(path)
+
+    def descriptor(self) -> dict:
+        descriptor = super().descriptor()
+        descriptor["kwargs"]["members"] = [
+            str(path) for path in descriptor["kwargs"].pop("path_to_dcms")
+        ]
+        descriptor["kwargs"]["archive_path"] = self.archive.archive_path
+        return descriptor
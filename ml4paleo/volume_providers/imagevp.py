@@ -1,13 +1,132 @@
+import logging
+import os
 import pathlib
-from functools import lru_cache
-from typing import List, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple, Union
 
 import numpy as np
 import psutil
 from PIL import Image
 
+from .cache import SliceCache
 from .volume_provider import VolumeProvider, normalize_key
 
+try:
+    import tifffile
+except ImportError:
+    # Without tifffile, TIFF regions are decoded in full by PIL and cropped.
+    tifffile = None
+
+_TIFF_SUFFIXES = (".tif", ".tiff")
+
+log = logging.getLogger(__name__)
+
+
+def _read_image_header(path) -> Optional[Tuple[Tuple[int, int], str]]:
+    """
+    Read the size and mode of an image without decoding its pixels.
+
+    Arguments:
+        path (pathlib.Path | BinaryIO): The path to the image, or an open
+            binary file.
+
+    Returns:
+        Tuple[Tuple[int, int], str]: The (width, height) size and PIL mode.
+        None: If the file could not be opened as an image.
+
+    """
+    try:
+        with Image.open(path) as img:
+            return img.size, img.mode
+    except Exception:
+        return None
+
+
+def _dtype_for_mode(mode: str) -> np.dtype:
+    """
+    Return the numpy dtype that a decoded image of the given PIL mode has.
+
+    For multi-channel modes this is the dtype of a single channel, since the
+    stack only keeps the first channel.
+    """
+    return np.array(Image.new(mode, (1, 1))).dtype
+
+
+def _read_tiff_region(
+    path: pathlib.Path,
+    box: Tuple[int, int, int, int],
+    step: Tuple[int, int] = (1, 1),
+    source=None,
+) -> Optional[np.ndarray]:
+    """
+    Read a region of a TIFF image, decoding only the tiles or strips it covers.
+
+    If a step is given, only the tiles or strips that contain sampled pixels
+    are decoded (e.g. with one-row strips and a row step of 4, only every
+    fourth strip is read).
+
+    Arguments:
+        path (pathlib.Path): The path to the TIFF file.
+        box (Tuple[int, int, int, int]): The (left, upper, right, lower) pixel
+            box to read, in PIL's convention.
+        step (Tuple[int, int]): The (column, row) sampling step.
+        source (BinaryIO): An open binary file to read the TIFF from, instead
+            of opening `path` (which is then only used for its suffix).
+
+    Returns:
+        np.ndarray: The (rows, cols) region of the image.
+        None: If the file is not a single-channel TIFF that is stored in more
+            than one tile or strip (the caller should fall back to PIL).
+
+    """
+    if tifffile is None or pathlib.PurePath(path).suffix.lower() not in _TIFF_SUFFIXES:
+        return None
+
+    left, upper, right, lower = box
+    rows = np.arange(upper, lower, step[1])
+    cols = np.arange(left, right, step[0])
+    with tifffile.TiffFile(source if source is not None else str(path)) as tif:
+        page = tif.pages[0]
+        if (
+            page.dtype is None
+            or page.samplesperpixel != 1
+            or page.imagedepth != 1
+            or len(page.dataoffsets) <= 1
+        ):
+            return None
+
+        if page.is_tiled:
+            segment_rows, segment_cols = page.tilelength, page.tilewidth
+        else:
+            segment_rows = min(page.rowsperstrip, page.imagelength)
+            segment_cols = page.imagewidth
+        segments_per_row = -(-page.imagewidth // segment_cols)
+
+        region = np.zeros((len(rows), len(cols)), dtype=page.dtype)
+        filehandle = tif.filehandle
+        for row in np.unique(rows // segment_rows):
+            y0 = row * segment_rows
+            in_row = (rows >= y0) & (rows < y0 + segment_rows)
+            for col in np.unique(cols // segment_cols):
+                index = row * segments_per_row + col
+                if page.databytecounts[index] == 0:
+                    # Sparse files may omit empty segments entirely.
+                    continue
+                filehandle.seek(page.dataoffsets[index])
+                data = filehandle.read(page.databytecounts[index])
+                segment, _, segment_shape = page.decode(
+                    data, index, jpegtables=page.jpegtables
+                )
+                segment = segment.reshape(segment_shape[-3], segment_shape[-2])
+
+                # Copy the sampled pixels of this segment into the region:
+                x0 = col * segment_cols
+                in_col = (cols >= x0) & (cols < x0 + segment_cols)
+                region[np.ix_(in_row, in_col)] = segment[
+                    np.ix_(rows[in_row] - y0, cols[in_col] - x0)
+                ]
+        return region
+
 
 class ImageStackVolumeProvider(VolumeProvider):
     """
@@ -20,6 +139,8 @@ class ImageStackVolumeProvider(VolumeProvider):
         path_or_list_of_images: Union[pathlib.Path, List[pathlib.Path]],
         image_glob: str = "*",
         cache_size: Union[int, str] = "guess",
+        decode_workers: int = 1,
+        validate_headers: bool = True,
     ):
         """
         Create a new ImageStackVolumeProvider.
@@ -34,14 +155,26 @@ class ImageStackVolumeProvider(VolumeProvider):
                 containing the images, or a list of paths to the images.
             image_glob (str): A glob pattern to match the image files against,
                 if path is a directory. Defaults to "*".
-            cache_size (int): The size of the cache to use, in number of stored
-                images. If 0, no cache will be used. If "guess", a reasonable
-                default will be chosen based upon the size of the images and
-                available memory (will use 50% of available memory). Defaults
-                to "guess".
+            cache_size (int): The size of the decoded-slice cache to use, in
+                bytes. Least-recently-used slices are evicted once the total
+                size of the cached slices exceeds this budget. If 0, no cache
+                will be used. If "guess", a reasonable default will be chosen
+                based upon available memory (will use 50% of available
+                memory). Defaults to "guess".
+            decode_workers (int): The number of threads to use to decode the
+                images of a single read. PIL releases the GIL while decoding,
+                so reads that span many Z slices scale with this number. If 1,
+                slices are decoded sequentially in Z order. If -1, one worker
+                per CPU core is used. Defaults to 1.
+            validate_headers (bool): Whether to check (from the image headers
+                only, without decoding pixels) that every image in the stack
+                has the same size, mode, and dtype. If False, only the first
+                image is inspected. Defaults to True.
 
         Raises:
-            ValueError: If the path is not a directory or list is empty.
+            ValueError: If the path is not a directory or list is empty, if
+                decode_workers is invalid, or if the images do not all share
+                the same size, mode, and dtype.
 
         """
         if isinstance(path_or_list_of_images, pathlib.Path):
@@ -58,46 +191,226 @@ class ImageStackVolumeProvider(VolumeProvider):
 
         # Calculate the cache size.
         if cache_size == "guess":
-            # Calculate the size of the images.
-            image_size = Image.open(self.paths[0]).size
-            image_size = image_size[0] * image_size[1] * 4
-            # Multiply by datatype size;
-            dtype = np.dtype(np.float32)
-            image_size *= dtype.itemsize
-            # Calculate the size of the cache.
-            cache_size = int(psutil.virtual_memory().available / 2 / image_size)
+            cache_size = int(psutil.virtual_memory().available / 2)
         elif isinstance(cache_size, str):
             raise ValueError(
                 f"Invalid cache size: {cache_size}. Must be an integer or 'guess'."
             )
         self._cache_size = cache_size
+        self._cache = SliceCache(self._cache_size) if self._cache_size > 0 else None
+
+        if decode_workers == -1:
+            decode_workers = os.cpu_count() or 1
+        if decode_workers < 1:
+            raise ValueError(
+                f"Invalid decode_workers: {decode_workers}. Must be -1 or at least 1."
+            )
+        self._decode_workers = int(decode_workers)
+
+        # Probe the image headers once, so that shape and dtype lookups (which
+        # happen on every read) don't have to touch the disk.
+        self._probe_headers(validate_headers)
+
+    def _probe_headers(self, validate: bool) -> None:
+        """
+        Read the image headers and store the shape and dtype of the stack.
+
+        Images that cannot be opened are skipped with a warning, and will be
+        read as blank slices (see `_read_image`).
+
+        Arguments:
+            validate (bool): Whether to scan every header, or just the first
+                readable one.
+
+        Raises:
+            ValueError: If no image could be opened, or if the images do not
+                share the same size, mode, and dtype.
+
+        """
+        if not validate:
+            headers = []
+            for path in self.paths:
+                header = self._read_header(path)
+                headers.append(header)
+                if header is not None:
+                    break
+        elif self._decode_workers > 1:
+            with ThreadPoolExecutor(max_workers=self._decode_workers) as pool:
+                headers = list(pool.map(self._read_header, self.paths))
+        else:
+            headers = [self._read_header(path) for path in self.paths]
 
-        # Decorate the read function with a cache.
-        # self._read_image = lru_cache(maxsize=self._cache_size)(self._read_image)
+        reference = None
+        for path, header in zip(self.paths, headers):
+            if header is None:
+                log.warning("Could not read image %s; it will be read as zeros.", path)
+                continue
+            if reference is None:
+                reference = (path, header)
+                continue
+            (reference_path, (size, mode)) = reference
+            if header[0] != size:
+                raise ValueError(
+                    f"Image {path} has size {header[0]}, but {reference_path} has size {size}."
+                )
+            # Modes may differ as long as they decode to the same dtype (e.g.
+            # "L" and "RGB", since only the first channel is kept).
+            if header[1] != mode and _dtype_for_mode(header[1]) != _dtype_for_mode(mode):
+                raise ValueError(
+                    f"Image {path} has mode {header[1]} ({_dtype_for_mode(header[1])}), "
+                    f"but {reference_path} has mode {mode} ({_dtype_for_mode(mode)})."
+                )
+        if reference is None:
+            raise ValueError("None of the images could be read.")
 
-    def _read_image(self, path: pathlib.Path) -> np.ndarray:
+        (size, mode) = reference[1]
+        self._shape = (size[0], size[1], len(self.paths))
+        self._mode = mode
+        self._dtype = _dtype_for_mode(mode)
+
+    def _open_source(self, path):
+        """
+        Return what image readers should open to read the image at `path`.
+
+        This is the path itself; subclasses that read images from somewhere
+        other than the filesystem return an open binary file instead.
         """
-        Read an image from disk.
+        return path
+
+    def _read_header(self, path) -> Optional[Tuple[Tuple[int, int], str]]:
+        return _read_image_header(self._open_source(path))
+
+    def _read_image(
+        self,
+        path: pathlib.Path,
+        box: Optional[Tuple[int, int, int, int]] = None,
+        step: Tuple[int, int] = (1, 1),
+    ) -> np.ndarray:
+        """
+        Read an image (or a region of an image) from disk.
+
+        If a box is provided, tiled and multi-strip TIFFs are read by decoding
+        only the segments that overlap the box (and that contain sampled
+        pixels, if a step is given). Other formats are cropped by PIL before
+        they are converted to numpy.
 
         Arguments:
             path (pathlib.Path): The path to the image to read.
+            box (Tuple[int, int, int, int]): The (left, upper, right, lower)
+                region to read, in image pixel coordinates. If None, the full
+                image is read.
+            step (Tuple[int, int]): The (x, y) sampling step. Defaults to
+                (1, 1), i.e. every pixel.
 
         Returns:
-            np.ndarray: The image data.
+            np.ndarray: The image data, in XY order.
 
         """
         try:
-            res = np.array(Image.open(path)).T
+            if box is None:
+                res = np.array(Image.open(self._open_source(path))).T
+            else:
+                res = None
+                if pathlib.PurePath(path).suffix.lower() in _TIFF_SUFFIXES:
+                    res = _read_tiff_region(path, box, step, self._open_source(path))
+                if res is None:
+                    with Image.open(self._open_source(path)) as img:
+                        if box != (0, 0, *img.size):
+                            img = img.crop(box)
+                        res = np.array(img)[:: step[1], :: step[0]]
+                res = res.T
         except:
-            res = np.zeros(self.shape[:2], dtype=self.dtype)
+            if box is None:
+                res = np.zeros(self.shape[:2], dtype=self.dtype)
+            else:
+                res = np.zeros(
+                    (
+                        len(range(box[0], box[2], step[0])),
+                        len(range(box[1], box[3], step[1])),
+                    ),
+                    dtype=self.dtype,
+                )
         # If dim is CHW, chop off the C dimension.
         if len(res.shape) == 3:
             res = res[0]
         return res
 
+    def _read_slice(
+        self,
+        z: int,
+        box: Tuple[int, int, int, int],
+        full_slice: bool,
+        step: Tuple[int, int] = (1, 1),
+    ) -> np.ndarray:
+        """
+        Read a region of the z-th image of the stack.
+
+        Full slices are served from (and stored in) the slice cache if it is
+        enabled. Partial reads are cropped out of the cache when the slice is
+        already cached, and are otherwise decoded region-of-interest only.
+
+        Arguments:
+            z (int): The index of the image to read.
+            box (Tuple[int, int, int, int]): The (left, upper, right, lower)
+                region to read, clipped to the image bounds.
+            full_slice (bool): Whether the box covers the entire image.
+            step (Tuple[int, int]): The (x, y) sampling step.
+
+        Returns:
+            np.ndarray: The image data. Cached slices are read-only.
+
+        """
+        if self._cache is not None:
+            res = self._cache.get(z)
+            if res is not None:
+                return res[box[0] : box[2] : step[0], box[1] : box[3] : step[1]]
+            if full_slice:
+                res = self._read_image(self.paths[z])
+                res.flags.writeable = False
+                self._cache.put(z, res)
+                return res[:: step[0], :: step[1]]
+        if full_slice and step == (1, 1):
+            return self._read_image(self.paths[z])
+        return self._read_image(self.paths[z], box, step)
+
+    def cache_stats(self) -> dict:
+        """
+        Return the hit/miss/eviction counters of the slice cache.
+
+        Returns:
+            dict: The cache statistics. Empty if caching is disabled.
+
+        """
+        if self._cache is None:
+            return {}
+        return self._cache.stats()
+
+    @property
+    def supports_region_reads(self) -> bool:
+        # Only TIFFs are decoded region-of-interest (see `_read_image`); other
+        # formats decode the whole image and crop it.
+        return pathlib.PurePath(self.paths[0]).suffix.lower() in _TIFF_SUFFIXES
+
+    def descriptor(self) -> dict:
+        # The paths are already globbed and sorted, and the headers were
+        # validated when this provider was built, so rebuilding only needs
+        # to read the first header. Rebuilt providers have no slice cache:
+        # this provider's cache size was sized for one process (half of the
+        # available memory, by default), and worker processes each have
+        # their own copy, while export workers never read a slice twice.
+        return {
+            "provider": type(self),
+            "kwargs": {
+                "path_or_list_of_images": list(self.paths),
+                "cache_size": 0,
+                "decode_workers": self._decode_workers,
+                "validate_headers": False,
+            },
+        }
+
     @property
     def shape(self) -> Tuple[int, int, int]:
-        return (*Image.open(self.paths[0]).size, len(self.paths))
+        return self._shape
 
     def __getitem__(self, key):
         """
@@ -105,24 +418,53 @@ class ImageStackVolumeProvider(VolumeProvider):
 
         Note that this method can be quite slow if the slice is "deep" in Z
         and small in XY. For better performance, this method will try to use
-        the cache if `cache_size` is set to a value greater than 0 in the
-        constructor of this class.
+        the slice cache if `cache_size` is set to a value greater than 0 in
+        the constructor of this class, and will only decode the requested XY
+        region of each image when the image format allows it.
+
+        Stepped slices (e.g. `vol[::4, ::4, ::4]`) only read the images in the
+        Z steps, and only decode the sampled rows of tiled or striped TIFFs.
 
         Arguments:
             key (tuple): The indices to slice.
 
         """
         # Normalize the indices
-        zs, ys, xs = normalize_key(key, self.shape[::-1])
+        shape = self.shape
+        zs, ys, xs = normalize_key(key, shape[::-1])
+        z_indices = range(*zs)
+        if len(z_indices) == 0:
+            return np.zeros((len(range(*xs)), len(range(*ys)), 0), dtype=self.dtype)
 
-        # Read the images.
-        images = [self._read_image(self.paths[z]) for z in range(zs[0], zs[1])]
+        # Only decode the part of each image that was asked for:
+        box = (xs[0], ys[0], xs[1], ys[1])
+        full_slice = box == (0, 0, shape[0], shape[1])
+
+        def _read(z: int) -> np.ndarray:
+            return self._read_slice(z, box, full_slice, (xs[2], ys[2]))
+
+        # Read the first image to learn the output shape and dtype, and then
+        # decode the rest of the Z range directly into a preallocated array.
+        first = _read(z_indices[0])
+        vol = np.empty((*first.shape, len(z_indices)), dtype=first.dtype)
+        vol[:, :, 0] = first
+
+        def _decode_into(i: int) -> None:
+            vol[:, :, i] = _read(z_indices[i])
+
+        remaining = range(1, len(z_indices))
+        if self._decode_workers > 1 and len(remaining) > 1:
+            workers = min(self._decode_workers, len(remaining))
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                # Consume the iterator so that decode errors are raised here.
+                list(pool.map(_decode_into, remaining))
+        else:
+            for i in remaining:
+                _decode_into(i)
 
         # Return the subvolume.
-        vol = np.stack(images, axis=-1)
-        # Return the subvolume.
-        return vol[xs[0] : xs[1], ys[0] : ys[1], :]
+        return vol
 
     @property
     def dtype(self) -> np.dtype:
-        return self[0:1, 0:1, 0].dtype
+        return self._dtype
@@ -1,14 +1,422 @@
+import json
+import logging
 import math
 import pathlib
-from typing import Tuple, Union
+import shutil
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple, Union
 import zarr
 import numpy as np
 import tqdm
-from joblib import Parallel, delayed
-from numcodecs import Blosc
+from joblib import Parallel, delayed, effective_n_jobs
 from PIL import Image
 
 from . import VolumeProvider
+from .compression import get_compressor
+from .stats import IntensityHistogram, intensity_window
+from .volume_provider import provider_from_descriptor
+
+MULTISCALE_POOLING_MODES = ("mean", "mode")
+EXPORT_PARALLEL_BACKENDS = ("joblib", "process")
+
+log = logging.getLogger(__name__)
+
+
+def _pool_blocks_2x(block: np.ndarray) -> np.ndarray:
+    """
+    Group a 3D block into 2x2x2 cells, returned as an (X/2, Y/2, Z/2, 8) array.
+
+    Odd dimensions are padded by repeating the edge voxels, so the result has
+    ceil(n / 2) cells along each axis.
+    """
+    padding = [(0, dim % 2) for dim in block.shape]
+    if any(after for _, after in padding):
+        block = np.pad(block, padding, mode="edge")
+    x, y, z = block.shape
+    return (
+        block.reshape(x // 2, 2, y // 2, 2, z // 2, 2)
+        .transpose(0, 2, 4, 1, 3, 5)
+        .reshape(x // 2, y // 2, z // 2, 8)
+    )
+
+
+def _mean_pool(block: np.ndarray) -> np.ndarray:
+    """
+    Downsample a 3D image block by 2x in every axis by averaging.
+    """
+    cells = _pool_blocks_2x(block)
+    accumulator = np.float32 if block.dtype.itemsize <= 2 else np.float64
+    pooled = cells.mean(axis=-1, dtype=accumulator)
+    if np.issubdtype(block.dtype, np.integer):
+        pooled = np.rint(pooled)
+    return pooled.astype(block.dtype)
+
+
+def _mode_pool(block: np.ndarray) -> np.ndarray:
+    """
+    Downsample a 3D label block by 2x in every axis, keeping the most common
+    label of each 2x2x2 cell (ties go to the first voxel of the cell).
+    """
+    cells = _pool_blocks_2x(block)
+    counts = np.empty(cells.shape, dtype=np.uint8)
+    for i in range(cells.shape[-1]):
+        counts[..., i] = (cells == cells[..., i : i + 1]).sum(axis=-1)
+    choice = counts.argmax(axis=-1)
+    return np.take_along_axis(cells, choice[..., np.newaxis], axis=-1)[..., 0]
+
+
+def _multiscale_attrs(
+    levels: int, downsample_factor: Tuple[int, int, int], pooling: str
+) -> dict:
+    """
+    Return OME-Zarr (NGFF v0.4) multiscales metadata for an XYZ pyramid.
+    """
+    return {
+        "multiscales": [
+            {
+                "version": "0.4",
+                "axes": [
+                    {"name": "x", "type": "space"},
+                    {"name": "y", "type": "space"},
+                    {"name": "z", "type": "space"},
+                ],
+                "datasets": [
+                    {
+                        "path": str(level),
+                        "coordinateTransformations": [
+                            {
+                                "type": "scale",
+                                "scale": [float(f * 2**level) for f in downsample_factor],
+                            }
+                        ],
+                    }
+                    for level in range(levels + 1)
+                ],
+                "type": pooling,
+            }
+        ]
+    }
+
+
+def plan_export_blocks(
+    shape: Tuple[int, int, int],
+    chunk_size: Tuple[int, int, int],
+    slice_count: int,
+    n_workers: int = 1,
+    alignment: int = 1,
+    chunk_aligned: bool = False,
+    max_block_voxels: Optional[int] = None,
+    region_reads: bool = True,
+) -> List[Tuple[Tuple[int, int], Tuple[int, int], Tuple[int, int]]]:
+    """
+    Partition an array into blocks that can be written independently.
+
+    With a single worker, the array is split into full-XY slabs that are
+    `slice_count` deep. With several workers, every block boundary lies on
+    the zarr chunk grid, so that no two blocks ever write to the same chunk:
+    the slab depth is rounded up to a whole number of chunks, and if there
+    are fewer slabs than workers, the slabs are further split in X and Y
+    (again along chunk boundaries) so that every worker has work to do.
+    Slabs are likewise split in X and Y if they are larger than
+    `max_block_voxels`, so that very wide volumes are written in tiles.
+
+    Every XY tile reads each of its slices again, so if the source can't read
+    regions cheaply (`region_reads=False`, e.g. PNG stacks or compressed ZIP
+    members, which decode the whole slice for every read), slabs are made
+    thinner (down to one chunk deep) for the workers instead, and are only
+    split in X and Y if they are larger than `max_block_voxels`.
+
+    Arguments:
+        shape: The shape of the array to write.
+        chunk_size: The chunk shape of the array.
+        slice_count: The preferred depth of each block, in Z.
+        n_workers: The number of workers that will write blocks concurrently.
+        alignment: Block boundaries are additionally aligned to multiples of
+            this (e.g. for multiscale pyramids).
+        chunk_aligned: Whether to align blocks to the chunk grid even when
+            there is only one worker.
+        max_block_voxels: The (soft) maximum number of voxels per block.
+            Blocks are never split below one chunk-grid cell in X and Y.
+        region_reads: Whether the source can read XY regions of a slice
+            more cheaply than the whole slice.
+
+    Returns:
+        List: ((xstart, xstop), (ystart, ystop), (zstart, zstop)) per block.
+
+    """
+
+    def _align(size: int, multiple: int) -> int:
+        return max(1, math.ceil(size / multiple)) * multiple
+
+    def _split(dim: int, step: int) -> List[Tuple[int, int]]:
+        return [(start, min(start + step, dim)) for start in range(0, dim, step)]
+
+    def _too_large(x_ranges, y_ranges, depth) -> bool:
+        if max_block_voxels is None:
+            return False
+        x_size = x_ranges[0][1] - x_ranges[0][0]
+        y_size = y_ranges[0][1] - y_ranges[0][0]
+        return x_size * y_size * min(depth, shape[2]) > max_block_voxels
+
+    if n_workers <= 1 and not chunk_aligned:
+        depth = _align(slice_count, alignment)
+        if not _too_large([(0, shape[0])], [(0, shape[1])], depth):
+            return [((0, shape[0]), (0, shape[1]), zs) for zs in _split(shape[2], depth)]
+
+    grid = [math.lcm(chunk, alignment) for chunk in chunk_size]
+    depth = _align(slice_count, grid[2])
+    if not region_reads and math.ceil(shape[2] / depth) < n_workers:
+        depth = _align(math.ceil(shape[2] / n_workers), grid[2])
+    z_ranges = _split(shape[2], depth)
+
+    # Split X and Y into (roughly) equal numbers of chunk-aligned tiles, until
+    # there is at least one block per worker, and blocks are small enough:
+    x_ranges, y_ranges = [(0, shape[0])], [(0, shape[1])]
+    splits = 1
+    max_splits = max(math.ceil(shape[0] / grid[0]), math.ceil(shape[1] / grid[1]))
+    while (
+        (region_reads and len(z_ranges) * len(x_ranges) * len(y_ranges) < n_workers)
+        or _too_large(x_ranges, y_ranges, depth)
+    ) and splits < max_splits:
+        splits += 1
+        x_ranges = _split(shape[0], _align(math.ceil(shape[0] / splits), grid[0]))
+        y_ranges = _split(shape[1], _align(math.ceil(shape[1] / splits), grid[1]))
+
+    return [
+        (xs, ys, zs) for zs in z_ranges for xs in x_ranges for ys in y_ranges
+    ]
+
+
+def _identity(x):
+    return x
+
+
+def manifest_path_for(zarr_file: Union[pathlib.Path, str]) -> pathlib.Path:
+    """
+    Return the path of the completion manifest of a resumable export.
+
+    The manifest lives next to the zarr (not inside it), so it is never
+    served or read as part of the zarr hierarchy.
+    """
+    zarr_file = pathlib.Path(zarr_file)
+    return zarr_file.with_name(zarr_file.name + ".manifest.jsonl")
+
+
+def _block_chunks(block, chunk_size):
+    """
+    Yield the key and (block-relative) slices of each chunk in a block.
+
+    Blocks passed here are chunk-aligned, so every chunk is entirely inside
+    the block (or clipped by the edge of the array).
+    """
+    chunk_ranges = [
+        range(start // chunk, -(-end // chunk))
+        for (start, end), chunk in zip(block, chunk_size)
+    ]
+    for i in chunk_ranges[0]:
+        for j in chunk_ranges[1]:
+            for k in chunk_ranges[2]:
+                yield f"{i}.{j}.{k}", tuple(
+                    slice(index * chunk - start, min((index + 1) * chunk, end) - start)
+                    for index, chunk, (start, end) in zip((i, j, k), chunk_size, block)
+                )
+
+
+def _checksum(data: np.ndarray) -> str:
+    return format(zlib.crc32(np.ascontiguousarray(data).tobytes()), "08x")
+
+
+def _append_manifest_record(manifest_path: str, record: dict) -> None:
+    # A single small append is effectively atomic, so workers in different
+    # processes can record their blocks in the same manifest.
+    with open(manifest_path, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def _read_manifest(manifest_path: pathlib.Path, header: dict) -> Optional[dict]:
+    """
+    Return the checksums of the completed chunks recorded in a manifest.
+
+    Arguments:
+        manifest_path (pathlib.Path): The manifest to read.
+        header (dict): The export parameters of the current export.
+
+    Returns:
+        dict: The checksum of each completed chunk, keyed by chunk key.
+        None: If there is no manifest, or if it was written by an export
+            with different parameters.
+
+    """
+    if not manifest_path.exists():
+        return None
+    completed = {}
+    with open(manifest_path) as f:
+        lines = f.read().splitlines()
+    if len(lines) == 0:
+        return None
+    try:
+        if json.loads(lines[0]) != header:
+            return None
+    except ValueError:
+        return None
+    for line in lines[1:]:
+        try:
+            completed.update(json.loads(line)["chunks"])
+        except (ValueError, KeyError):
+            # A crash mid-write can leave a truncated last line.
+            continue
+    return completed
+
+
+def _read_complete_block(zarr_array, block, completed: dict) -> Optional[np.ndarray]:
+    """
+    Return the data of a block if every one of its chunks was recorded as
+    complete, and still has the checksum that was recorded (else None).
+    """
+    (xstart, xend), (ystart, yend), (zstart, zend) = block
+    chunks = list(_block_chunks(block, zarr_array.chunks))
+    if any(key not in completed for key, _ in chunks):
+        return None
+    try:
+        data = zarr_array[xstart:xend, ystart:yend, zstart:zend]
+    except Exception:
+        # Corrupt (e.g. truncated) chunks fail to decode.
+        return None
+    if all(_checksum(data[slices]) == completed[key] for key, slices in chunks):
+        return data
+    return None
+
+
+def _write_export_block(
+    volume_provider: VolumeProvider,
+    pyramid: list,
+    block: Tuple[Tuple[int, int], Tuple[int, int], Tuple[int, int]],
+    downsample_factor: Tuple[int, int, int],
+    dtype: np.dtype,
+    cuboid_transform_fn,
+    pool_fn,
+    manifest_path: Optional[str] = None,
+    stats_range: Optional[Tuple[float, float]] = None,
+    compute_stats: bool = False,
+) -> Optional[IntensityHistogram]:
+    """
+    Read one (output-coordinate) block from the provider, and write it to
+    every level of the pyramid. If a manifest path is given, the block's
+    chunks are recorded as complete once every level has been written.
+
+    Returns the intensity histogram of the block, if `compute_stats` is set.
+    """
+    (out_xstart, out_xend), (out_ystart, out_yend), (out_zstart, out_zend) = block
+    source_ranges = [
+        (start * factor, min(end * factor, source_dim))
+        for (start, end), factor, source_dim in zip(
+            block, downsample_factor, volume_provider.shape
+        )
+    ]
+    vol = volume_provider[
+        source_ranges[0][0] : source_ranges[0][1] : downsample_factor[0],
+        source_ranges[1][0] : source_ranges[1][1] : downsample_factor[1],
+        source_ranges[2][0] : source_ranges[2][1] : downsample_factor[2],
+    ]
+    vol = cuboid_transform_fn(vol)
+    vol = vol.astype(dtype)
+    pyramid[0][out_xstart:out_xend, out_ystart:out_yend, out_zstart:out_zend] = vol
+
+    # Build each pyramid level from the block of the level above it:
+    level_vol = vol
+    for level in range(1, len(pyramid)):
+        level_vol = pool_fn(level_vol)
+        x, y, z = (start // 2**level for start, _ in block)
+        pyramid[level][
+            x : x + level_vol.shape[0],
+            y : y + level_vol.shape[1],
+            z : z + level_vol.shape[2],
+        ] = level_vol
+
+    if manifest_path is not None:
+        _append_manifest_record(
+            manifest_path,
+            {
+                "chunks": {
+                    key: _checksum(vol[slices])
+                    for key, slices in _block_chunks(block, pyramid[0].chunks)
+                }
+            },
+        )
+
+    if compute_stats:
+        return IntensityHistogram(dtype, stats_range).add(vol)
+    return None
+
+
+# The provider and zarr arrays of a "process" backend export worker. These are
+# set up once per worker process by `_init_export_worker`.
+_export_worker_state: dict = {}
+
+
+def _init_export_worker(
+    descriptor: dict,
+    level_paths: List[str],
+    synchronizer_path: str,
+    downsample_factor: Tuple[int, int, int],
+    dtype: np.dtype,
+    cuboid_transform_fn,
+    pool_fn,
+    manifest_path: Optional[str],
+    stats_range: Optional[Tuple[float, float]],
+    compute_stats: bool,
+) -> None:
+    synchronizer = None
+    if synchronizer_path is not None:
+        synchronizer = zarr.ProcessSynchronizer(synchronizer_path)
+    _export_worker_state.update(
+        volume_provider=provider_from_descriptor(descriptor),
+        pyramid=[
+            zarr.open_array(
+                path, mode="r+", synchronizer=synchronizer if level > 0 else None
+            )
+            for level, path in enumerate(level_paths)
+        ],
+        downsample_factor=downsample_factor,
+        dtype=dtype,
+        cuboid_transform_fn=cuboid_transform_fn or _identity,
+        pool_fn=pool_fn,
+        manifest_path=manifest_path,
+        stats_range=stats_range,
+        compute_stats=compute_stats,
+    )
+
+
+def _export_block_in_worker(block) -> Optional[IntensityHistogram]:
+    return _write_export_block(block=block, **_export_worker_state)
+
+
+def _sample_stats_range(
+    volume_provider: VolumeProvider,
+    downsample_factor: Tuple[int, int, int],
+    dtype: np.dtype,
+    cuboid_transform_fn,
+    samples: int = 4,
+) -> Optional[Tuple[float, float]]:
+    """
+    Estimate the value range of an export from a few evenly-spaced slices.
+
+    Only needed for dtypes whose histograms are binned (see
+    `IntensityHistogram`); values outside of the range are still counted.
+    """
+    if IntensityHistogram(dtype).exact:
+        return None
+    low, high = None, None
+    for z in np.linspace(0, volume_provider.shape[2] - 1, samples).astype(int):
+        vol = volume_provider[:: downsample_factor[0], :: downsample_factor[1], int(z)]
+        vol = np.asarray(cuboid_transform_fn(vol)).astype(dtype)
+        vol = vol[np.isfinite(vol)] if vol.dtype.kind == "f" else vol
+        if vol.size == 0:
+            continue
+        low = float(vol.min()) if low is None else min(low, float(vol.min()))
+        high = float(vol.max()) if high is None else max(high, float(vol.max()))
+    return None if low is None else (low, high)
 
 
 def export_zarr_array(
@@ -23,36 +431,93 @@ def export_zarr_array(
     parallel_jobs: int = False,
     cuboid_transform_fn=None,
     progress_callback=None,
+    multiscale_levels: int = 0,
+    multiscale_pooling: str = "mean",
+    parallel_backend: str = "joblib",
+    resume: bool = False,
+    compute_stats: bool = True,
+    max_block_bytes: Optional[int] = None,
     **kwargs,
 ):
     """
     Export the volume to a zarr array.
 
+    If `multiscale_levels` is greater than 0, the output is instead an
+    OME-Zarr (NGFF) multiscale group: the full-resolution array is written to
+    the "0" subpath, and each further level is downsampled 2x in every axis
+    from the level before it. All levels are written in the same streaming
+    pass over the volume provider, so the source is only read once.
+
     Arguments:
         volume_provider: The volume provider to export.
         zarr_file: The path to the zarr file to write to.
         downsample_factor: The factor to downsample the volume by.
         dtype: The numpy dtype to use for the zarr array.
-        compression: The compression to use for the zarr array.
+        compression: The compression to use for the zarr array: a numcodecs
+            codec, or the name of a profile in `COMPRESSION_PROFILES`.
+            Defaults to the "default" profile.
         chunk_size: The chunk size to use for the zarr array.
-        slice_count: The number of slices to write at a time.
+        slice_count: The number of slices to write at a time. When running
+            in parallel, this is rounded up to a whole number of chunks.
         progress: Whether to show a progress bar.
         parallel_jobs: The number of parallel jobs to use. If False, will not
-            use parallel jobs.
-        cuboid_transform_fn: A function to apply to each cuboid before
-            writing it to the zarr array. (Happens before dtype casting.)
+            use parallel jobs. Work is split along the zarr chunk grid (see
+            `plan_export_blocks`), so any number of jobs is safe.
+        cuboid_transform_fn: A function to apply to each (downsampled) cuboid
+            before writing it to the zarr array. (Happens before dtype
+            casting.)
+        multiscale_levels: The number of downsampled levels to write in
+            addition to the full-resolution array. Defaults to 0 (write a
+            plain zarr array, with no pyramid).
+        multiscale_pooling: How to downsample each pyramid level: "mean" for
+            images, or "mode" for label volumes. Defaults to "mean".
+        parallel_backend: How to run parallel jobs. "joblib" runs each block
+            as a joblib task (which ships the volume provider with every
+            task). "process" uses a process pool in which each worker builds
+            its own volume provider once, from `volume_provider.descriptor()`,
+            and writes its blocks directly to the zarr. The "process" backend
+            needs a provider that supports descriptors, and a picklable
+            (module-level) `cuboid_transform_fn`. Defaults to "joblib".
+        resume: Whether to record each completed chunk (with a checksum of
+            its contents) in a manifest next to the zarr file (see
+            `manifest_path_for`). If a manifest from an earlier, interrupted
+            export with the same parameters exists, the existing zarr is
+            reused, and chunks that were completed and still match their
+            checksums are skipped. Defaults to False.
+        compute_stats: Whether to compute intensity statistics of the written
+            volume (see `IntensityHistogram`) as it is written, for the whole
+            volume and for each Z slab. They are stored in the
+            "intensity_stats" attribute of the (full-resolution) array, where
+            `ZarrVolumeProvider.intensity_stats` reads them. Defaults to True.
+        max_block_bytes: The (soft) maximum size of a block of the volume that
+            is read and written at once, in bytes. Slabs that are larger than
+            this are split into chunk-aligned tiles in X and Y (see
+            `plan_export_blocks`). Defaults to None (no limit).
+
+    Returns:
+        zarr.Array: The (full-resolution) zarr array that was written.
 
     """
     if downsample_factor is None:
         downsample_factor = (1, 1, 1)
     if dtype is None:
         dtype = volume_provider.dtype
-    if compression is None:
-        compression = Blosc()
+    compression = get_compressor(compression)
     if chunk_size is None:
         chunk_size = (256, 256, 256)
 
-    cuboid_transform_fn = cuboid_transform_fn or (lambda x: x)
+    if parallel_backend not in EXPORT_PARALLEL_BACKENDS:
+        raise ValueError(
+            f"Invalid parallel_backend {parallel_backend}; must be one of {EXPORT_PARALLEL_BACKENDS}."
+        )
+    descriptor = None
+    if parallel_jobs is not False and parallel_backend == "process":
+        descriptor = volume_provider.descriptor()
+        if descriptor is None:
+            raise ValueError(
+                f"{type(volume_provider).__name__} cannot be rebuilt from a descriptor, "
+                "so it cannot be used with the 'process' backend."
+            )
 
     # Open the zarr file
     zarr_file = pathlib.Path(zarr_file)
@@ -63,16 +528,88 @@ def export_zarr_array(
         math.ceil(volume_provider.shape[1] / downsample_factor[1]),
         math.ceil(volume_provider.shape[2] / downsample_factor[2]),
     ]
-    zarr_array = zarr.open(
-        str(zarr_file),
-        mode="w",
-        zarr_format=2,
-        shape=shape,
+    if multiscale_pooling not in MULTISCALE_POOLING_MODES:
+        raise ValueError(
+            f"Invalid multiscale_pooling {multiscale_pooling}; must be one of {MULTISCALE_POOLING_MODES}."
+        )
+    pool_fn = _mean_pool if multiscale_pooling == "mean" else _mode_pool
+
+    array_kwargs = dict(
         chunks=chunk_size,
         dtype=dtype,
         compressor=compression,
         **kwargs,
     )
+    # Pyramid levels are written in slabs that are only a fraction of a chunk
+    # deep, so parallel workers need chunk-level locking to avoid clobbering
+    # each other's writes.
+    synchronizer = None
+    if multiscale_levels > 0 and parallel_jobs is not False:
+        synchronizer = zarr.ProcessSynchronizer(str(zarr_file) + ".sync")
+
+    manifest_path = None
+    completed = None
+    if resume:
+        manifest_path = manifest_path_for(zarr_file)
+        manifest_header = {
+            "source_shape": [int(dim) for dim in volume_provider.shape],
+            "shape": shape,
+            "chunks": list(chunk_size),
+            "dtype": np.dtype(dtype).str,
+            "downsample_factor": list(downsample_factor),
+            "multiscale_levels": multiscale_levels,
+            "multiscale_pooling": multiscale_pooling,
+        }
+        if zarr_file.exists():
+            completed = _read_manifest(manifest_path, manifest_header)
+
+    if completed is not None:
+        # Reopen the arrays of the interrupted export:
+        level_paths = [zarr_file]
+        if multiscale_levels > 0:
+            level_paths = [zarr_file / str(level) for level in range(multiscale_levels + 1)]
+        pyramid = [
+            zarr.open_array(
+                str(path), mode="r+", synchronizer=synchronizer if level > 0 else None
+            )
+            for level, path in enumerate(level_paths)
+        ]
+        zarr_array = pyramid[0]
+    elif multiscale_levels > 0:
+        group = zarr.open_group(str(zarr_file), mode="w")
+        group.attrs.update(
+            _multiscale_attrs(multiscale_levels, downsample_factor, multiscale_pooling)
+        )
+        pyramid = []
+        level_shape = shape
+        for level in range(multiscale_levels + 1):
+            pyramid.append(
+                group.create_dataset(
+                    str(level),
+                    shape=level_shape,
+                    synchronizer=synchronizer if level > 0 else None,
+                    **array_kwargs,
+                )
+            )
+            level_shape = [math.ceil(dim / 2) for dim in level_shape]
+        zarr_array = pyramid[0]
+    else:
+        zarr_array = zarr.open(
+            str(zarr_file),
+            mode="w",
+            zarr_format=2,
+            shape=shape,
+            **array_kwargs,
+        )
+        pyramid = [zarr_array]
+
+    if resume and completed is None:
+        with open(manifest_path, "w") as f:
+            f.write(json.dumps(manifest_header) + "\n")
+        completed = {}
+    elif not resume:
+        # A manifest from an earlier export no longer describes this zarr.
+        manifest_path_for(zarr_file).unlink(missing_ok=True)
 
     # Write the data
     if slice_count is None:
@@ -93,44 +630,127 @@ def export_zarr_array(
     else:
         _prog = prog_bar  # type: ignore
 
+    # Downsampling is pushed down into the volume provider as a stepped read,
+    # so that providers only read (and decode) the voxels that are kept. Work
+    # is planned in output (downsampled) coordinates so that every block
+    # starts on a multiple of the downsample factor.
+    output_slice_count = max(1, slice_count // downsample_factor[2])
+    n_workers = 1 if parallel_jobs is False else effective_n_jobs(parallel_jobs)
+    max_block_voxels = None
+    if max_block_bytes is not None:
+        itemsize = max(np.dtype(dtype).itemsize, np.dtype(volume_provider.dtype).itemsize)
+        max_block_voxels = max(1, max_block_bytes // itemsize)
+    blocks = plan_export_blocks(
+        shape,
+        chunk_size,
+        output_slice_count,
+        n_workers=n_workers,
+        # Each pyramid level halves the block, so blocks must be a multiple of
+        # 2 ** levels in size for the levels to stay aligned.
+        alignment=2**multiscale_levels,
+        # Resumable exports record and verify whole chunks.
+        chunk_aligned=resume,
+        max_block_voxels=max_block_voxels,
+        region_reads=getattr(volume_provider, "supports_region_reads", True),
+    )
+    stats_range = None
+    slab_histograms: dict = {}
+    if compute_stats:
+        stats_range = _sample_stats_range(
+            volume_provider, downsample_factor, dtype, cuboid_transform_fn or _identity
+        )
+
+    def _count_block(block, block_histogram):
+        # Blocks that share a Z range (i.e. XY tiles) make up one slab:
+        if block_histogram is None:
+            return
+        slab = slab_histograms.setdefault(
+            tuple(block[2]), IntensityHistogram(dtype, stats_range)
+        )
+        slab += block_histogram
+
+    if completed:
+        remaining = []
+        for block in blocks:
+            data = _read_complete_block(zarr_array, block, completed)
+            if data is None:
+                remaining.append(block)
+            elif compute_stats:
+                # Finished blocks still count towards the statistics:
+                _count_block(block, IntensityHistogram(dtype, stats_range).add(data))
+        log.info(
+            "Resuming export to %s: %d of %d blocks already complete.",
+            zarr_file,
+            len(blocks) - len(remaining),
+            len(blocks),
+        )
+        blocks = remaining
+    if manifest_path is not None:
+        manifest_path = str(manifest_path)
+
+    def _export_block(block):
+        return _write_export_block(
+            volume_provider,
+            pyramid,
+            block,
+            downsample_factor,
+            dtype,
+            cuboid_transform_fn or _identity,
+            pool_fn,
+            manifest_path,
+            stats_range,
+            compute_stats,
+        )
+
     if parallel_jobs is False:
-        for i in _prog(range(0, volume_provider.shape[2], slice_count)):
-            zstart = i
-            zend = min(i + slice_count, volume_provider.shape[2])
-            vol = volume_provider[:, :, zstart:zend]
-            vol = cuboid_transform_fn(vol)
-            vol = vol.astype(dtype)[
-                :: downsample_factor[0],
-                :: downsample_factor[1],
-                :: downsample_factor[2],
-            ]
-            zarr_array[
-                :, :, (zstart // downsample_factor[2]) : (zend // downsample_factor[2])
-            ] = vol
+        for block in _prog(blocks):
+            _count_block(block, _export_block(block))
+
+    elif parallel_backend == "process":
+        # Each worker builds its own provider and opens its own handles to the
+        # zarr arrays once, so tasks only carry the block coordinates.
+        level_paths = [str(zarr_file)]
+        if multiscale_levels > 0:
+            level_paths = [str(zarr_file / str(level)) for level in range(len(pyramid))]
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            initializer=_init_export_worker,
+            initargs=(
+                descriptor,
+                level_paths,
+                synchronizer.path if synchronizer is not None else None,
+                downsample_factor,
+                dtype,
+                cuboid_transform_fn,
+                pool_fn,
+                manifest_path,
+                stats_range,
+                compute_stats,
+            ),
+        ) as executor:
+            futures = [executor.submit(_export_block_in_worker, block) for block in blocks]
+            for block, future in zip(blocks, _prog(futures)):
+                _count_block(block, future.result())
 
     else:
-        if slice_count < chunk_size[2]:
-            # Warn if number of slices is less than chunk size
-            # TODO
-            pass
-
-        def _racey_export_chunk_parallel(zstart):
-            zend = min(zstart + slice_count, volume_provider.shape[2])
-            vol = volume_provider[:, :, zstart:zend]
-            vol = cuboid_transform_fn(vol)
-            vol = vol.astype(dtype)[
-                :: downsample_factor[0],
-                :: downsample_factor[1],
-                :: downsample_factor[2],
-            ]
-            zarr_array[
-                :, :, (zstart // downsample_factor[2]) : (zend // downsample_factor[2])
-            ] = vol
-
-        _ = Parallel(n_jobs=parallel_jobs)(
-            delayed(_racey_export_chunk_parallel)(zstart)
-            for zstart in _prog(range(0, volume_provider.shape[2], slice_count))
+        # Blocks are aligned to the chunk grid, so no two workers ever write
+        # to the same chunk of the full-resolution array.
+        block_histograms = Parallel(n_jobs=parallel_jobs)(
+            delayed(_export_block)(block) for block in _prog(blocks)
         )
+        for block, block_histogram in zip(blocks, block_histograms):
+            _count_block(block, block_histogram)
+
+    if synchronizer is not None:
+        shutil.rmtree(synchronizer.path, ignore_errors=True)
+
+    if compute_stats:
+        histogram = IntensityHistogram(dtype, stats_range)
+        slabs = []
+        for (zstart, zend), slab_histogram in sorted(slab_histograms.items()):
+            histogram += slab_histogram
+            slabs.append({"z": [zstart, zend], **slab_histogram.summary(histogram=False)})
+        zarr_array.attrs["intensity_stats"] = {**histogram.summary(), "slabs": slabs}
 
     return zarr_array
 
@@ -259,20 +879,30 @@ def export_to_img_stack(
     downsample_factor: Tuple[int, int, int] = (1, 1, 1),
     progress: bool = True,
     parallel_jobs: Union[int, bool] = False,
+    intensity_stats: Optional[dict] = None,
     **kwargs,
 ):
     """
     Export a volume to an image stack.
 
+    Formats that only hold 8-bit images (png, jpg) are written by mapping the
+    volume's intensity window (see `intensity_window`) onto 0-255, so that
+    e.g. 16-bit volumes aren't truncated. The window comes from the volume's
+    precomputed intensity statistics; without them, values are cast as-is.
+
     Arguments:
         volume_provider: The volume provider to export.
         img_dir: The directory to save the image stack to.
         img_format: The image format to use.
-        downsample_factor: The downsample factor to use.
+        downsample_factor: The downsample factor to use, in XYZ. Images are
+            numbered by their downsampled Z index.
         progress: Whether to show a progress bar.
         parallel_jobs: The number of parallel jobs to use. If False, no parallel
             jobs are used. If True, the number of jobs is set to the number of
             cores.
+        intensity_stats: The intensity statistics of the volume, as computed
+            by `export_zarr_array`. If None, the provider's `intensity_stats`
+            are used, if it has any.
         **kwargs: Additional arguments to pass to `skimage.io.imsave`.
 
     """
@@ -282,26 +912,37 @@ def export_to_img_stack(
     img_dir = pathlib.Path(img_dir)
     img_dir.mkdir(parents=True, exist_ok=True)
 
+    if intensity_stats is None:
+        intensity_stats = getattr(volume_provider, "intensity_stats", None)
+    window = None
+    if intensity_stats and np.dtype(volume_provider.dtype) != np.uint8:
+        window = intensity_window(intensity_stats)
+
     def _export_slice(i):
-        img = volume_provider[:, :, i]
-        img = img[
+        # Read only the downsampled pixels of the source slice:
+        img = volume_provider[
             :: downsample_factor[0],
             :: downsample_factor[1],
+            i * downsample_factor[2],
         ]
         img = img.squeeze()
 
         # Cast if file format requires it:
         if img_format in ["png", "jpg", "jpeg"]:
+            if window is not None and window[1] > window[0]:
+                img = (img.astype(np.float32) - window[0]) / (window[1] - window[0])
+                img = np.clip(img * 255.0, 0, 255).round()
             img = img.astype(np.uint8)
 
         img_path = img_dir / f"{i:04d}.{img_format}"
         Image.fromarray(img).save(img_path, **kwargs)
 
+    slice_total = math.ceil(volume_provider.shape[2] / downsample_factor[2])
     _prog = tqdm.tqdm if progress else lambda x: x
     if parallel_jobs is False:
-        for i in _prog(range(volume_provider.shape[2])):
+        for i in _prog(range(slice_total)):
             _export_slice(i)
     else:
         _ = Parallel(n_jobs=parallel_jobs)(
-            delayed(_export_slice)(i) for i in _prog(range(volume_provider.shape[2]))
+            delayed(_export_slice)(i) for i in _prog(range(slice_total))
         )
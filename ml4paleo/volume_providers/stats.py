@@ -0,0 +1,317 @@
+from typing import Iterable, Optional, Sequence, Tuple
+
+import numpy as np
+
+# The percentiles that are precomputed for every volume (and every slab).
+DEFAULT_PERCENTILES = (0.1, 0.5, 1.0, 2.0, 5.0, 25.0, 50.0, 75.0, 95.0, 98.0, 99.0, 99.5, 99.9)
+
+# Intensity windows prefer non-zero voxels when there are enough of them, so
+# padded borders and sparse black backgrounds don't collapse the range.
+MIN_NONZERO_VOXELS = 128
+
+_FLOAT_HISTOGRAM_BINS = 4096
+_DISPLAY_HISTOGRAM_BINS = 256
+_ADD_BATCH_SIZE = 1 << 22
+
+
+def _percentile_key(q: float) -> str:
+    return repr(float(q))
+
+
+class IntensityHistogram:
+    """
+    A mergeable histogram of the voxel intensities of a volume.
+
+    Integer volumes of up to 16 bits are counted exactly, with one bin per
+    possible value, so their percentiles match `np.percentile`. Other dtypes
+    are counted in fixed-width bins over a value range chosen up front (values
+    outside of it are counted in the first or last bin), and percentiles are
+    interpolated within a bin. The exact minimum, maximum, mean, and number of
+    zero voxels are tracked separately.
+
+    Histograms of different parts of a volume can be added together, so they
+    can be computed per block (in parallel) and merged afterwards.
+    """
+
+    def __init__(
+        self,
+        dtype: np.dtype,
+        value_range: Optional[Tuple[float, float]] = None,
+        bins: int = _FLOAT_HISTOGRAM_BINS,
+    ):
+        """
+        Create a new, empty IntensityHistogram.
+
+        Arguments:
+            dtype (np.dtype): The dtype of the values that will be counted.
+            value_range (Tuple[float, float]): The (low, high) range of the
+                bins, for dtypes that are not counted exactly. Defaults to
+                (0, 1).
+            bins (int): The number of bins, for dtypes that are not counted
+                exactly. Defaults to 4096.
+
+        """
+        self.dtype = np.dtype(dtype)
+        self.exact = self.dtype.kind in "biu" and self.dtype.itemsize <= 2
+        if self.exact:
+            self._offset = int(np.iinfo(self.dtype).min) if self.dtype.kind == "i" else 0
+            self.counts = np.zeros(2 ** (8 * self.dtype.itemsize), dtype=np.int64)
+        else:
+            low, high = value_range if value_range is not None else (0.0, 1.0)
+            if not high > low:
+                high = low + 1.0
+            self.value_range = (float(low), float(high))
+            self.counts = np.zeros(bins, dtype=np.int64)
+        self.count = 0
+        # Exact histograms derive these from their counts instead:
+        self._zero_count = 0
+        self._min = None
+        self._max = None
+        self._sum = 0.0
+        self._sum_of_squares = 0.0
+
+    def __getstate__(self) -> dict:
+        # Exact 16-bit histograms are mostly empty; only ship the used bins.
+        state = self.__dict__.copy()
+        used = np.flatnonzero(state.pop("counts"))
+        state["_used_bins"] = (used, self.counts[used], len(self.counts))
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        used, used_counts, bins = state.pop("_used_bins")
+        self.__dict__.update(state)
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.counts[used] = used_counts
+
+    def _bin_indices(self, values: np.ndarray) -> np.ndarray:
+        if self.exact:
+            return values.astype(np.intp) - self._offset
+        low, high = self.value_range
+        scaled = (values.astype(np.float64) - low) * (len(self.counts) / (high - low))
+        return np.clip(scaled, 0, len(self.counts) - 1).astype(np.int64)
+
+    def _bin_value(self, index):
+        """
+        Return the value at a (fractional) bin position, or array of positions.
+        """
+        if self.exact:
+            return index + self._offset
+        low, high = self.value_range
+        return low + index * (high - low) / len(self.counts)
+
+    def add(self, data: np.ndarray) -> "IntensityHistogram":
+        """
+        Count the (finite) values of an array.
+
+        Arguments:
+            data (np.ndarray): The values to count.
+
+        Returns:
+            IntensityHistogram: This histogram.
+
+        """
+        values = np.asarray(data).ravel()
+        if values.dtype.kind == "f":
+            values = values[np.isfinite(values)]
+        if values.size == 0:
+            return self
+        # Bin in pieces, to bound the size of the temporary index arrays:
+        for start in range(0, values.size, _ADD_BATCH_SIZE):
+            piece = values[start : start + _ADD_BATCH_SIZE]
+            self.counts += np.bincount(self._bin_indices(piece), minlength=len(self.counts))
+            if not self.exact:
+                as_float = piece.astype(np.float64)
+                self._sum += float(as_float.sum())
+                self._sum_of_squares += float(np.dot(as_float, as_float))
+        self.count += int(values.size)
+        if not self.exact:
+            self._zero_count += int(values.size - np.count_nonzero(values))
+            low, high = float(values.min()), float(values.max())
+            self._min = low if self._min is None else min(self._min, low)
+            self._max = high if self._max is None else max(self._max, high)
+        return self
+
+    def __iadd__(self, other: "IntensityHistogram") -> "IntensityHistogram":
+        if other.count == 0:
+            return self
+        self.counts += other.counts
+        self.count += other.count
+        if not self.exact:
+            self._zero_count += other._zero_count
+            self._min = other._min if self._min is None else min(self._min, other._min)
+            self._max = other._max if self._max is None else max(self._max, other._max)
+            self._sum += other._sum
+            self._sum_of_squares += other._sum_of_squares
+        return self
+
+    @property
+    def zero_count(self) -> int:
+        if self.exact:
+            return int(self.counts[-self._offset])
+        return self._zero_count
+
+    @property
+    def nonzero_count(self) -> int:
+        return self.count - self.zero_count
+
+    @property
+    def min(self) -> Optional[float]:
+        if not self.exact or self.count == 0:
+            return self._min
+        return float(self._bin_value(np.flatnonzero(self.counts)[0]))
+
+    @property
+    def max(self) -> Optional[float]:
+        if not self.exact or self.count == 0:
+            return self._max
+        return float(self._bin_value(np.flatnonzero(self.counts)[-1]))
+
+    def _moments(self) -> Tuple[float, float]:
+        """
+        Return the sum and the sum of squares of the counted values.
+        """
+        if not self.exact:
+            return self._sum, self._sum_of_squares
+        values = self._bin_value(np.arange(len(self.counts), dtype=np.float64))
+        return float(np.dot(values, self.counts)), float(np.dot(values**2, self.counts))
+
+    def _nonzero_counts(self) -> np.ndarray:
+        counts = self.counts.copy()
+        if self.zero_count > 0:
+            counts[self._bin_indices(np.zeros(1, dtype=self.dtype))[0]] -= self.zero_count
+        return counts
+
+    def percentiles(self, qs: Iterable[float], nonzero: bool = False) -> list:
+        """
+        Return percentiles of the counted values, like `np.percentile`.
+
+        Arguments:
+            qs (Iterable[float]): The percentiles to compute, from 0 to 100.
+            nonzero (bool): Whether to leave zero voxels out. Defaults to
+                False.
+
+        Returns:
+            list: The percentile values, or Nones if there are no values.
+
+        """
+        counts = self._nonzero_counts() if nonzero else self.counts
+        total = int(counts.sum())
+        qs = list(qs)
+        if total == 0:
+            return [None for _ in qs]
+        cumulative = np.cumsum(counts)
+
+        def _value_at_rank(rank: float) -> float:
+            index = int(np.searchsorted(cumulative, rank, side="right"))
+            if self.exact:
+                return float(self._bin_value(index))
+            # Interpolate within the bin, assuming its values are uniform:
+            before = cumulative[index - 1] if index > 0 else 0
+            fraction = (rank - before + 0.5) / counts[index]
+            return self._bin_value(index + fraction)
+
+        results = []
+        for q in qs:
+            rank = q / 100.0 * (total - 1)
+            below, above = int(np.floor(rank)), int(np.ceil(rank))
+            value = _value_at_rank(below)
+            if above != below:
+                value += (rank - below) * (_value_at_rank(above) - value)
+            results.append(float(min(max(value, self.min), self.max)))
+        return results
+
+    def summary(
+        self,
+        percentiles: Sequence[float] = DEFAULT_PERCENTILES,
+        histogram: bool = True,
+    ) -> dict:
+        """
+        Return a JSON-serializable summary of the histogram.
+
+        Arguments:
+            percentiles (Sequence[float]): The percentiles to include, both
+                over all voxels and over non-zero voxels.
+            histogram (bool): Whether to include a 256-bin histogram of the
+                values between the minimum and maximum. Defaults to True.
+
+        Returns:
+            dict: The summary.
+
+        """
+        mean, std = None, None
+        if self.count:
+            total, total_of_squares = self._moments()
+            mean = total / self.count
+            std = float(np.sqrt(max(0.0, total_of_squares / self.count - mean**2)))
+        summary = {
+            "dtype": self.dtype.str,
+            "count": self.count,
+            "nonzero_count": self.nonzero_count,
+            "min": None if self.min is None else float(self.min),
+            "max": None if self.max is None else float(self.max),
+            "mean": mean,
+            "std": std,
+            "percentiles": dict(
+                zip(map(_percentile_key, percentiles), self.percentiles(percentiles))
+            ),
+            "nonzero_percentiles": dict(
+                zip(
+                    map(_percentile_key, percentiles),
+                    self.percentiles(percentiles, nonzero=True),
+                )
+            ),
+        }
+        if histogram and self.count:
+            # Re-bin the fine histogram into display bins, by bin centers:
+            edges = np.linspace(self.min, self.max, _DISPLAY_HISTOGRAM_BINS + 1)
+            centers = self._bin_value(np.arange(len(self.counts)) + (0.0 if self.exact else 0.5))
+            display_counts, _ = np.histogram(centers, bins=edges, weights=self.counts)
+            summary["histogram"] = {
+                "edges": edges.tolist(),
+                "counts": display_counts.astype(np.int64).tolist(),
+            }
+        return summary
+
+
+def intensity_window(
+    stats: dict,
+    lower_percentile: float = 1.0,
+    upper_percentile: float = 99.5,
+) -> Optional[Tuple[float, float]]:
+    """
+    Return a robust (low, high) display window from precomputed statistics.
+
+    Uses the non-zero percentiles when there are enough non-zero voxels, and
+    falls back to the full value range if the percentiles coincide.
+
+    Arguments:
+        stats (dict): An `IntensityHistogram.summary`, e.g. the
+            "intensity_stats" attribute that `export_zarr_array` writes.
+        lower_percentile (float): The lower percentile. Must be one of the
+            precomputed percentiles. Defaults to 1.0.
+        upper_percentile (float): The upper percentile. Must be one of the
+            precomputed percentiles. Defaults to 99.5.
+
+    Returns:
+        Tuple[float, float]: The window.
+        None: If the statistics don't cover any voxels.
+
+    Raises:
+        KeyError: If a percentile was not precomputed.
+
+    """
+    if not stats or not stats.get("count"):
+        return None
+    key = (
+        "nonzero_percentiles"
+        if stats["nonzero_count"] >= MIN_NONZERO_VOXELS
+        else "percentiles"
+    )
+    low = stats[key][_percentile_key(lower_percentile)]
+    high = stats[key][_percentile_key(upper_percentile)]
+    if low is None or high is None or not high > low:
+        low, high = stats["min"], stats["max"]
+    return float(low), float(high)
+
+
+__all__ = ["IntensityHistogram", "intensity_window", "DEFAULT_PERCENTILES"]
@@ -0,0 +1,189 @@
+import pathlib
+import sys
+import threading
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+
+try:
+    import tifffile
+except ImportError as e:
+    raise ImportError(
+        "tifffile was not found. Install tifffile to memory-map TIFF stacks."
+    ) from e
+
+from .imagevp import ImageStackVolumeProvider
+
+_NATIVE_BYTEORDER = "<" if sys.byteorder == "little" else ">"
+
+# (offset, dtype, shape, tile_shape) of the pixel data of one TIFF file. For
+# strip layouts `shape` is (rows, cols) and `tile_shape` is None; for tiled
+# layouts `shape` is (tile_rows, tile_cols, tile_length, tile_width).
+_TiffLayout = Tuple[int, np.dtype, Tuple[int, ...], Optional[Tuple[int, int]]]
+
+
+def _memmap_layout(path: pathlib.Path) -> Optional[_TiffLayout]:
+    """
+    Return the memory-mappable layout of a TIFF's pixel data, if it has one.
+
+    A TIFF can be memory-mapped if its first page is single-channel,
+    uncompressed, stored in the machine's byte order, and its strips (or
+    tiles) are stored back-to-back in the file.
+
+    Arguments:
+        path (pathlib.Path): The path to the TIFF file.
+
+    Returns:
+        _TiffLayout: The layout of the pixel data.
+        None: If the file cannot be memory-mapped.
+
+    """
+    try:
+        with tifffile.TiffFile(str(path)) as tif:
+            page = tif.pages[0]
+            byteorder = tif.byteorder
+            if (
+                page.compression != 1
+                or page.predictor != 1
+                or page.fillorder != 1
+                or page.samplesperpixel != 1
+                or page.imagedepth != 1
+                or page.dtype is None
+                or page.bitspersample != page.dtype.itemsize * 8
+                or byteorder != _NATIVE_BYTEORDER
+            ):
+                return None
+            dtype = np.dtype(page.dtype)
+            offsets = np.asarray(page.dataoffsets, dtype=np.int64)
+            bytecounts = np.asarray(page.databytecounts, dtype=np.int64)
+            if page.is_tiled:
+                tile_shape = (page.tilelength, page.tilewidth)
+                shape = (
+                    -(-page.imagelength // page.tilelength),
+                    -(-page.imagewidth // page.tilewidth),
+                    page.tilelength,
+                    page.tilewidth,
+                )
+            else:
+                tile_shape = None
+                shape = (page.imagelength, page.imagewidth)
+    except Exception:
+        return None
+
+    # The segments must be contiguous and in order, and must add up to exactly
+    # the pixel data, so that one memmap covers the whole image:
+    if np.any(offsets[1:] != offsets[:-1] + bytecounts[:-1]):
+        return None
+    if int(bytecounts.sum()) != int(np.prod(shape)) * dtype.itemsize:
+        return None
+    return int(offsets[0]), dtype, shape, tile_shape
+
+
+class MemmapTiffStackVolumeProvider(ImageStackVolumeProvider):
+    """
+    An ImageStackVolumeProvider that memory-maps uncompressed TIFF slices.
+
+    Uncompressed TIFFs are read straight from their pixel strips (or tiles)
+    with `np.memmap`, so reads are bounded by disk bandwidth rather than by
+    decoding overhead. Slices that cannot be memory-mapped (e.g. compressed
+    TIFFs, or other image formats) are read through PIL as usual.
+    """
+
+    def __init__(
+        self,
+        path_or_list_of_images: Union[pathlib.Path, List[pathlib.Path]],
+        image_glob: str = "*",
+        cache_size: Union[int, str] = 0,
+        decode_workers: int = 1,
+        validate_headers: bool = True,
+    ):
+        """
+        Create a new MemmapTiffStackVolumeProvider.
+
+        Arguments are the same as for ImageStackVolumeProvider, except that the
+        slice cache is disabled by default: memory-mapped slices are already
+        cached by the operating system's page cache.
+
+        """
+        self._layouts: dict = {}
+        self._layouts_lock = threading.Lock()
+        super().__init__(
+            path_or_list_of_images,
+            image_glob=image_glob,
+            cache_size=cache_size,
+            decode_workers=decode_workers,
+            validate_headers=validate_headers,
+        )
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        del state["_layouts_lock"]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._layouts_lock = threading.Lock()
+
+    def _layout(self, z: int) -> Optional[_TiffLayout]:
+        """
+        Return the (memoized) memmap layout of the z-th slice.
+        """
+        with self._layouts_lock:
+            if z in self._layouts:
+                return self._layouts[z]
+        layout = _memmap_layout(pathlib.Path(self.paths[z]))
+        with self._layouts_lock:
+            self._layouts[z] = layout
+        return layout
+
+    def is_memmappable(self, z: int) -> bool:
+        """
+        Return whether the z-th slice is read by memory-mapping.
+
+        Arguments:
+            z (int): The index of the slice.
+
+        Returns:
+            bool: True if the slice is an uncompressed, contiguous TIFF.
+
+        """
+        return self._layout(z) is not None
+
+    def _read_slice(
+        self,
+        z: int,
+        box: Tuple[int, int, int, int],
+        full_slice: bool,
+        step: Tuple[int, int] = (1, 1),
+    ) -> np.ndarray:
+        layout = self._layout(z)
+        if layout is None:
+            return super()._read_slice(z, box, full_slice, step)
+
+        offset, dtype, shape, tile_shape = layout
+        # We don't keep the memmap around, since each one holds a file
+        # descriptor open. Reopening it is cheap compared to reading pixels.
+        data = np.memmap(self.paths[z], dtype=dtype, mode="r", offset=offset, shape=shape)
+        left, upper, right, lower = box
+        if tile_shape is None:
+            # Strided views of the memmap only touch the sampled rows.
+            region = data[upper:lower:step[1], left:right:step[0]]
+        else:
+            # Only the tiles that overlap the box are copied:
+            tile_length, tile_width = tile_shape
+            first_row, first_col = upper // tile_length, left // tile_width
+            tiles = data[
+                first_row : -(-lower // tile_length),
+                first_col : -(-right // tile_width),
+            ]
+            region = tiles.transpose(0, 2, 1, 3).reshape(
+                tiles.shape[0] * tile_length, tiles.shape[1] * tile_width
+            )
+            region = region[
+                upper - first_row * tile_length : lower - first_row * tile_length : step[1],
+                left - first_col * tile_width : right - first_col * tile_width : step[0],
+            ]
+        return region.T
+
+
+__all__ = ["MemmapTiffStackVolumeProvider"]
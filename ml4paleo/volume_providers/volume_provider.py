@@ -1,107 +1,131 @@
-from typing import Tuple
+import functools
+import operator
+from typing import Optional, Tuple
 import abc
 import numpy as np
 
 
+def _key_signature(key, permit_single_int: bool) -> tuple:
+    """
+    Convert an indexing key into a hashable tuple, validating its entries.
+
+    Slices become (start, stop, step) tuples, integers (including numpy
+    integers) become python ints, and Ellipsis is kept as-is.
+    """
+    if not isinstance(key, tuple):
+        if not permit_single_int and not isinstance(key, slice) and key is not Ellipsis:
+            raise IndexError("A single integer index is not permitted here.")
+        key = (key,)
+
+    signature = []
+    for item in key:
+        if isinstance(item, slice):
+            signature.append(
+                tuple(None if v is None else operator.index(v) for v in (
+                    item.start, item.stop, item.step
+                ))
+            )
+        elif item is Ellipsis:
+            signature.append(Ellipsis)
+        else:
+            try:
+                signature.append(operator.index(item))
+            except TypeError:
+                raise TypeError(
+                    f"Unsupported index {item!r}; only integers, slices, and "
+                    "Ellipsis are supported."
+                ) from None
+    return tuple(signature)
+
+
+@functools.lru_cache(maxsize=4096)
+def _normalize_signature(
+    signature: tuple, self_shape: Tuple[int, int, int]
+) -> Tuple[Tuple[int, int, int], Tuple[int, int, int], Tuple[int, int, int]]:
+    """
+    Normalize a key signature (see `_key_signature`) against an array shape.
+
+    The result is cached, since providers are typically read with the same
+    handful of keys over and over (e.g. slab after slab of a conversion).
+    """
+    # Expand the Ellipsis (if any) and pad the key out to three dimensions:
+    if signature.count(Ellipsis) > 1:
+        raise IndexError("An index can only have a single ellipsis ('...').")
+    if Ellipsis in signature:
+        at = signature.index(Ellipsis)
+        fill = ((None, None, None),) * (4 - len(signature))
+        signature = signature[:at] + fill + signature[at + 1 :]
+    if len(signature) > 3:
+        raise IndexError(f"Too many indices for a 3D volume: {len(signature)}.")
+    signature = signature + ((None, None, None),) * (3 - len(signature))
+
+    # Note that the shape is given in the reverse order of the key.
+    ranges = []
+    for item, dim in zip(signature, self_shape[::-1]):
+        if isinstance(item, tuple):
+            start, stop, step = slice(*item).indices(dim)
+            if step < 0:
+                raise ValueError("Negative slice steps are not supported.")
+            ranges.append((start, max(start, stop), step))
+        else:
+            index = item + dim if item < 0 else item
+            if not 0 <= index < dim:
+                raise IndexError(
+                    f"Index {item} is out of bounds for an axis of size {dim}."
+                )
+            ranges.append((index, index + 1, 1))
+
+    return ranges[2], ranges[1], ranges[0]
+
+
 def normalize_key(
     key: Tuple,
     self_shape: Tuple,
     permit_single_int: bool = True,
-) -> Tuple[Tuple[int, int], Tuple[int, int], Tuple[int, int]]:
+) -> Tuple[Tuple[int, int, int], Tuple[int, int, int], Tuple[int, int, int]]:
     """
-    NOTE: This function is copied from the BossDB "intern" package.
+    NOTE: This function is adapted from the BossDB "intern" package.
     https://github.com/jhuapl-boss/intern/blob/master/intern/convenience/array.py#L1293
 
-    Given indexing tuple, return (start, stop) for each dimension XYZ.
+    Given indexing tuple, return (start, stop, step) for each dimension, in
+    the reverse order of the key (so a key in XYZ order gives ZYX ranges).
 
+    Keys follow numpy's basic-indexing semantics: negative indices count from
+    the end of the axis, slice bounds are clipped to the axis, omitted
+    trailing dimensions (or an Ellipsis) select the full axis, and numpy
+    integer types are accepted anywhere a python int is. Integer indices
+    are returned as a one-element range, so providers can keep returning 3D
+    arrays. Only positive slice steps are supported; providers can use them
+    to skip data when downsampling.
 
     Arguments:
-        key (Tuple): An array of three values in one of the following formats
-            1. Start/Stop (`int:int`)
-            2. Single index (`int`)
-        self_shape (Tuple): Shape of the array being indexed. Used to
-            determine the bounds of the array if no endpoint is provided.
+        key (Tuple): Up to three values (or one value), each one of
+            1. A slice (`int:int` or `int:int:int`, with optional bounds)
+            2. A single index (`int`)
+            3. An Ellipsis (`...`), at most once
+        self_shape (Tuple): Shape of the array being indexed, in the reverse
+            order of the key. Used to determine the bounds of each axis.
             For example, if the user asks for `my_array[60:, 60:, 60:]` then
             the endpoint is assumed to be the full extent of the array.
-        permit_single_int (bool): Default True. Permit a single integer.
-            This integer is assumed to be a single z slice
-            (e.g. `my_array[500]`).
+        permit_single_int (bool): Default True. Permit a single integer
+            (e.g. `my_array[500]`), which indexes the first axis of the key.
 
     Returns:
-        Tuple[Tuple]: Set of three tuples with (start, stop) integers
-            for each dimension in XYZ
+        Tuple[Tuple]: Set of three tuples with (start, stop, step) integers
+            for each dimension, in the reverse order of the key. Starts and
+            stops are clipped to the array bounds, and stop >= start.
 
-    """
-    # There is a wide variety of indexing options available, including
-    # single-integer indexing,
-    # tuple-of-slices indexing,
-    # tuple-of-int indexing...
-
-    # First we'll address if the user presents a single integer.
-    # ```
-    # my_array[500]
-    # ```
-    # In this case, the user is asking for a single Z slice (or single X
-    # slice if in XYZ order... But that's a far less common use case.)
-    # We will get the full XY extents and download a single 2D array:
-    if isinstance(key, int) and permit_single_int:
-        # Get the full Z slice:
-        xs = (0, self_shape[2])
-        ys = (0, self_shape[1])
-        zs = (key, key + 1)
-    else:
-        _normalize_units = (1, 1, 1)
-
-        # We will now do the following codeblock three times, for X,Y,Z:
-        # First, we check to see if this index is a single integer. If so,
-        # the user is requesting a 2D array with zero depth along this
-        # dimension. For example, if the user asks for
-        # ```
-        # my_data[0:120, 0:120, 150]
-        # ```
-        # Then "150" suggests that the user just wants one single X slice.
-        if isinstance(key[2], int):
-            xs = (key[2], key[2] + 1)
-        else:
-            # If the key is a Slice, then it has .start and .stop attrs.
-            # (The user is requesting an array with more than one slice
-            # in this dimension.)
-            start = key[2].start if key[2].start else 0
-            stop = key[2].stop if key[2].stop else self_shape[0]
-
-            start = int(start / _normalize_units[0])
-            stop = int(stop / _normalize_units[0])
-
-            # Cast the coords to integers (since Boss needs int coords)
-            xs = (int(start), int(stop))
-
-        # Do the same thing again for the next dimension: Either a single
-        # integer, or a slice...
-        if isinstance(key[1], int):
-            ys = (key[1], key[1] + 1)
-        else:
-            start = key[1].start if key[1].start else 0
-            stop = key[1].stop if key[1].stop else self_shape[1]
+    Raises:
+        IndexError: If an integer index is out of bounds, or if there are too
+            many indices.
+        TypeError: If the key contains an unsupported index type.
+        ValueError: If a slice has a negative step.
 
-            start = start / _normalize_units[1]
-            stop = stop / _normalize_units[1]
-
-            ys = (int(start), int(stop))
-
-        # Do the same thing again for the last dimension: Either a single
-        # integer, or a slice...
-        if isinstance(key[0], int):
-            zs = (key[0], key[0] + 1)
-        else:
-            start = key[0].start if key[0].start else 0
-            stop = key[0].stop if key[0].stop else self_shape[2]
-
-            start = start / _normalize_units[2]
-            stop = stop / _normalize_units[2]
-
-            zs = (int(start), int(stop))
-
-    return xs, ys, zs
+    """
+    return _normalize_signature(
+        _key_signature(key, permit_single_int),
+        tuple(int(d) for d in self_shape),
+    )
 
 
 class VolumeProvider(abc.ABC):
@@ -140,6 +164,11 @@ class VolumeProvider(abc.ABC):
         """
         Return a slice of the volume.
 
+        Keys follow numpy's basic-indexing semantics (see `normalize_key`),
+        including positive slice steps. Providers should implement steps by
+        skipping the data that isn't sampled rather than reading it all and
+        striding afterwards, since exports use stepped reads to downsample.
+
         Arguments:
             key: The slice to return.
 
@@ -149,5 +178,51 @@ class VolumeProvider(abc.ABC):
         """
         raise NotImplementedError
 
+    @property
+    def supports_region_reads(self) -> bool:
+        """
+        Whether reading an XY region of a slice is cheaper than reading the
+        whole slice. Exports only split slices into XY tiles (and so read each
+        slice once per tile) for providers that can read regions cheaply.
+
+        Returns:
+            bool: True by default.
+
+        """
+        return True
+
+    def descriptor(self) -> Optional[dict]:
+        """
+        Return a lightweight, picklable description of this provider.
+
+        A descriptor holds only what is needed to rebuild an equivalent
+        provider (e.g. file paths and already-read header metadata), never
+        data, caches, or open file handles. Worker processes use it to build
+        their own provider once, instead of receiving a pickled copy of the
+        provider with every task. See `provider_from_descriptor`.
+
+        Returns:
+            dict: The provider class ("provider") and its constructor
+                arguments ("kwargs").
+            None: If this provider cannot be rebuilt from a description
+                (e.g. because it holds its data in memory).
+
+        """
+        return None
+
+
+def provider_from_descriptor(descriptor: dict) -> VolumeProvider:
+    """
+    Build a new volume provider from a descriptor.
+
+    Arguments:
+        descriptor (dict): A descriptor from `VolumeProvider.descriptor`.
+
+    Returns:
+        VolumeProvider: A new provider, equivalent to the described one.
+
+    """
+    return descriptor["provider"](**descriptor["kwargs"])
+
 
-__all__ = ["VolumeProvider", "normalize_key"]
+__all__ = ["VolumeProvider", "normalize_key", "provider_from_descriptor"]
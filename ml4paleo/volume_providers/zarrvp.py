@@ -1,4 +1,4 @@
-from typing import Tuple, Union
+from typing import Optional, Tuple, Union
 import pathlib
 import numpy as np
 import zarr
@@ -11,19 +11,55 @@ class ZarrVolumeProvider(VolumeProvider):
     A volume provider that provides a 3D volume of data from a zarr array.
     """
 
-    def __init__(self, file_path: Union[str, pathlib.Path]):
+    def __init__(self, file_path: Union[str, pathlib.Path], level: int = 0):
         """
         Create a new ZarrVolumeProvider.
 
+        If the zarr file is an OME-Zarr multiscale group (as written by
+        `export_zarr_array` with `multiscale_levels`), the array at the given
+        pyramid level is used.
+
         Arguments:
             file_path: The path to the zarr file.
+            level: The multiscale level to read, where 0 is full resolution.
+                Ignored for plain zarr arrays.
+
+        Raises:
+            ValueError: If the zarr file is a group without multiscales
+                metadata, or the level does not exist.
 
         """
-        self.zarr = zarr.open(str(file_path), mode="r")
+        self._file_path = file_path
+        self._level = level
+        opened = zarr.open(str(file_path), mode="r")
+        if isinstance(opened, zarr.Group):
+            if "multiscales" not in opened.attrs:
+                raise ValueError(f"{file_path} is a zarr group, not a multiscale volume.")
+            datasets = opened.attrs["multiscales"][0]["datasets"]
+            if not 0 <= level < len(datasets):
+                raise ValueError(
+                    f"Level {level} does not exist; {file_path} has {len(datasets)} levels."
+                )
+            opened = opened[datasets[level]["path"]]
+        self.zarr = opened
 
     def __getitem__(self, key):
         return self.zarr[key]
 
+    def descriptor(self) -> dict:
+        return {
+            "provider": type(self),
+            "kwargs": {"file_path": self._file_path, "level": self._level},
+        }
+
+    @property
+    def intensity_stats(self) -> Optional[dict]:
+        """
+        The intensity statistics that `export_zarr_array` stored with the
+        array, or None if there are none.
+        """
+        return self.zarr.attrs.get("intensity_stats")
+
     @property
     def shape(self) -> Tuple[int, int, int]:
         return self.zarr.shape
@@ -0,0 +1,235 @@
+import fnmatch
+import io
+import mmap
+import pathlib
+import struct
+import threading
+import zipfile
+from typing import List, Optional, Tuple, Union
+
+from .imagevp import ImageStackVolumeProvider
+
+# The fixed-size part of a ZIP local file header, which precedes each member's
+# (variable-length) name and extra field, and then its data.
+_LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+_LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+
+
+class _MemberView(io.RawIOBase):
+    """
+    A read-only, seekable binary file over a slice of a memory-mapped archive.
+
+    Reads copy only the requested bytes out of the map, so opening a member
+    is free, and reading a region of an image only touches the pages of the
+    archive that hold it.
+    """
+
+    def __init__(self, buffer: memoryview, name: str):
+        self._buffer = buffer
+        self._position = 0
+        self.name = name
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        data = self._buffer[self._position : self._position + len(b)]
+        b[: len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._buffer)
+        self._position = max(0, offset)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+
+class ZipArchive:
+    """
+    Random access to the members of a ZIP archive, by member name.
+
+    Stored (uncompressed) members are read straight out of a memory map of the
+    archive. Compressed members are decompressed into memory one at a time,
+    when they are opened. Nothing is ever extracted to disk.
+
+    Archives can be pickled (e.g. to send a provider to a worker process); the
+    archive is reopened on first use after unpickling.
+    """
+
+    def __init__(self, archive_path: Union[str, pathlib.Path]):
+        """
+        Open a ZIP archive.
+
+        Arguments:
+            archive_path (pathlib.Path): The path to the archive.
+
+        Raises:
+            ValueError: If the file is not a ZIP archive.
+
+        """
+        self.archive_path = pathlib.Path(archive_path)
+        if not zipfile.is_zipfile(self.archive_path):
+            raise ValueError(f"{self.archive_path} is not a ZIP archive.")
+        self._lock = threading.Lock()
+        self._zipfile: Optional[zipfile.ZipFile] = None
+        self._map: Optional[mmap.mmap] = None
+        self._data_ranges: dict = {}
+        with zipfile.ZipFile(self.archive_path) as zf:
+            self._infos = {
+                info.filename: info for info in zf.infolist() if not info.is_dir()
+            }
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        for key in ("_lock", "_zipfile", "_map"):
+            del state[key]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._zipfile = None
+        self._map = None
+
+    def names(self, pattern: str = "*") -> List[str]:
+        """
+        Return the (sorted) names of the file members that match a pattern.
+
+        Arguments:
+            pattern (str): A glob pattern to match member names against.
+                Defaults to "*" (every file member).
+
+        Returns:
+            List[str]: The matching member names.
+
+        """
+        return sorted(name for name in self._infos if fnmatch.fnmatch(name, pattern))
+
+    def _open_archive(self) -> Tuple[zipfile.ZipFile, mmap.mmap]:
+        with self._lock:
+            if self._zipfile is None:
+                self._zipfile = zipfile.ZipFile(self.archive_path)
+                with open(self.archive_path, "rb") as f:
+                    self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return self._zipfile, self._map
+
+    def _data_range(self, name: str) -> Optional[Tuple[int, int]]:
+        """
+        Return the (offset, size) of a stored member's data in the archive,
+        or None if the member is compressed (or encrypted).
+        """
+        if name in self._data_ranges:
+            return self._data_ranges[name]
+        info = self._infos[name]
+        data_range = None
+        if info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 0x1:
+            _, archive_map = self._open_archive()
+            header = _LOCAL_HEADER.unpack_from(archive_map, info.header_offset)
+            if header[0] != _LOCAL_HEADER_SIGNATURE:
+                raise ValueError(f"Bad local file header for {name} in {self.archive_path}.")
+            name_length, extra_length = header[-2], header[-1]
+            offset = info.header_offset + _LOCAL_HEADER.size + name_length + extra_length
+            data_range = (offset, info.file_size)
+        self._data_ranges[name] = data_range
+        return data_range
+
+    def is_stored(self, name: str) -> bool:
+        """
+        Return whether a member is stored uncompressed (and so is memory-mapped).
+        """
+        return self._data_range(name) is not None
+
+    def open(self, name: Union[str, pathlib.PurePath]):
+        """
+        Open a member of the archive for reading.
+
+        Arguments:
+            name (str): The name of the member.
+
+        Returns:
+            BinaryIO: A seekable binary file of the member's contents.
+
+        Raises:
+            KeyError: If there is no such member.
+
+        """
+        name = pathlib.PurePath(name).as_posix() if not isinstance(name, str) else name
+        if name not in self._infos:
+            raise KeyError(f"There is no member {name} in {self.archive_path}.")
+        data_range = self._data_range(name)
+        if data_range is None:
+            zf, _ = self._open_archive()
+            return io.BytesIO(zf.read(name))
+        _, archive_map = self._open_archive()
+        offset, size = data_range
+        return _MemberView(memoryview(archive_map)[offset : offset + size], name)
+
+
+class ZipImageStackVolumeProvider(ImageStackVolumeProvider):
+    """
+    An ImageStackVolumeProvider that reads its images directly from the
+    members of a ZIP archive, without extracting them.
+    """
+
+    def __init__(
+        self,
+        archive_path: Union[str, pathlib.Path],
+        members: Optional[List[str]] = None,
+        image_glob: str = "*",
+        cache_size: Union[int, str] = "guess",
+        decode_workers: int = 1,
+        validate_headers: bool = True,
+    ):
+        """
+        Create a new ZipImageStackVolumeProvider.
+
+        Arguments:
+            archive_path (pathlib.Path): The path to the ZIP archive.
+            members (List[str]): The names of the image members, in Z order.
+                If None, every member that matches `image_glob` is used, in
+                name order.
+            image_glob (str): A glob pattern to match member names against,
+                if members is None. Defaults to "*".
+
+        The other arguments are the same as for ImageStackVolumeProvider.
+
+        """
+        self.archive = ZipArchive(archive_path)
+        if members is None:
+            members = self.archive.names(image_glob)
+        super().__init__(
+            list(members),
+            cache_size=cache_size,
+            decode_workers=decode_workers,
+            validate_headers=validate_headers,
+        )
+
+    def _open_source(self, path):
+        return self.archive.open(path)
+
+    @property
+    def supports_region_reads(self) -> bool:
+        # Compressed members are decompressed in full on every read:
+        return super().supports_region_reads and self.archive.is_stored(
+            str(self.paths[0])
+        )
+
+    def descriptor(self) -> dict:
+        descriptor = super().descriptor()
+        descriptor["kwargs"]["members"] = descriptor["kwargs"].pop(
+            "path_or_list_of_images"
+        )
+        descriptor["kwargs"]["archive_path"] = self.archive.archive_path
+        return descriptor
+
+
+__all__ = ["ZipArchive", "ZipImageStackVolumeProvider"]
@@ -20,7 +20,9 @@ from flask import request
 from config import CONFIG
 from job import UploadJob
 from PIL import Image, ImageDraw
+from ml4paleo.segmentation.feature_cache import FeatureCache
 from ml4paleo.volume_providers import ZarrVolumeProvider
+from ml4paleo.volume_providers.stats import intensity_window
 
 MODEL_METRIC_SECTION_KEYS = (
     "metric",
@@ -47,6 +49,27 @@ MODEL_METRIC_KEYWORDS = (
 )
 
 
+_feature_cache: Optional[FeatureCache] = None
+
+
+def get_feature_cache() -> FeatureCache:
+    """
+    Return the process-wide cache of slice features, per CONFIG.
+
+    The in-memory part lives as long as the process (e.g. across preview
+    predictions in the web server); the on-disk part is shared with the
+    segmentation runner.
+    """
+    global _feature_cache
+    if _feature_cache is None:
+        _feature_cache = FeatureCache(
+            CONFIG.feature_cache_directory,
+            max_disk_bytes=CONFIG.feature_cache_max_disk_bytes,
+            max_memory_bytes=CONFIG.feature_cache_max_memory_bytes,
+        )
+    return _feature_cache
+
+
 def _job_id(job_or_id: Union[UploadJob, str]) -> str:
     """
     Normalize an UploadJob or raw job ID to the job ID string.
@@ -1419,6 +1442,7 @@ def normalize_annotation_volume(
     vol: np.ndarray,
     lower_percentile: float = 1.0,
     upper_percentile: float = 99.5,
+    intensity_stats: Optional[dict] = None,
 ) -> tuple[np.ndarray, dict]:
     """
     Normalize a sampled annotation subvolume into a high-contrast uint8 volume.
@@ -1426,8 +1450,26 @@ def normalize_annotation_volume(
     The annotation UI and training round-trip go through a browser canvas, so
     they are effectively limited to 8-bit display data. We therefore choose a
     robust intensity window server-side before serializing to PNG.
+
+    If the volume's precomputed `intensity_stats` (from conversion) are given,
+    the window comes from the whole volume, so every sample of a dataset is
+    displayed with the same window and no percentiles are computed here.
     """
     vol = np.asarray(vol)
+    window = None
+    if intensity_stats:
+        try:
+            window = intensity_window(intensity_stats, lower_percentile, upper_percentile)
+        except KeyError:
+            window = None
+    if window is not None:
+        return _apply_annotation_window(
+            vol,
+            float(intensity_stats["min"]),
+            float(intensity_stats["max"]),
+            *window,
+        )
+
     finite_values = vol[np.isfinite(vol)]
     if finite_values.size == 0:
         return np.zeros(vol.shape, dtype=np.uint8), {
@@ -1452,6 +1494,19 @@ def normalize_annotation_volume(
         window_min = source_min
         window_max = source_max
 
+    return _apply_annotation_window(vol, source_min, source_max, window_min, window_max)
+
+
+def _apply_annotation_window(
+    vol: np.ndarray,
+    source_min: float,
+    source_max: float,
+    window_min: float,
+    window_max: float,
+) -> tuple[np.ndarray, dict]:
+    """
+    Map an intensity window of a volume onto 0-255.
+    """
     if window_max <= window_min:
         fill_value = 0 if source_max <= 0 else 255
         return np.full(vol.shape, fill_value, dtype=np.uint8), {
@@ -46,10 +46,35 @@ class CONFIG:
     # for u8, and ~40 MB files for u16. Any larger than this, you should
     # make sure you can handle each chunk in RAM in your workflow.
     chunk_size = (512, 512, 64)
+    # If True, the chunk sizes in this file are only the preferred sizes: when
+    # an upload is converted, they are adapted to the shape and dtype of the
+    # volume, the parallelism settings, and the available memory (e.g. wider
+    # chunks for thin slabs, and tiled conversion for very wide slices). The
+    # chosen sizes are saved with the job, and used for all later processing.
+    adaptive_chunk_sizes = True
+    # The memory budget, in bytes, for adaptive chunk sizes. If None, half of
+    # the memory that is available when the upload is converted is used.
+    chunk_planning_memory_budget = None
+    # The compression profile for converted uploads (see
+    # `ml4paleo.volume_providers.compression.COMPRESSION_PROFILES`). If "auto",
+    # the image profiles are benchmarked on a sample of each upload, and the
+    # one with the best compression ratio that still writes at least
+    # `conversion_compression_min_mb_per_s` is used.
+    conversion_compression = "auto"
+    conversion_compression_min_mb_per_s = 100.0
     # The number of parallel jobs to run when converting uploaded data to zarr.
     # This can be roughly the number of cores on your machine, since the main
     # bottleneck is the disk IO.
     conversion_job_parallelism = max(1, _NUMBER_OF_CORES - 1)
+    # The number of threads to use when reading DICOM headers of an upload.
+    # Header reads are dominated by file-open latency rather than CPU, so this
+    # can be higher than the number of cores (especially on network storage).
+    header_scan_parallelism = 16
+    # The number of downsampled (2x per level) pyramid levels to write
+    # alongside the full-resolution volume when converting an upload. These
+    # are written as an OME-Zarr multiscale group, so viewers can stream low
+    # resolutions when zoomed out. Set to 0 to write a plain zarr array.
+    conversion_multiscale_levels = 3
 
     # Training and Annotation
     #
@@ -85,6 +110,39 @@ class CONFIG:
     # than the storage chunk size, because we want to be able to segment the
     # data in parallel and therefore may need more space in RAM.
     segmentation_chunk_size = (256, 256, 256)
+    # Features of previewed annotation slices are cached (keyed by the slice
+    # contents and the feature parameters), so that repeated preview
+    # predictions don't featurize the same slices over and over. (Training
+    # doesn't need the cache, since it stores its sampled features.) The
+    # most recently used features are kept in memory, and on disk here. Like
+    # the download cache, this directory is safe to delete.
+    feature_cache_directory = "volume/feature_cache"
+    feature_cache_max_disk_bytes = 4 * 1024**3
+    feature_cache_max_memory_bytes = 512 * 1024**2
+    # The sampled training features and labels of each annotation are stored
+    # per job, so that retraining only featurizes new annotations. If
+    # incremental training is enabled, retraining also keeps the previous
+    # model's trees and adds `incremental_training_estimators` new ones (fit
+    # on all of the samples), rather than training a new model from scratch.
+    # Once a model would grow past `incremental_training_max_estimators`
+    # trees (or if the annotations were edited or deleted, or a new class
+    # was annotated), it is retrained from scratch instead.
+    training_sample_directory = "volume/training_samples"
+    incremental_training = True
+    incremental_training_estimators = 10
+    incremental_training_max_estimators = 200
+    # The features that segmentation models are trained on: one of the banks
+    # in `ml4paleo.segmentation.features.FEATURE_BANKS` ("minimal", "default"
+    # or "full"). After training, models are retrained on only the fewest
+    # feature channels that make up `feature_pruning_importance` of their
+    # total feature importance, so segmentation only computes those channels.
+    # Set it to None to keep every channel. (The banks' 3D features aren't
+    # used here, since annotations are trained on as single slices.)
+    feature_bank = "default"
+    feature_pruning_importance = 0.99
+    # The compression profile for segmentation label volumes. Labels are a few
+    # small integers, which compress very well with bit-shuffling.
+    segmentation_compression = "labels"
     # The directory where segmented arrays should be stored, as zarrs. The
     # segmentation will be stored with the name "[timestamp].zarr", where the
     # timestamp lines up with the model that was used to generate it.
@@ -14,6 +14,11 @@ starts converting a job, and to `JobStatus.CONVERTED` when it finishes
 converting a job. If the conversion job fails, the job status will be set to
 `JobStatus.CONVERT_ERROR`.
 
+Conversions are resumable: completed chunks are recorded in a manifest next to
+the zarr array, and jobs that were interrupted mid-conversion (i.e. are still
+`JobStatus.CONVERTING` when the runner starts) are converted again, skipping
+the chunks that were already written.
+
 """
 
 import logging
@@ -28,8 +33,17 @@ from typing import Any, Iterator, Optional
 from config import CONFIG
 from job import DEFAULT_SOURCE_TYPE, JobStatus, JSONFileUploadJobManager, UploadJob
 
-from ml4paleo.volume_providers import ImageStackVolumeProvider
+from ml4paleo.volume_providers import (
+    ImageStackVolumeProvider,
+    ZipImageStackVolumeProvider,
+)
+from ml4paleo.volume_providers.zipvp import ZipArchive
 from ml4paleo.volume_providers.io import export_zarr_array
+from ml4paleo.volume_providers.chunking import plan_chunk_shapes
+from ml4paleo.volume_providers.compression import (
+    benchmark_compression,
+    pick_compression_profile,
+)
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
@@ -71,6 +85,28 @@ def get_next_uploaded_dataset_to_convert() -> Optional[UploadJob]:
     return next_job[0]
 
 
+def requeue_interrupted_conversions() -> None:
+    """
+    Queue jobs that were left in the CONVERTING state for conversion again.
+
+    Only one conversion runner runs at a time, so a job that is CONVERTING
+    when the runner starts was interrupted (e.g. by a container restart).
+    Conversions are resumable, so the retry skips the chunks that were
+    already written.
+
+    Arguments:
+        None
+
+    Returns:
+        None
+
+    """
+    job_manager = get_job_manager()
+    for job in job_manager.get_jobs_by_status(JobStatus.CONVERTING):
+        log.info("Resuming interrupted conversion of job %s.", job.id)
+        job_manager.update_job(job.id, update={"status": JobStatus.UPLOADED})
+
+
 def _list_uploaded_files(upload_dir: pathlib.Path) -> list[pathlib.Path]:
     return sorted(path for path in upload_dir.iterdir() if path.is_file())
 
@@ -122,13 +158,41 @@ def _extract_zip_archive(archive_path: pathlib.Path, destination: pathlib.Path)
     return sorted(extracted_source_files)
 
 
+def _list_zip_archive_members(archive_path: pathlib.Path) -> list[pathlib.PurePosixPath]:
+    members = [
+        pathlib.PurePosixPath(name)
+        for name in ZipArchive(archive_path).names()
+        if not _should_ignore_source_file(pathlib.PurePosixPath(name))
+    ]
+    if len(members) == 0:
+        raise ValueError(f"Archive {archive_path.name} did not contain any usable files.")
+    return members
+
+
 @contextmanager
-def _prepare_upload_source_files(job_id: str) -> Iterator[list[pathlib.Path]]:
+def _prepare_upload_source_files(
+    job_id: str,
+) -> Iterator[tuple[list[pathlib.PurePath], Optional[pathlib.Path]]]:
+    """
+    Yield the source files of an upload, and the archive they are in (if any).
+
+    If the upload is a single ZIP archive, its members are read in place, so
+    the yielded source files are member names within that archive. Otherwise,
+    any ZIP archives are extracted to a temporary directory, and the yielded
+    source files are paths on disk (and the archive is None).
+    """
     upload_dir = pathlib.Path(CONFIG.upload_directory) / job_id
     uploaded_files = _list_uploaded_files(upload_dir)
     if len(uploaded_files) == 0:
         raise ValueError(f"No uploaded files found for job {job_id}.")
 
+    usable_files = [
+        path for path in uploaded_files if not _should_ignore_source_file(path, upload_dir)
+    ]
+    if len(usable_files) == 1 and zipfile.is_zipfile(usable_files[0]):
+        yield _list_zip_archive_members(usable_files[0]), usable_files[0]
+        return
+
     with tempfile.TemporaryDirectory(prefix=f"ml4paleo_upload_{job_id}_") as tmpdir:
         staging_root = pathlib.Path(tmpdir)
         prepared_source_files: list[pathlib.Path] = []
@@ -149,28 +213,37 @@ def _prepare_upload_source_files(job_id: str) -> Iterator[list[pathlib.Path]]:
         if len(prepared_source_files) == 0:
             raise ValueError(f"No usable source files found for job {job_id}.")
 
-        yield prepared_source_files
+        yield prepared_source_files, None
+
 
+def _scan_uploaded_dicom_headers(
+    upload_paths: list[pathlib.PurePath], archive_path: Optional[pathlib.Path] = None
+) -> dict:
+    """
+    Read the DICOM headers of the uploaded files, in parallel.
 
-def _count_uploaded_dicom_files(upload_paths: list[pathlib.Path]) -> int:
+    The same headers are used to detect DICOM uploads and to build the
+    DicomVolumeProvider, so each file's header is only parsed once.
+    """
     try:
-        import pydicom
+        from ml4paleo.volume_providers.dicomvp import scan_dicom_headers
     except ImportError:
-        return 0
+        return {}
 
-    dicom_file_count = 0
-    for path in upload_paths:
-        try:
-            pydicom.dcmread(str(path), stop_before_pixels=True)
-        except Exception:
-            continue
-        dicom_file_count += 1
-    return dicom_file_count
+    open_fn = ZipArchive(archive_path).open if archive_path is not None else None
+    return scan_dicom_headers(
+        upload_paths, workers=CONFIG.header_scan_parallelism, open_fn=open_fn
+    )
 
 
-def _get_volume_provider(job: UploadJob, source_files: list[pathlib.Path]):
+def _get_volume_provider(
+    job: UploadJob,
+    source_files: list[pathlib.PurePath],
+    archive_path: Optional[pathlib.Path] = None,
+):
     source_type = getattr(job, "source_type", DEFAULT_SOURCE_TYPE)
-    dicom_file_count = _count_uploaded_dicom_files(source_files)
+    dicom_headers = _scan_uploaded_dicom_headers(source_files, archive_path)
+    dicom_file_count = len(dicom_headers)
     if 0 < dicom_file_count < len(source_files):
         raise ValueError(
             f"Upload for job {job.id} contains a mix of DICOM and non-DICOM files. Upload one source type per job."
@@ -178,7 +251,10 @@ def _get_volume_provider(job: UploadJob, source_files: list[pathlib.Path]):
 
     if source_type == "dicom" or dicom_file_count == len(source_files):
         try:
-            from ml4paleo.volume_providers.dicomvp import DicomVolumeProvider
+            from ml4paleo.volume_providers.dicomvp import (
+                DicomVolumeProvider,
+                ZipDicomVolumeProvider,
+            )
         except ImportError as exc:
             raise RuntimeError(
                 "DICOM support is not installed. Install the dicom dependency group."
@@ -190,12 +266,117 @@ def _get_volume_provider(job: UploadJob, source_files: list[pathlib.Path]):
                 job.id,
                 source_type,
             )
-        return DicomVolumeProvider(source_files), "dicom"
+        # Conversion reads every slice exactly once, in full-XY slabs, so a
+        # decoded-slice cache would only cost memory in each worker.
+        if archive_path is not None:
+            return (
+                ZipDicomVolumeProvider(
+                    archive_path,
+                    members=[path.as_posix() for path in source_files],
+                    cache_size=0,
+                    headers=dicom_headers,
+                    header_workers=CONFIG.header_scan_parallelism,
+                ),
+                "dicom",
+            )
+        return (
+            DicomVolumeProvider(
+                source_files,
+                cache_size=0,
+                headers=dicom_headers,
+                header_workers=CONFIG.header_scan_parallelism,
+            ),
+            "dicom",
+        )
 
     ordered_source_files = sorted(source_files, key=lambda path: (path.name, str(path)))
+    if archive_path is not None:
+        # Stored (uncompressed) members are memory-mapped straight out of the
+        # archive, so there is no need to extract them first.
+        return (
+            ZipImageStackVolumeProvider(
+                archive_path,
+                members=[path.as_posix() for path in ordered_source_files],
+                cache_size=0,
+            ),
+            "image_stack",
+        )
+    if all(path.suffix.lower() in (".tif", ".tiff") for path in ordered_source_files):
+        # Uncompressed TIFF exports can be memory-mapped instead of decoded.
+        # (Compressed slices still fall back to a regular PIL read.)
+        try:
+            from ml4paleo.volume_providers.tiffvp import MemmapTiffStackVolumeProvider
+        except ImportError:
+            log.info("tifffile is not installed; reading TIFF upload %s with PIL.", job.id)
+        else:
+            return MemmapTiffStackVolumeProvider(ordered_source_files), "image_stack"
     return ImageStackVolumeProvider(ordered_source_files, cache_size=0), "image_stack"
 
 
+def _plan_job_storage(job: UploadJob, volume_provider) -> dict:
+    """
+    Return the storage plan (chunk shapes and compression) for a job's volume.
+
+    A plan that was already saved for the same volume (e.g. by a conversion
+    that was interrupted) is reused, so that a resumed conversion writes the
+    same chunks even if the available memory has changed since.
+
+    Arguments:
+        job (UploadJob): The job being converted.
+        volume_provider (VolumeProvider): The job's source volume.
+
+    Returns:
+        dict: The plan. If adaptive chunk sizes are enabled, this includes
+            the chunk shapes (see `plan_chunk_shapes`); it always includes
+            the "compression_profile" to convert with.
+
+    """
+    shape = [int(dim) for dim in volume_provider.shape[-3:]]
+    existing = getattr(job, "chunk_plan", None)
+    if existing and existing.get("shape") == shape:
+        return existing
+
+    if CONFIG.adaptive_chunk_sizes:
+        plan = plan_chunk_shapes(
+            shape,
+            volume_provider.dtype,
+            conversion_workers=CONFIG.conversion_job_parallelism,
+            segmentation_workers=CONFIG.segment_job_parallelism,
+            memory_budget=CONFIG.chunk_planning_memory_budget,
+            multiscale_levels=CONFIG.conversion_multiscale_levels,
+            storage_chunk_size=CONFIG.chunk_size,
+            segmentation_chunk_size=CONFIG.segmentation_chunk_size,
+            meshing_chunk_size=CONFIG.meshing_chunk_size,
+        )
+    else:
+        plan = {"shape": shape, "notes": []}
+
+    if CONFIG.conversion_compression == "auto":
+        chunk_size = plan.get("storage_chunk_size", CONFIG.chunk_size)
+        # Benchmark on the chunked directory's disk, since that's where the
+        # real chunks will be written:
+        pathlib.Path(CONFIG.chunked_directory).mkdir(parents=True, exist_ok=True)
+        results = benchmark_compression(
+            volume_provider,
+            chunk_size=tuple(chunk_size),
+            workdir=CONFIG.chunked_directory,
+        )
+        plan["compression_profile"] = pick_compression_profile(
+            results, min_write_mb_per_s=CONFIG.conversion_compression_min_mb_per_s
+        )
+        plan["compression_benchmark"] = results
+        plan["notes"].append(
+            f"Picked the {plan['compression_profile']} compression profile "
+            "by benchmarking a sample of the upload."
+        )
+    else:
+        plan["compression_profile"] = CONFIG.conversion_compression
+
+    for note in plan["notes"]:
+        log.info("Storage plan for job %s: %s", job.id, note)
+    return plan
+
+
 def convert_next():
     """
     Convert the next dataset that has been uploaded but not yet converted.
@@ -219,9 +400,9 @@ def convert_next():
     next_job.start_convert()
     job_manager.update_job(next_job.id, next_job)
     try:
-        with _prepare_upload_source_files(next_job.id) as source_files:
+        with _prepare_upload_source_files(next_job.id) as (source_files, archive_path):
             volume_provider, resolved_source_type = _get_volume_provider(
-                next_job, source_files
+                next_job, source_files, archive_path
             )
             if getattr(next_job, "source_type", DEFAULT_SOURCE_TYPE) != resolved_source_type:
                 next_job.source_type = resolved_source_type
@@ -237,6 +418,11 @@ def convert_next():
                 len(source_files),
             )
 
+            chunk_plan = _plan_job_storage(next_job, volume_provider)
+            next_job.chunk_plan = chunk_plan
+            job_manager.update_job(next_job.id, update={"chunk_plan": chunk_plan})
+            chunk_size = next_job.chunk_size_for("storage", CONFIG.chunk_size)
+
             def _progress_callback(completed: int, item: Any, total: int) -> None:
                 logging.info(f"Converted {completed} / {total} for job {next_job.id}.")
                 job_mgr = get_job_manager()
@@ -247,13 +433,23 @@ def convert_next():
             export_zarr_array(
                 volume_provider,
                 pathlib.Path(CONFIG.chunked_directory) / next_job.id,
-                chunk_size=CONFIG.chunk_size,
+                chunk_size=chunk_size,
+                compression=chunk_plan.get("compression_profile"),
                 progress_callback=_progress_callback,
                 parallel_jobs=CONFIG.conversion_job_parallelism,
-                # This needs to be set to the chunk size to avoid multiple jobs trying
-                # to write to the same chunk in memory at once, which COULD result in
-                # missing data.
-                slice_count=CONFIG.chunk_size[2],
+                # Workers rebuild the provider from its paths (and DICOM header
+                # index) once, rather than receiving it with every slab.
+                parallel_backend="process",
+                # Record finished chunks, so that an interrupted conversion can
+                # pick up where it left off instead of starting over.
+                resume=True,
+                # Parallel work is split along the chunk grid, so this only sets
+                # how deep each slab read from the upload is.
+                slice_count=chunk_size[2],
+                multiscale_levels=CONFIG.conversion_multiscale_levels,
+                # Very wide slices are converted in XY tiles rather than in
+                # full slabs, to stay within the planned memory budget.
+                max_block_bytes=chunk_plan.get("conversion_max_block_bytes"),
             )
     except Exception:
         log.exception("Conversion failed for job %s.", next_job.id)
@@ -270,6 +466,7 @@ def convert_next():
 
 
 if __name__ == "__main__":
+    requeue_interrupted_conversions()
     while True:
         convert_next()
         time.sleep(CONFIG.job_poll_sec)
@@ -132,6 +132,7 @@ class UploadJobSchema(Schema):
     last_updated_at = fields.Str()
     current_job_progress = fields.Float()
     shape = fields.List(fields.Int(), allow_none=True)
+    chunk_plan = fields.Dict(allow_none=True)
 
 
 def _new_job_id() -> UploadJobID:
@@ -160,6 +161,7 @@ class UploadJob:
         last_updated_at: Optional[str] = None,
         current_job_progress: Optional[float] = None,
         shape: Optional[List[int]] = None,
+        chunk_plan: Optional[dict] = None,
     ):
         """
         Create a new job with the fieldwise constructor.
@@ -181,6 +183,10 @@ class UploadJob:
                 on the job. If not provided, the progress will be set to 0.
             shape (List[int]): The shape of the data in the job. If not
                 provided, the shape will be set to None.
+            chunk_plan (dict): The storage and compute chunk shapes (see
+                `plan_chunk_shapes`) and the compression profile chosen for
+                the data when it was converted. If not provided, the
+                configured chunk sizes are used.
 
         """
         created_at = created_at or datetime.datetime.now().isoformat()
@@ -193,6 +199,22 @@ class UploadJob:
         self.created_at = created_at
         self.last_updated_at = last_updated_at
         self.current_job_progress = current_job_progress or 0.0
+        self.chunk_plan = chunk_plan
+
+    def chunk_size_for(self, stage: str, default):
+        """
+        Return the planned chunk size of a processing stage of this job.
+
+        Arguments:
+            stage (str): "storage", "segmentation", or "meshing".
+            default: The chunk size to use if there is no plan for the stage.
+
+        Returns:
+            Tuple[int, int, int]: The chunk size.
+
+        """
+        planned = (self.chunk_plan or {}).get(f"{stage}_chunk_size")
+        return tuple(planned) if planned else default
 
     def set_status(self, status: JobStatus):
         """
@@ -235,6 +257,7 @@ class UploadJob:
             last_updated_at=d.get("last_updated_at", d["created_at"]),
             current_job_progress=d.get("current_job_progress", 0.0),
             shape=d.get("shape", None),
+            chunk_plan=d.get("chunk_plan", None),
         )
         return res
 
@@ -51,6 +51,7 @@ from apputils import (
     count_annotation_samples,
     extract_annotation_image_slice,
     get_annotation_pairs,
+    get_feature_cache,
     get_job_artifact_freshness,
     get_latest_segmentation_id,
     get_latest_mesh_id,
@@ -677,7 +678,9 @@ class ML4PaleoWebApplication:
                 CONFIG.annotation_shape_xyz[::-1],
                 return_metadata=True,
             )
-            display_vol_zyx, display_stats = normalize_annotation_volume(vol_zyx)
+            display_vol_zyx, display_stats = normalize_annotation_volume(
+                vol_zyx, intensity_stats=zarrvol.intensity_stats
+            )
             # Get the slice as a PIL image:
             img = get_png_filmstrip(display_vol_zyx)
             img_bytes = io.BytesIO()
@@ -949,8 +952,13 @@ class ML4PaleoWebApplication:
                 return jsonify({"prediction": None})
 
             # Predict the mask:
-            model = RandomForest3DSegmenter()
+            model = RandomForest3DSegmenter(feature_cache=get_feature_cache())
             model.load(str(modelpath))
+            if sample_metadata is None and model.intensity_window is not None:
+                # Display images are already windowed onto 0-255; map them
+                # back onto raw intensities, as in training:
+                low, high = model.intensity_window
+                img_np = low + img_np.astype(np.float32) / 255.0 * (high - low)
             mask = model._segment_slice(img_np)
             mask = mask.T
             annos = np.array(
@@ -1171,7 +1179,7 @@ class ML4PaleoWebApplication:
         #  Visualization
         #
         ###############################
-        @self.app.route("/api/job/<job_id>/zarr/<path>", methods=["GET"])
+        @self.app.route("/api/job/<job_id>/zarr/<path:path>", methods=["GET"])
         def render_zarr(job_id, path):
             # Just serve files from the zarr directory:
             return send_from_directory(
@@ -1179,7 +1187,7 @@ class ML4PaleoWebApplication:
             )
 
         @self.app.route(
-            "/api/job/<job_id>/segmentation/<seg_id>/zarr/<path>", methods=["GET"]
+            "/api/job/<job_id>/segmentation/<seg_id>/zarr/<path:path>", methods=["GET"]
         )
         def render_zarr_seg(job_id, path, seg_id):
             # Just serve files from the zarr directory:
@@ -68,7 +68,7 @@ def mesh_job(job: UploadJob) -> None:
     mesher = ChunkedMesher(
         volume_provider,
         mesh_output_dir,
-        chunk_size=CONFIG.meshing_chunk_size,
+        chunk_size=job.chunk_size_for("meshing", CONFIG.meshing_chunk_size),
         downsample_factor=CONFIG.meshing_downsample_factor,
     )
     # Mesh everything:
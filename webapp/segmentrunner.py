@@ -28,14 +28,23 @@ from PIL import Image
 import numpy as np
 from config import CONFIG
 from job import JobStatus, JSONFileUploadJobManager, UploadJob
-from apputils import get_annotation_pairs, load_annotation_sample_metadata, load_annotation_source_slice
+from apputils import (
+    get_annotation_pairs,
+    get_latest_segmentation_model,
+    load_annotation_sample_metadata,
+    load_annotation_source_slice,
+    load_model_metadata_sidecar,
+)
 
 from ml4paleo.segmentation import (
     RandomForest3DSegmenter,
     Segmenter3D,
     segment_volume_to_zarr,
 )
+from ml4paleo.segmentation.features import feature_bank
+from ml4paleo.segmentation.training_store import TrainingSampleStore
 from ml4paleo.volume_providers import ZarrVolumeProvider
+from ml4paleo.volume_providers.stats import intensity_window
 
 logging.basicConfig(level=logging.INFO)
 
@@ -58,10 +67,14 @@ def model_factory() -> Tuple[Segmenter3D, dict]:
         "n_jobs": -1,
     }
     return (
-        RandomForest3DSegmenter(rf_kwargs=dict(rf_kwargs)),
+        RandomForest3DSegmenter(
+            rf_kwargs=dict(rf_kwargs),
+            features_fn=feature_bank(CONFIG.feature_bank),
+        ),
         {
             "rf_kwargs": dict(rf_kwargs),
             "model_class": "RandomForest3DSegmenter",
+            "feature_bank": CONFIG.feature_bank,
         },
     )
 
@@ -93,18 +106,27 @@ def _sample_id_from_path(img_path: pathlib.Path) -> str:
     return stem.removeprefix(prefix) if stem.startswith(prefix) else stem
 
 
-def _foreground_metrics(pred: np.ndarray, truth: np.ndarray) -> dict[str, float]:
+def _foreground_metrics(
+    pred: np.ndarray,
+    truth: np.ndarray,
+    weights: Optional[np.ndarray] = None,
+) -> dict[str, float]:
     """
     Return foreground-over-background metrics for one prediction array.
+
+    If `weights` are given, each voxel counts as that many voxels (e.g. when
+    the voxels are a sample of a larger image).
     """
     pred_fg = pred != 0
     truth_fg = truth != 0
+    if weights is None:
+        weights = np.ones(truth.shape, dtype=np.float32)
 
-    tp = int(np.logical_and(pred_fg, truth_fg).sum())
-    fp = int(np.logical_and(pred_fg, ~truth_fg).sum())
-    fn = int(np.logical_and(~pred_fg, truth_fg).sum())
-    correct = int((pred == truth).sum())
-    total = int(truth.size)
+    tp = int(round(float(weights[np.logical_and(pred_fg, truth_fg)].sum())))
+    fp = int(round(float(weights[np.logical_and(pred_fg, ~truth_fg)].sum())))
+    fn = int(round(float(weights[np.logical_and(~pred_fg, truth_fg)].sum())))
+    correct = int(round(float(weights[pred == truth].sum())))
+    total = int(round(float(weights.sum())))
 
     foreground_denom = (2 * tp) + fp + fn
     iou_denom = tp + fp + fn
@@ -127,40 +149,31 @@ def _foreground_metrics(pred: np.ndarray, truth: np.ndarray) -> dict[str, float]
 
 def _evaluate_training_metrics(
     segmenter: Segmenter3D,
-    imgs_xy: list[np.ndarray],
-    segs_xy: list[np.ndarray],
+    samples: dict[str, np.ndarray],
 ) -> dict[str, float]:
     """
     Evaluate the trained segmenter on the training slices.
-    """
-    aggregate = {"tp": 0, "fp": 0, "fn": 0, "correct": 0, "total": 0}
-    for img_xy, seg_xy in zip(imgs_xy, segs_xy):
-        pred_xy = segmenter._segment_slice(img_xy)  # type: ignore[attr-defined]
-        metrics = _foreground_metrics(pred_xy, seg_xy)
-        for key in aggregate:
-            aggregate[key] += int(metrics[key])
-
-    tp = aggregate["tp"]
-    fp = aggregate["fp"]
-    fn = aggregate["fn"]
-    correct = aggregate["correct"]
-    total = aggregate["total"]
-    foreground_denom = (2 * tp) + fp + fn
-    iou_denom = tp + fp + fn
-    dice = (2 * tp / foreground_denom) if foreground_denom else 1.0
-    iou = (tp / iou_denom) if iou_denom else 1.0
-    accuracy = (correct / total) if total else 1.0
 
+    Rather than segmenting every training slice again, the segmenter is
+    evaluated on the weighted evaluation samples that were featurized along
+    with its training samples, so the pixel counts are estimates.
+    """
+    metrics = _foreground_metrics(
+        segmenter.predict_samples(samples["evaluation_features"]),  # type: ignore[attr-defined]
+        samples["evaluation_labels"],
+        samples["evaluation_weights"],
+    )
     return {
-        "train_foreground_dice": float(dice),
-        "train_foreground_iou": float(iou),
-        "train_pixel_accuracy": float(accuracy),
-        "train_loss": float(1.0 - dice),
-        "foreground_tp": int(tp),
-        "foreground_fp": int(fp),
-        "foreground_fn": int(fn),
-        "pixel_correct": int(correct),
-        "pixel_total": int(total),
+        "train_foreground_dice": metrics["train_foreground_dice"],
+        "train_foreground_iou": metrics["train_foreground_iou"],
+        "train_pixel_accuracy": metrics["train_pixel_accuracy"],
+        "train_loss": metrics["train_loss"],
+        "foreground_tp": int(metrics["tp"]),
+        "foreground_fp": int(metrics["fp"]),
+        "foreground_fn": int(metrics["fn"]),
+        "pixel_correct": int(metrics["correct"]),
+        "pixel_total": int(metrics["total"]),
+        "evaluation_sample_count": int(len(samples["evaluation_labels"])),
     }
 
 
@@ -201,6 +214,66 @@ def _update_model_metadata(
         json.dump(existing, f, indent=2, sort_keys=True)
 
 
+def _load_training_samples(
+    job: UploadJob,
+    segmenter: Segmenter3D,
+    imgs_xy: list[np.ndarray],
+    segs_xy: list[np.ndarray],
+) -> Tuple[dict[str, np.ndarray], list[str]]:
+    """
+    Return the training samples of all annotations, and their store keys.
+
+    Samples are stored per job (see `TrainingSampleStore`), so only
+    annotations that are new (or were edited) since the last training are
+    featurized. Samples of annotations that no longer exist are pruned.
+    """
+    store = TrainingSampleStore(pathlib.Path(CONFIG.training_sample_directory) / str(job.id))
+    parameters = segmenter.training_parameters()  # type: ignore[attr-defined]
+    keys = []
+    for img_xy, seg_xy in zip(imgs_xy, segs_xy):
+        key = store.key(img_xy, seg_xy, parameters)
+        if key not in store:
+            store.put(
+                key,
+                segmenter.training_samples(  # type: ignore[attr-defined]
+                    img_xy[:, :, np.newaxis], seg_xy[:, :, np.newaxis]
+                ),
+            )
+        keys.append(key)
+    store.prune(keys)
+    return store.load(keys), keys
+
+
+def _previous_model_to_grow(
+    job: UploadJob, sample_keys: list[str], parameters: str
+) -> Optional[pathlib.Path]:
+    """
+    Return the latest model of the job, if it can be grown incrementally.
+
+    A model can be grown if it was trained with the same parameters, on
+    annotations that all still exist unchanged, and growing it won't take it
+    past `CONFIG.incremental_training_max_estimators` trees.
+    """
+    if not CONFIG.incremental_training:
+        return None
+    model_path = get_latest_segmentation_model(job)
+    if model_path is None:
+        return None
+    metadata = load_model_metadata_sidecar(job, model_path.stem) or {}
+    previous_keys = metadata.get("training_sample_keys")
+    if previous_keys is None or metadata.get("training_parameters") != parameters:
+        return None
+    if not set(previous_keys) <= set(sample_keys):
+        return None
+    n_estimators = metadata.get("rf_kwargs", {}).get("n_estimators", 0)
+    n_estimators = metadata.get("n_estimators", n_estimators)
+    if n_estimators + CONFIG.incremental_training_estimators > (
+        CONFIG.incremental_training_max_estimators
+    ):
+        return None
+    return model_path
+
+
 def train_job(job: UploadJob) -> Tuple[Segmenter3D, str]:
     # First train the segmenter on the available training data.
     # The training data live in the CONFIG.training_directory directory, with
@@ -246,14 +319,81 @@ def train_job(job: UploadJob) -> Tuple[Segmenter3D, str]:
 
     # Train the model:
     segmenter, model_params = model_factory()
+    # Normalize features by the volume's intensity window, which was
+    # computed when the volume was converted (older conversions have none):
+    intensity_stats = ZarrVolumeProvider(
+        pathlib.Path(CONFIG.chunked_directory) / str(job.id)
+    ).intensity_stats
+    if intensity_stats and hasattr(segmenter, "intensity_window"):
+        segmenter.intensity_window = intensity_window(intensity_stats)
+        model_params["intensity_window"] = segmenter.intensity_window
+    window = getattr(segmenter, "intensity_window", None)
+    if window is not None and metadata_backed_samples < training_count:
+        # Legacy annotations without metadata are display PNGs, i.e. already
+        # windowed onto 0-255. Map them back onto raw intensities, so that
+        # they are normalized like the raw slices of the other samples:
+        low, high = window
+        imgs_np = imgs_np.astype(np.float32)
+        for z, sample in enumerate(training_samples):
+            if not sample["uses_raw_volume_metadata"]:
+                imgs_np[:, :, z] = low + imgs_np[:, :, z] / 255.0 * (high - low)
 
     logging.info("Training with shapes img=%s and seg=%s", imgs_np.shape, segs_np.shape)
-    segmenter.fit(imgs_np, segs_np)
-    training_metrics = _evaluate_training_metrics(
+    samples, sample_keys = _load_training_samples(
+        job,
         segmenter,
         [imgs_np[:, :, z] for z in range(imgs_np.shape[2])],
         [segs_np[:, :, z] for z in range(segs_np.shape[2])],
     )
+    parameters = segmenter.training_parameters()  # type: ignore[attr-defined]
+    previous_model = _previous_model_to_grow(job, sample_keys, parameters)
+    training_mode = "full"
+    if previous_model is not None:
+        try:
+            segmenter.load(str(previous_model))
+            segmenter.grow(  # type: ignore[attr-defined]
+                samples["features"],
+                samples["labels"],
+                CONFIG.incremental_training_estimators,
+            )
+            training_mode = "incremental"
+            logging.info(
+                "Grew model %s of job %s by %s trees.",
+                previous_model.stem,
+                job.id,
+                CONFIG.incremental_training_estimators,
+            )
+        except ValueError as e:
+            # E.g. a new class was annotated; start over.
+            logging.info("Retraining job %s from scratch: %s", job.id, e)
+            segmenter, _ = model_factory()
+            segmenter.intensity_window = model_params.get("intensity_window")  # type: ignore[attr-defined]
+    if training_mode == "full":
+        segmenter.fit_samples(  # type: ignore[attr-defined]
+            samples["features"], samples["labels"]
+        )
+        if CONFIG.feature_pruning_importance is not None:
+            channels = segmenter.prune_features(  # type: ignore[attr-defined]
+                samples["features"],
+                samples["labels"],
+                CONFIG.feature_pruning_importance,
+            )
+            logging.info(
+                "Kept %s / %s feature channels for job %s.",
+                len(channels),
+                samples["features"].shape[1],
+                job.id,
+            )
+    model_params.update(
+        {
+            "training_mode": training_mode,
+            "training_parameters": parameters,
+            "training_sample_keys": sample_keys,
+            "n_estimators": int(segmenter._clf.n_estimators),  # type: ignore[attr-defined]
+            "feature_channels": segmenter.feature_channels,  # type: ignore[attr-defined]
+        }
+    )
+    training_metrics = _evaluate_training_metrics(segmenter, samples)
     logging.info(
         "Training metrics for job %s: dice=%.4f iou=%.4f loss=%.4f",
         job.id,
@@ -317,10 +457,11 @@ def train_and_segment_job(job: UploadJob) -> None:
         vol_provider,
         seg_path,
         segmenter=segmenter,
-        chunk_size=CONFIG.segmentation_chunk_size,
+        chunk_size=job.chunk_size_for("segmentation", CONFIG.segmentation_chunk_size),
         parallel=CONFIG.segment_job_parallelism,
         progress=True,
         progress_callback=progress_callback,
+        compression=CONFIG.segmentation_compression,
     )
     _update_model_metadata(job.id, timestamp, {"segmentation_id": seg_path.name})
 